@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of dtree on synthetic trees.
+
+Run the default scenarios and save the results::
+
+    python benchmarks/bench_dtree.py --output before.json
+
+or a single custom scenario::
+
+    python benchmarks/bench_dtree.py --depth 5 --fanout 4 --mix eq,range --nesting 1 --policy recursive
+
+and compare two result files, e.g. from two commits; the exit status is 1
+if some metric regressed by more than the threshold::
+
+    python benchmarks/bench_dtree.py --compare before.json after.json --threshold 0.1
+
+Features missing from the checked out dtree, like compile, run_batch or
+Forest, are skipped, so that older commits can be measured too.
+"""
+import argparse
+import gc
+import json
+import operator
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dtree  # noqa: E402
+from dtree import *  # noqa: E402
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NUMBERS = ['n%d' % i for i in range(8)]
+CATEGORIES = ['c%d' % i for i in range(4)]
+LABELS = ['v%d' % i for i in range(20)]
+KINDS = ('eq', 'range', 'in', 'opaque')
+
+SCENARIOS = {
+    'eq-once': dict(depth=3, fanout=8, mix=('eq',), nesting=0, policy='once'),
+    'range-once': dict(depth=3, fanout=8, mix=('range',), nesting=0, policy='once'),
+    'mixed-once': dict(depth=4, fanout=5, mix=KINDS, nesting=0, policy='once'),
+    'nested-once': dict(depth=3, fanout=5, mix=KINDS, nesting=2, policy='once'),
+    'mixed-recursive': dict(depth=4, fanout=5, mix=KINDS, nesting=1, policy='recursive'),
+    'wide-eq-once': dict(depth=1, fanout=200, mix=('eq',), nesting=0, policy='once'),
+    'deep-range-recursive': dict(depth=12, fanout=2, mix=('range',), nesting=0, policy='recursive'),
+    # a Forest of that many trees over the same accessors
+    'forest-once': dict(depth=3, fanout=4, mix=('eq', 'range', 'in'), nesting=1, policy='once', trees=16),
+}
+
+# metrics where a higher value is better, all others are costs
+THROUGHPUT_METRICS = ('run_throughput', 'batch_throughput')
+
+
+def make_accessor(name):
+    # reads obj[name], and is the name column of run_batch where it exists
+    if hasattr(ValueAccessor, 'key'):
+        return ValueAccessor.key(name)
+    if hasattr(DTree, 'run_batch'):
+        return ValueAccessor(name, operator.itemgetter(name), column=name)
+    return ValueAccessor(name, operator.itemgetter(name))
+
+
+def make_accessors():
+    return dict((name, make_accessor(name)) for name in NUMBERS + CATEGORIES)
+
+
+def make_condition(rng, accessors, mix, nesting):
+    if nesting > 0:
+        operands = [make_condition(rng, accessors, mix, nesting - 1) for _ in range(rng.randint(2, 3))]
+        return rng.choice((And, Or))(*operands)
+    kind = rng.choice(mix)
+    if kind == 'eq':
+        return accessors[rng.choice(CATEGORIES)].eq(rng.choice(LABELS))
+    if kind == 'range':
+        accessor = accessors[rng.choice(NUMBERS)]
+        return getattr(accessor, rng.choice(('lt', 'le', 'gt', 'ge')))(rng.randint(0, 100))
+    if kind == 'in':
+        return accessors[rng.choice(CATEGORIES)].in_(set(rng.sample(LABELS, 3)))
+    name = rng.choice(NUMBERS)
+    threshold = rng.randint(0, 100)
+    return to_condition(lambda obj: obj[name] % 7 < threshold % 7)
+
+
+def make_node(rng, accessors, depth, fanout, mix, nesting, policy, leaves):
+    args = []
+    for _ in range(fanout):
+        condition = make_condition(rng, accessors, mix, nesting)
+        if depth > 1:
+            args.append((condition, make_node(rng, accessors, depth - 1, fanout, mix, nesting, None, leaves)))
+        else:
+            leaves.append(len(leaves))
+            args.append((condition, ToAction(lambda obj, i=len(leaves): i, 'leaf %d' % len(leaves))))
+    args.append((else_, pass_))
+    return Node(*args, policy=policy)
+
+
+def make_inputs(rng, size):
+    rows = []
+    for _ in range(size):
+        row = dict((name, rng.randint(0, 100)) for name in NUMBERS)
+        row.update((name, rng.choice(LABELS)) for name in CATEGORIES)
+        rows.append(row)
+    return rows
+
+
+def best_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run_all(runner, inputs):
+    run = runner.run
+    for obj in inputs:
+        run(obj)
+
+
+def bench(scenario, inputs_size=2000, repeat=5, seed=0):
+    if scenario.get('trees'):
+        return bench_forest(scenario, inputs_size, repeat, seed)
+    rng = random.Random(seed)
+    node = make_node(rng, make_accessors(), scenario['depth'], scenario['fanout'], scenario['mix'],
+                     scenario['nesting'], scenario['policy'], [])
+    inputs = make_inputs(rng, inputs_size)
+    results = {}
+
+    results['construction_time'] = best_of(repeat, lambda: DTree(node))
+    tracemalloc.start()
+    try:
+        tree = DTree(node)
+        results['tree_memory'] = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    if hasattr(tree, 'compile'):
+        results['compile_time'] = best_of(repeat, tree.compile)
+
+    elapsed = best_of(repeat, lambda: run_all(tree, inputs))
+    results['run_latency'] = elapsed / len(inputs)
+    results['run_throughput'] = len(inputs) / elapsed
+    if hasattr(tree, 'compile'):
+        compiled = tree.compile()
+        results['compiled_latency'] = best_of(repeat, lambda: run_all(compiled, inputs)) / len(inputs)
+
+    if numpy is not None and hasattr(tree, 'run_batch'):
+        columns = dict((name, numpy.array([row[name] for row in inputs])) for name in NUMBERS + CATEGORIES)
+        results['batch_throughput'] = len(inputs) / best_of(repeat, lambda: tree.run_batch(columns))
+    return results
+
+
+def bench_forest(scenario, inputs_size=2000, repeat=5, seed=0):
+    if not hasattr(dtree, 'Forest'):
+        return {}
+    rng = random.Random(seed)
+    accessors = make_accessors()
+    trees = [
+        DTree(make_node(rng, accessors, scenario['depth'], scenario['fanout'], scenario['mix'],
+                        scenario['nesting'], scenario['policy'], []))
+        for _ in range(scenario['trees'])
+    ]
+    inputs = make_inputs(rng, inputs_size)
+    results = {}
+
+    forest = Forest(trees)
+    results['forest_latency'] = best_of(repeat, lambda: run_all(forest, inputs)) / len(inputs)
+    # Forest inlines the key lookups of every tree; memoizing them in the
+    # shared scope instead is what this one measures, where it can be chosen
+    try:
+        evaluate = dtree._Compiler(memoize_paths=True).compile_forest(trees)[1]
+    except TypeError:
+        evaluate = None
+
+    def run_memoized():
+        for obj in inputs:
+            evaluate(obj, {}, None)
+    if evaluate is not None:
+        results['forest_memoized_latency'] = best_of(repeat, run_memoized) / len(inputs)
+
+    runs = [tree.compile().run for tree in trees]
+
+    def run_trees():
+        for obj in inputs:
+            for run in runs:
+                run(obj)
+    results['trees_latency'] = best_of(repeat, run_trees) / len(inputs)
+    return results
+
+
+def git_commit():
+    try:
+        output = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.STDOUT,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode().strip()
+
+
+def compare(old, new, threshold):
+    regressions = []
+    for name in sorted(set(old['results']) & set(new['results'])):
+        for metric in sorted(set(old['results'][name]) & set(new['results'][name])):
+            before = old['results'][name][metric]
+            after = new['results'][name][metric]
+            if not before or not after:
+                continue
+            if metric in THROUGHPUT_METRICS:
+                change = before / after - 1
+            else:
+                change = after / before - 1
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions.append((name, metric))
+            print('%-22s %-18s %12.4g %12.4g %+8.1f%%%s' % (name, metric, before, after, change * 100, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run, may be repeated; all by default')
+    parser.add_argument('--depth', type=int)
+    parser.add_argument('--fanout', type=int)
+    parser.add_argument('--mix', help='comma separated condition kinds among %s' % ', '.join(KINDS))
+    parser.add_argument('--nesting', type=int, help='levels of And/Or nesting in conditions')
+    parser.add_argument('--policy', choices=('once', 'recursive'))
+    parser.add_argument('--inputs', type=int, default=2000, help='number of inputs per run')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file to write the results to')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slow-down reported as a regression by --compare')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        return 1 if compare(old, new, args.threshold) else 0
+
+    custom = dict((key, getattr(args, key)) for key in ('depth', 'fanout', 'nesting', 'policy'))
+    if args.mix:
+        custom['mix'] = tuple(args.mix.split(','))
+    custom = dict((key, value) for key, value in custom.items() if value is not None)
+    if custom:
+        scenario = dict(SCENARIOS['mixed-once'], **custom)
+        scenarios = {'custom': scenario}
+    else:
+        scenarios = dict((name, SCENARIOS[name]) for name in (args.scenario or SCENARIOS))
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_implementation() + ' ' + platform.python_version(),
+        'scenarios': dict((name, dict(s, mix=list(s['mix']))) for name, s in scenarios.items()),
+        'results': {},
+    }
+    for name in sorted(scenarios):
+        results = bench(scenarios[name], args.inputs, args.repeat, args.seed)
+        report['results'][name] = results
+        print('%-22s %s' % (name, '  '.join('%s=%.4g' % item for item in sorted(results.items()))))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,22 @@
 # -*- coding: utf-8 -*-
 import functools
+import hashlib
+from itertools import islice
+import json
+import keyword
+import multiprocessing
+from bisect import bisect_left
+import operator
+import os
+import pickle
+import random
+import re
+import tempfile
+import threading
+import time
 from weakref import WeakKeyDictionary
 from collections import OrderedDict
+import sys
 
 __version__ = "1.0.5"
 __author__ = 'ZouYJ'
@@ -10,6 +25,8 @@ __all__ = (
     "Error",
     "UnknownPolicyError",
     "NoMatchError",
+    "FrozenError",
+    "RuleFileError",
     "register_policy",
     "Description",
     "Condition",
@@ -20,19 +37,28 @@ __all__ = (
     "else_",
     "ELSE",
     "ToCondition",
+    "Compare",
     "Runner",
     "Catch",
     "Action",
     "ToAction",
+    "BatchAction",
     "Chain",
     "Node",
     "DTree",
+    "CompiledDTree",
+    "Forest",
+    "DecisionDiagram",
+    "Trace",
+    "AuditLog",
     "ValueAccessor",
     "CachingGetter",
+    "LATENCY_BUCKETS",
     "pass_",
     "PASS",
     "to_condition",
     "to_action",
+    "load_rules",
     "isnode",
     "isaction",
     "iscondition",
@@ -41,6 +67,12 @@ __all__ = (
 )
 
 
+# plain dicts keep insertion order and take less memory since Python 3.7
+_OrderedDict = dict if sys.version_info >= (3, 7) else OrderedDict
+
+_STRING_TYPES = (str, type(u''))
+
+
 class Error(Exception):
     pass
 
@@ -53,25 +85,49 @@ class NoMatchError(Error):
     pass
 
 
-def run_by_once_policy(self, obj):
-    for condition, runner in self._condition_to_runner.items():
-        if condition.validate(obj):
-            return runner.run(obj)
+class FrozenError(Error):
+    pass
+
+
+class RuleFileError(Error):
+    pass
+
+
+def run_by_once_policy(self, obj, scope=None):
+    if scope is None:
+        scope = {}
+    plan = self._plan
+    if plan is None:
+        plan = self._plan = _build_plan(list(self._condition_to_runner.items()))
+    for condition, runner in plan:
+        if runner is None:
+            runner = condition.match(obj, scope)
+            if runner is not None:
+                return runner._run(obj, scope)
+        elif condition._validate(obj, scope):
+            return runner._run(obj, scope)
     if self.else_runner:
-        return self.else_runner.run(obj)
+        return self.else_runner._run(obj, scope)
     else:
         raise NoMatchError
 
 
-def run_by_recursive_policy(self, obj):
+def run_by_recursive_policy(self, obj, scope=None):
+    if scope is None:
+        scope = {}
     for condition, runner in self._condition_to_runner.items():
         try:
-            if condition.validate(obj):
-                return runner.run(obj)
+            if not condition._validate(obj, scope):
+                continue
         except NoMatchError:
             continue
+        try:
+            return runner._run(obj, scope)
+        except NoMatchError:
+            # the runner may have changed obj before giving up
+            scope.clear()
     if self.else_runner:
-        return self.else_runner.run(obj)
+        return self.else_runner._run(obj, scope)
     else:
         raise NoMatchError
 
@@ -85,21 +141,67 @@ POLICIES = {
 DEFAULT_POLICY = ONCE
 
 
-def register_policy(policy, run_method):
-    global POLICIES
+def register_policy(policy, run_method, scoped=False):
+    """Register ``run_method(dtree, obj)`` as the run method of ``policy``.
+
+    With ``scoped=True`` the run method is called as
+    ``run_method(dtree, obj, scope)`` instead, and should pass the
+    evaluation scope on through ``Condition._validate`` and ``Runner._run``.
+    The values of POLICIES are such scoped run methods, so a two-argument
+    run method must be registered here rather than set in POLICIES; the
+    built-in run_by_once_policy and run_by_recursive_policy may still be
+    called as ``run_method(dtree, obj)``.
+    """
     assert policy not in POLICIES, 'Policy %s already registered' % policy
+    if not scoped:
+        unscoped_run_method = run_method
+
+        def run_method(self, obj, scope):
+            return unscoped_run_method(self, obj)
+
     POLICIES[policy] = run_method
 
 
-class Description(object):
+_MISSING = object()
+
+
+class _Slotted(object):
+    # pickles the __slots__ of subclasses, which Python 2 only does by
+    # itself with protocol 2
+
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', ()))
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if name == '__dict__':
+                    continue
+                try:
+                    state[name] = cls.__dict__[name].__get__(self, cls)
+                except AttributeError:
+                    pass
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+
+class Description(_Slotted):
+
+    # subclasses keep their attributes in __slots__, since large rule sets
+    # hold very many conditions and runners
+    __slots__ = ()
 
     _description = None
 
     @property
     def description(self):
-        if self._description is None:
-            self._description = self.get_default_description()
-        return self._description
+        description = getattr(self, '_description', None)
+        if description is None:
+            description = self._description = self.get_default_description()
+        return description
 
     @description.setter
     def description(self, description):
@@ -109,11 +211,89 @@ class Description(object):
         return self.__class__.__name__
 
 
+class _StructuralKey(object):
+    """Hashable structure of a condition, with its hash computed once."""
+
+    __slots__ = ('parts', '_hash')
+
+    def __init__(self, *parts):
+        self.parts = parts
+        self._hash = hash(parts)
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return self is other or (
+            isinstance(other, _StructuralKey) and self._hash == other._hash and self.parts == other.parts
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        return self.parts
+
+    def __setstate__(self, parts):
+        self.__init__(*parts)
+
+
+def _constant_key(value):
+    # the type is part of the key: eq(1) and eq(True) may differ, e.g. for is_
+    if isinstance(value, (list, tuple)):
+        parts = tuple(_constant_key(item) for item in value)
+        if None in parts:
+            return None
+        return type(value), parts
+    if isinstance(value, (set, frozenset)):
+        value = frozenset(value)
+    try:
+        hash(value)
+    except TypeError:
+        return None
+    return type(value), value
+
+
 class Condition(Description):
 
+    __slots__ = ()
+
+    # A pure condition has no side effects and does not raise for the
+    # inputs reaching it, so DTree.optimize may evaluate it in another order.
+    pure = False
+
+    _key = _MISSING
+
+    @property
+    def key(self):
+        """Structural identity of the condition, or None if it is opaque.
+
+        Conditions with equal keys validate alike on an input, so within a
+        DTree run compound and pure conditions are validated once per key.
+        """
+        key = getattr(self, '_key', _MISSING)
+        if key is _MISSING:
+            key = self._key = self.get_key()
+        return key
+
+    def get_key(self):
+        return None
+
+    def __getstate__(self):
+        state = super(Condition, self).__getstate__()
+        # the key is computed again when needed: it holds the types of
+        # constants, which Python 2 cannot always pickle, e.g. type(None)
+        state.pop('_key', None)
+        return state
+
     def validate(self, obj):
         raise NotImplementedError
 
+    def _validate(self, obj, scope):
+        # validate within the evaluation scope of a DTree run, see
+        # ValueAccessor.of
+        return self.validate(obj)
+
     def __call__(self, obj):
         return self.validate(obj)
 
@@ -133,12 +313,35 @@ class Condition(Description):
 
 class And(Condition):
 
+    __slots__ = ('_conditions', '_description', '_key')
+
     def __init__(self, *conditions):
         self._conditions = conditions
 
+    @property
+    def pure(self):
+        return all(condition.pure for condition in self._conditions)
+
     def validate(self, obj):
         return all(condition.validate(obj) for condition in self._conditions)
 
+    def _validate(self, obj, scope):
+        if type(self) is not And and _overrides(self, And, 'validate'):
+            return self.validate(obj)
+        try:
+            key = self._key
+        except AttributeError:
+            key = self.key
+        if key is None:
+            return all(condition._validate(obj, scope) for condition in self._conditions)
+        result = scope.get(key, _MISSING)
+        if result is _MISSING:
+            result = scope[key] = all(condition._validate(obj, scope) for condition in self._conditions)
+        return result
+
+    def get_key(self):
+        return _compound_key('and', self._conditions)
+
     def get_default_description(self):
         L = [condition.description for condition in self._conditions]
         return 'AND(' + ', '.join(L) + ')'
@@ -146,12 +349,35 @@ class And(Condition):
 
 class Or(Condition):
 
+    __slots__ = ('_conditions', '_description', '_key')
+
     def __init__(self, *conditions):
         self._conditions = conditions
 
+    @property
+    def pure(self):
+        return all(condition.pure for condition in self._conditions)
+
     def validate(self, obj):
         return any(condition.validate(obj) for condition in self._conditions)
 
+    def _validate(self, obj, scope):
+        if type(self) is not Or and _overrides(self, Or, 'validate'):
+            return self.validate(obj)
+        try:
+            key = self._key
+        except AttributeError:
+            key = self.key
+        if key is None:
+            return any(condition._validate(obj, scope) for condition in self._conditions)
+        result = scope.get(key, _MISSING)
+        if result is _MISSING:
+            result = scope[key] = any(condition._validate(obj, scope) for condition in self._conditions)
+        return result
+
+    def get_key(self):
+        return _compound_key('or', self._conditions)
+
     def get_default_description(self):
         L = [condition.description for condition in self._conditions]
         return 'OR(' + ', '.join(L) + ')'
@@ -159,12 +385,35 @@ class Or(Condition):
 
 class Not(Condition):
 
+    __slots__ = ('_condition', '_description', '_key')
+
     def __init__(self, condition):
         self._condition = condition
 
+    @property
+    def pure(self):
+        return self._condition.pure
+
     def validate(self, obj):
         return not self._condition.validate(obj)
 
+    def _validate(self, obj, scope):
+        if type(self) is not Not and _overrides(self, Not, 'validate'):
+            return self.validate(obj)
+        try:
+            key = self._key
+        except AttributeError:
+            key = self.key
+        if key is None:
+            return not self._condition._validate(obj, scope)
+        result = scope.get(key, _MISSING)
+        if result is _MISSING:
+            result = scope[key] = not self._condition._validate(obj, scope)
+        return result
+
+    def get_key(self):
+        return _compound_key('not', (self._condition,))
+
     def get_default_description(self):
         condition = self._condition
         n = 1
@@ -178,33 +427,78 @@ class Not(Condition):
 
 class Else(Condition):
 
+    __slots__ = ('_description', '_key')
+
+    pure = True
+
     def validate(self, obj):
         return True
 
     def get_default_description(self):
         return "ELSE"
 
+    def __reduce__(self):
+        if self is else_:
+            return 'else_'
+        return super(Else, self).__reduce__()
+
 
 else_ = ELSE = Else()
 
 
 class ToCondition(Condition):
 
-    def __init__(self, validator, description=None):
+    # __dict__ is only allocated when needed, e.g. by functools.wraps in
+    # to_condition
+    __slots__ = ('_validator', '_description', '_key', 'pure', '__dict__')
+
+    def __init__(self, validator, description=None, pure=False):
         self._validator = validator
         if description is None and isinstance(validator, Condition):
             description = validator.description
         self._description = description
+        self.pure = pure
 
     def validate(self, obj):
         return self._validator(obj)
 
+    def _validate(self, obj, scope):
+        try:
+            key = self._key
+        except AttributeError:
+            key = self.key
+        if key is None:
+            return self.validate(obj)
+        result = scope.get(key, _MISSING)
+        if result is _MISSING:
+            result = scope[key] = self.validate(obj)
+        return result
+
+    def get_key(self):
+        if not self.pure:
+            return None
+        return _StructuralKey('call', self._validator)
+
+
+def _compound_key(kind, conditions):
+    keys = [condition.key for condition in conditions]
+    if None in keys:
+        return None
+    return _StructuralKey(kind, *keys)
+
 
 class Runner(Description):
 
+    __slots__ = ()
+
     def run(self, obj):
         raise NotImplementedError
 
+    def _run(self, obj, scope):
+        # run within the evaluation scope of a DTree run, see
+        # ValueAccessor.of
+        return self.run(obj)
+
     def __div__(self, runner):
         assert isinstance(runner, Runner), "Expected Runner, got %s" % type(runner)
         return Chain(self, runner)
@@ -223,18 +517,30 @@ class Runner(Description):
 
 class Catch(Runner):
 
+    __slots__ = ('pre_runner', 'next_runner', 'error_handler', '_description')
+
     def __init__(self, pre_runner, next_runner=None, error_handler=None):
         self.pre_runner = pre_runner
         self.next_runner = next_runner
         self.error_handler = error_handler
 
     def run(self, obj):
+        return self._run_scoped(obj, {})
+
+    def _run(self, obj, scope):
+        if type(self) is not Catch and _overrides(self, Catch, 'run'):
+            return self.run(obj)
+        return self._run_scoped(obj, scope)
+
+    def _run_scoped(self, obj, scope):
         try:
-            return self.pre_runner.run(obj)
+            return self.pre_runner._run(obj, scope)
         except Exception as e:
             ret = None
             if self.next_runner:
-                ret = self.next_runner.run(obj)
+                # the scope only holds values read before pre_runner ran
+                scope.clear()
+                ret = self.next_runner._run(obj, scope)
             if self.error_handler:
                 self.error_handler(e, obj)
                 return ret
@@ -253,11 +559,14 @@ class Catch(Runner):
 
 
 class Action(Runner):
-    pass
+
+    __slots__ = ()
 
 
 class ToAction(Action):
 
+    __slots__ = ('_runner', '_description', '__dict__')
+
     def __init__(self, runner, description=None):
         self._runner = runner
         if description is None and isinstance(runner, Runner):
@@ -268,27 +577,70 @@ class ToAction(Action):
         return self._runner(obj)
 
 
-pass_ = PASS = ToAction(lambda obj: None, "PASS")
+class BatchAction(Action):
+    """Action running a function on many objects at once.
+
+    ``runner`` takes a list of objects and returns the list of their
+    results, e.g. with one bulk insert. DTree.run_bulk calls it once with
+    all the objects routed to its leaf, and run() with a list of one.
+    """
+
+    __slots__ = ('_runner', '_description')
+
+    def __init__(self, runner, description=None):
+        self._runner = runner
+        self._description = description
+
+    def run(self, obj):
+        return self.run_bulk([obj])[0]
+
+    def run_bulk(self, objs):
+        results = list(self._runner(objs))
+        if len(results) != len(objs):
+            raise Error('%s returned %d results for %d objects' % (self.description, len(results), len(objs)))
+        return results
+
+
+def _pass(obj):
+    return None
+
+
+pass_ = PASS = ToAction(_pass, "PASS")
 
 
 class Chain(Action):
 
+    __slots__ = ('_runners', '_description')
+
     def __init__(self, *runners):
         for runner in runners:
             assert isinstance(runner, Runner)
         self._runners = runners
 
     def run(self, obj):
+        return self._run_scoped(obj, {})
+
+    def _run(self, obj, scope):
+        if type(self) is not Chain and _overrides(self, Chain, 'run'):
+            return self.run(obj)
+        return self._run_scoped(obj, scope)
+
+    def _run_scoped(self, obj, scope):
         ret = None
-        for runner in self._runners:
-            ret = runner.run(obj)
+        for i, runner in enumerate(self._runners):
+            if i:
+                # values read before the previous runners ran may be stale
+                scope.clear()
+            ret = runner._run(obj, scope)
         return ret
 
     def get_default_description(self):
         return ' ==> '.join(runner.description for runner in self._runners)
 
 
-class Node(object):
+class Node(_Slotted):
+
+    __slots__ = ('args', 'kwargs')
 
     def __init__(self, *args, **kwargs):
         for condition, runner_or_node in args:
@@ -301,6 +653,13 @@ class Node(object):
 
 class DTree(Runner):
 
+    # __dict__ is only allocated for extra attributes, like the ones set by
+    # instrument()
+    __slots__ = (
+        '_node', '_kwargs', '_policy', '_condition_to_runner', '_else_runner',
+        '_plan', '_parent', '_frozen', '_description', '_run_method', '_height', '__dict__',
+    )
+
     @property
     def depth(self):
         n = 0
@@ -312,30 +671,123 @@ class DTree(Runner):
 
     @property
     def parent(self):
-        if not hasattr(self, '_parent'):
-            return None
-        return self._parent
+        return getattr(self, '_parent', None)
 
     @parent.setter
     def parent(self, parent):
+        if self._frozen:
+            raise FrozenError('Cannot change the parent of a frozen DTree')
         self._parent = parent
 
-    def __init__(self, node):
+    @property
+    def frozen(self):
+        return self._frozen
+
+    @Runner.description.setter
+    def description(self, description):
+        if self._frozen:
+            raise FrozenError('Cannot change the description of a frozen DTree')
+        self._description = description
+
+    def __init__(self, node, lazy=False):
         self._node = node
-        kwargs = node.kwargs
+        self._frozen = False
+        kwargs = self._kwargs = node.kwargs
         policy = kwargs.get('policy') or self.default_policy
         if policy is not None and policy not in POLICIES:
             raise UnknownPolicyError(policy)
         self._policy = policy
-        self._condition_to_runner = OrderedDict()
+        self._condition_to_runner = _OrderedDict()
         self._else_runner = None
-        args = node.args
-        for cond, run in args:
-            self.add_child(cond, run)
+        self._plan = None
+        # the run method of the policy, resolved by freeze()
+        self._run_method = None
+        # the number of DTree levels below, or any number above
+        # _MAX_CALL_HEIGHT once add_child() got it that deep, which decides
+        # whether runs need _run_iteratively; unknown until a lazy tree is
+        # frozen
+        self._height = 0
+        if lazy:
+            # the children are built by _expand() on first use
+            self._lazy = True
+            self._height = _UNKNOWN_HEIGHT
+            self._run_tree = functools.partial(_run_lazily, self)
+            return
+        built = getattr(_building, 'trees', None)
+        if built is not None:
+            # a sub-tree, whose children _build_children adds
+            _building.trees = None
+            built.append(self)
+            return
+        _build_children(self)
 
     @property
     def node(self):
-        return self._node
+        """The Node the tree was built from, rebuilt if dropped."""
+        if self._node is not None:
+            return self._node
+        # the sub-trees which dropped their node, parents before children
+        dropped = []
+        stack = [self]
+        while stack:
+            dtree = stack.pop()
+            dropped.append(dtree)
+            stack.extend(runner for _, runner in dtree.children if isdtree(runner) and runner._node is None)
+        nodes = {}
+        for dtree in reversed(dropped):
+            args = []
+            for condition, runner in dtree.children:
+                if isdtree(runner):
+                    runner = nodes[id(runner)] if runner._node is None else runner._node
+                args.append((condition, runner))
+            nodes[id(dtree)] = Node(*args, **dtree._kwargs)
+        return nodes[id(self)]
+
+    def drop_nodes(self):
+        """Drop the references to the Nodes the tree was built from.
+
+        Saves their memory once nothing else refers to them; the node
+        property rebuilds them on demand. Returns the tree.
+        """
+        stack = [self]
+        while stack:
+            dtree = stack.pop()
+            if dtree._frozen:
+                raise FrozenError('Cannot drop the nodes of a frozen DTree')
+            stack.extend(runner for _, runner in dtree.children if isdtree(runner))
+            dtree._node = None
+        return self
+
+    def expand(self):
+        """Build all the sub-trees of a lazy tree now.
+
+        ``DTree(node, lazy=True)`` only builds the children of the tree and
+        of each sub-tree from their Node when the tree is first run or its
+        children are read, so that the branches never visited cost neither
+        time nor memory. Returns the tree.
+        """
+        stack = [self]
+        while stack:
+            for _, runner in stack.pop().children:
+                if isdtree(runner):
+                    stack.append(runner)
+        return self
+
+    def _expand(self):
+        # build the children of a lazy tree, once
+        if not getattr(self, '_lazy', False):
+            return
+        with _expand_lock:
+            if self._lazy:
+                for condition, runner_or_node in self._node.args:
+                    self._add_child(condition, runner_or_node)
+                self._restore_run(_run_lazily)
+                self._lazy = False
+
+    def _restore_run(self, replacement):
+        # undo self._run_tree = functools.partial(replacement, self), and only that
+        if getattr(self._run_tree, 'func', None) is replacement:
+            del self._run_tree
 
     @property
     def default_policy(self):
@@ -343,13 +795,32 @@ class DTree(Runner):
 
     @property
     def policy(self):
-        if self.parent is None:
-            return self._policy or DEFAULT_POLICY
-        return self._policy or self.parent.policy
+        dtree = self
+        while not dtree._policy:
+            dtree = dtree.parent
+            if dtree is None:
+                return DEFAULT_POLICY
+        return dtree._policy
 
     def add_child(self, condition, runner_or_node):
+        self._expand()
+        runner = self._add_child(condition, runner_or_node)
+        if isdtree(runner):
+            # the trees this one is a sub-tree of may get deeper too; only
+            # whether they get deeper than _MAX_CALL_HEIGHT matters
+            dtree, height = self, min(runner._height + 1, _MAX_CALL_HEIGHT + 1)
+            while dtree is not None and dtree._height < height:
+                dtree._height = height
+                dtree, height = dtree.parent, min(height + 1, _MAX_CALL_HEIGHT + 1)
+
+    def _add_child(self, condition, runner_or_node):
+        if self._frozen:
+            raise FrozenError('Cannot add a child to a frozen DTree')
         if isnode(runner_or_node):
-            runner_or_node = self.__class__(runner_or_node)
+            if hasattr(self, '_lazy'):
+                runner_or_node = self.__class__(runner_or_node, lazy=True)
+            else:
+                runner_or_node = self.__class__(runner_or_node)
             runner_or_node.parent = self
         elif not isinstance(runner_or_node, Runner):
             raise TypeError('Expected Node, Action or DTree object, got %s' % type(runner_or_node))
@@ -358,39 +829,1424 @@ class DTree(Runner):
             self._else_runner = runner_or_node
         else:
             self._condition_to_runner[condition] = runner_or_node
+            self._plan = None
+        return runner_or_node
 
     @property
     def children(self):
+        self._expand()
         if self.else_runner:
             return list(self._condition_to_runner.items()) + [(else_, self._else_runner)]
         return list(self._condition_to_runner.items())
 
     @property
     def else_runner(self):
+        self._expand()
         return self._else_runner
 
-    def run(self, obj):
+    @property
+    def leaves(self):
+        """Leaf runners in depth-first order; a leaf's index is its leaf id."""
+        return [runner for _, _, runner in _iter_leaves(self)]
+
+    def run(self, obj, trace=False):
+        if trace:
+            return _run_audited(self, obj, {}, True)
+        return self._run_tree(obj, {})
+
+    def _run(self, obj, scope):
+        if type(self) is not DTree and _overrides(self, DTree, 'run'):
+            return self.run(obj)
+        return self._run_tree(obj, scope)
+
+    def _run_tree(self, obj, scope):
+        # replaced on lazy, caching, audited and instrumented trees
+        run_method = self._run_method or _resolve_run_method(self)
+        if self._height > _MAX_CALL_HEIGHT and \
+                (run_method is run_by_once_policy or run_method is run_by_recursive_policy):
+            return _run_iteratively(self, obj, scope, run_method)
+        return run_method(self, obj, scope)
+
+    def __getstate__(self):
+        state = super(DTree, self).__getstate__()
+        # registered policies may not be picklable, their names are
+        state.pop('_run_method', None)
+        return state
+
+    def __setstate__(self, state):
+        super(DTree, self).__setstate__(state)
+        self._run_method = POLICIES.get(self._policy) if self._frozen else None
+
+    def run_batch(self, data, actions=False):
+        """Evaluate the tree over columnar data at once.
+
+        ``data`` may be a NumPy structured array, a dict of arrays or a
+        DataFrame-like table. Compare conditions on accessors with a
+        ``column`` are evaluated as NumPy boolean masks, other conditions
+        fall back to row-wise evaluation.
+
+        Returns an array with the leaf id (see ``leaves``) of every row, -1
+        for rows without a match. With ``actions=True``, each leaf's action
+        is run on the rows routed to it and the list of results is returned
+        instead; NoMatchError is raised before running any action if some
+        row has no match.
+        """
+        import numpy
+        evaluator = _BatchEvaluator(numpy, data)
+        leaf_ids = evaluator.route(self, numpy.arange(evaluator.size))
+        if not actions:
+            return leaf_ids
+        if (leaf_ids < 0).any():
+            raise NoMatchError
+        results = [None] * evaluator.size
+        for leaf_id, runner in enumerate(self.leaves):
+            for i in numpy.flatnonzero(leaf_ids == leaf_id):
+                results[i] = runner.run(evaluator.row(i))
+        return results
+
+    def map(self, iterable, workers=None, chunksize=1):
+        """Run the tree on every item of ``iterable`` in a process pool.
+
+        Returns the results in order. The tree is sent to each of the
+        ``workers`` processes once, so it must be picklable: build it with
+        ValueAccessor.key/attr, the ValueAccessor comparisons and
+        module-level functions rather than lambdas.
+        """
+        pool = multiprocessing.Pool(workers, _init_map_worker, (self,))
+        try:
+            results = pool.map(_map_worker_run, iterable, chunksize)
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        return results
+
+    def stream(self, iterable, chunk_size=1, sinks=None, error_handler=None):
+        """Run the tree on the items of ``iterable`` lazily, a chunk at a time.
+
+        A generator of the results in input order: only ``chunk_size`` items
+        are read and held at once, and the next chunk is not read before the
+        results of the previous one are consumed.
+
+        ``sinks`` maps leaf runners to callables or queues. Items routed to
+        such a leaf are not run by it but handed to its sink at the end of
+        each chunk, as a list to a callable or one by one to the ``put`` of
+        a queue, which blocks on a full bounded queue; their result is None.
+        Only the leaves reached through ONCE and RECURSIVE nodes are routed.
+
+        With an ``error_handler``, each item runs as in a Catch: an error,
+        NoMatchError included, is passed to ``error_handler(e, obj)`` and
+        the result is None, instead of ending the stream.
+        """
+        runner = router = self
+        if sinks:
+            self._expand()
+            run_method = POLICIES.get(self.policy)
+            if run_method is not run_by_once_policy and run_method is not run_by_recursive_policy:
+                raise Error('Sinks need the ONCE or RECURSIVE policy, not %s' % self.policy)
+            runner = router = _SinkRouter(self, run_method, sinks)
+        if error_handler is not None:
+            runner = Catch(runner, error_handler=error_handler)
+        iterator = iter(iterable)
+        while True:
+            chunk = list(islice(iterator, chunk_size))
+            if not chunk:
+                return
+            results = [runner._run(obj, {}) for obj in chunk]
+            if sinks:
+                routed, router.routed = router.routed, _OrderedDict()
+                for leaf, items in routed.items():
+                    sink = sinks[leaf]
+                    put = getattr(sink, 'put', None)
+                    if put is None:
+                        sink(items)
+                    else:
+                        for obj in items:
+                            put(obj)
+            for result in results:
+                yield result
+
+    def run_bulk(self, objs, error_handler=None):
+        """Run the tree on all of ``objs``, each leaf with a BatchAction once.
+
+        The objects are all routed first, running the other leaves as run()
+        does. Then each leaf holding BatchActions runs on the objects routed
+        to it, in the order the leaves were first reached: its BatchActions
+        get the list of them at once, and its other runners run on each of
+        them, so that every object still goes through the steps of a Chain
+        in order and a Catch handles the errors of each object on its own.
+        Such leaves cannot backtrack, a NoMatchError they raise is an error.
+
+        Returns the results in input order. The error of an object,
+        NoMatchError included, is passed to ``error_handler(e, obj)`` and
+        its result is None; without a handler, the first error is raised
+        once all the leaves ran.
+        """
+        run_method = POLICIES.get(self.policy)
+        if run_method is not run_by_once_policy and run_method is not run_by_recursive_policy:
+            raise Error('Bulk runs need the ONCE or RECURSIVE policy, not %s' % self.policy)
+        self._expand()
+        objs = list(objs)
+        results = [None] * len(objs)
+        errors = [None] * len(objs)
+        # leaf runner -> [(index, obj, scope)] of the objects routed to it
+        groups = _OrderedDict()
+        batched = {}
+        deferred = []
+
+        def leaf(runner, obj, scope):
+            if _batched(runner, batched):
+                deferred.append((runner, scope))
+                return None
+            return runner._run(obj, scope)
+
+        for i, obj in enumerate(objs):
+            try:
+                results[i] = _run_iteratively(self, obj, {}, run_method, leaf)
+            except Exception as e:
+                errors[i] = e
+            if deferred:
+                runner, scope = deferred.pop()
+                groups.setdefault(runner, []).append((i, obj, scope))
+        for runner, items in groups.items():
+            outcomes = _run_bulk(runner, [(obj, scope) for _, obj, scope in items])
+            for (i, _, _), (result, error) in zip(items, outcomes):
+                results[i] = result
+                errors[i] = error
+        for i, error in enumerate(errors):
+            if error is not None:
+                if error_handler is None:
+                    raise error
+                error_handler(error, objs[i])
+        return results
+
+    def trace(self, obj):
+        """Run the tree on ``obj`` and record which conditions it tested.
+
+        Returns the result and a Trace to pass to reevaluate(). Sub-trees
+        with other policies than ONCE and RECURSIVE run as leaf runners.
+        """
+        trace = Trace()
+        return self._run_traced(obj, trace, trace.record), trace
+
+    def reevaluate(self, obj, previous_trace, changed):
+        """Run the tree again on ``obj`` after some of its fields changed.
+
+        ``changed`` holds the accessors, or their descriptions, whose values
+        may differ since the run recorded in ``previous_trace``. Conditions
+        it recorded are not tested again unless they read a changed
+        accessor, or are opaque like ToCondition; the leaf runner is run
+        again. Returns the result and a new Trace, like trace().
+        """
+        trace = Trace(previous_trace._dependencies)
+        changed = frozenset(changed)
+        outcomes = previous_trace.outcomes
+
+        def validate(condition, obj, scope):
+            outcome = outcomes.get(condition)
+            if outcome is None or trace.depends(condition, changed):
+                return trace.record(condition, obj, scope)
+            trace.outcomes[condition] = outcome
+            return outcome
+
+        return self._run_traced(obj, trace, validate), trace
+
+    def _run_traced(self, obj, trace, validate):
+        run_method = POLICIES.get(self.policy)
+        if run_method is not run_by_once_policy and run_method is not run_by_recursive_policy:
+            raise Error('Tracing needs the ONCE or RECURSIVE policy, not %s' % self.policy)
+        self._expand()
+        return _run_iteratively(self, obj, {}, run_method, trace.run_leaf, validate)
+
+    def lower(self, samples=None, max_nodes=100000):
+        """Lower the tree into a DecisionDiagram over its atomic conditions.
+
+        The tree must use the ONCE policy and its conditions must be pure.
+        And, Or, Not and the nesting of ONCE sub-trees are expanded into
+        one diagram, which tests the atoms in the order the tree does, but
+        each at most once per input: equal atoms are tested once, tests
+        which outcomes on the way decide, like ``age < 18`` once
+        ``age < 12`` held, are left out, and equal sub-graphs are shared.
+        Sub-trees with other policies are kept as leaf runners.
+
+        ``report`` holds the number of atoms and diagram nodes, and the
+        worst-case number of atomic tests per input of the tree and of the
+        diagram; with ``samples``, also the average numbers for them.
+        Raises Error if the diagram grows beyond ``max_nodes``.
+        """
+        if POLICIES.get(self.policy) is not run_by_once_policy:
+            raise Error('Lowering needs the ONCE policy, not %s' % self.policy)
+        self.expand()
+        builder = _DiagramBuilder(max_nodes)
+        root = builder.build(self, 0, {})
+        report = {
+            'atoms': len(builder.atoms),
+            'nodes': _count_nodes(root),
+            'worst_tests_before': _worst_tests(self),
+            'worst_tests_after': _worst_path(root),
+            'average_tests_before': None,
+            'average_tests_after': None,
+        }
+        diagram = DecisionDiagram(root, report)
+        samples = list(samples or ())
+        if samples:
+            report['average_tests_before'] = sum(_count_dtree_tests(self, s) for s in samples) / float(len(samples))
+            report['average_tests_after'] = sum(diagram.count_tests(s) for s in samples) / float(len(samples))
+        return diagram
+
+    def optimize(self, samples=None):
+        """Return a copy of the tree with its pure conditions reordered.
+
+        The operands of pure And/Or conditions are sorted by their cost
+        divided by the chance they decide the result, and runs of pure
+        sibling Compares which provably exclude each other (distinct
+        values, disjoint ranges of one accessor) are sorted by how often
+        they match. The statistics are measured on ``samples``, or, without
+        samples, taken from the metrics recorded since instrument(), which
+        only allows reordering siblings.
+        """
+        self.expand()
+        if samples is not None:
+            profile = _Profile(list(samples))
+            hits = profile.count_hits(self)
+        elif self.metrics is not None:
+            profile = None
+            hits = _recorded_hits(self)
+        else:
+            raise Error('optimize needs samples or the metrics of an instrumented tree')
+        return self.__class__(_optimized_node(self, profile, hits))
+
+    def freeze(self):
+        """Make the tree immutable and compute all its lazy state up front.
+
+        Descriptions, condition keys, policies and dispatch plans are only
+        read afterwards, so a frozen tree can be run from many threads at
+        once. Adding children, setting the parent or the description,
+        drop_nodes() and instrument() raise FrozenError on a frozen tree.
+        Only audit() and cache_decisions(), which freeze the tree
+        themselves, still switch on and off: they replace the way the tree
+        runs in one assignment, and runs already started in other threads
+        finish the way they began. Returns the tree.
+        """
+        dtrees = _precompute(self)
+        # parents first, so that the policy property stops at the parent
+        for dtree in dtrees:
+            dtree._policy = dtree.policy
+            dtree._run_method = _resolve_run_method(dtree)
+        for dtree in reversed(dtrees):
+            dtree._height = max([runner._height + 1 for _, runner in dtree.children if isdtree(runner)] or [0])
+            if dtree._plan is None:
+                dtree._plan = _build_plan(list(dtree._condition_to_runner.items()))
+            dtree._frozen = True
+        return self
+
+    def compile(self):
+        """Freeze this tree and flatten it into a CompiledDTree.
+
+        The returned runner gives the same results as running the tree by
+        its policies, but evaluates in one generated function with policies
+        resolved and comparisons inlined.
+        """
+        return CompiledDTree(self.freeze())
+
+    def cache_decisions(self, enabled=True, maxsize=1024, ttl=None):
+        """Remember the leaf runner chosen for the values of the accessors
+        a run read on its way to it.
+
+        The tree is frozen, and its conditions must be pure Compares, And,
+        Or and Not, so that these values decide the leaf: repeated inputs
+        then only read the accessors along their path, each chosen by the
+        values read before it, and run the leaf without testing conditions.
+        Fields only read on some branches need not exist on the inputs
+        taking others. Runs where a leaf raised NoMatchError are not
+        remembered, and inputs with values that cannot be read or hashed
+        on a remembered path are run as usual and counted as ``skips``.
+        At most ``maxsize`` decisions are kept, the least recently used
+        are evicted first, and decisions expire after ``ttl`` seconds if
+        given. Disabling drops the cache.
+        """
+        self._expand()
+        if not enabled:
+            self._restore_run(_run_cached)
+            _pop_attribute(self, '_decisions')
+            return
+        if hasattr(self, '_metrics') or hasattr(self, '_audit_log'):
+            raise Error('Cannot cache the decisions of an instrumented or audited tree')
         run_method = POLICIES.get(self.policy)
-        if run_method is None:
-            raise UnknownPolicyError(self.policy)
-        return run_method(self, obj)
+        if run_method is not run_by_once_policy and run_method is not run_by_recursive_policy:
+            raise Error('Caching decisions needs the ONCE or RECURSIVE policy, not %s' % self.policy)
+        self.expand()
+        for condition in _iter_conditions(self):
+            if not condition.pure or _dependencies(condition) is None:
+                raise Error('Cannot cache decisions on the impure condition %s' % condition.description)
+        self.freeze()
+        decisions = self._decisions = _DecisionCache(run_method, maxsize, ttl)
+        self._run_tree = functools.partial(_run_cached, self, decisions)
+
+    @property
+    def cache_info(self):
+        """Counts of the decision cache, or None when it is not enabled."""
+        decisions = getattr(self, '_decisions', None)
+        if decisions is None:
+            return None
+        return decisions.info()
+
+    def audit(self, enabled=True, sample_rate=0.0, capacity=1024):
+        """Log the paths taken by runs of the tree.
+
+        Runs called as ``run(obj, trace=True)`` are logged, and others with
+        the chance ``sample_rate``. The tree is frozen, and the paths of
+        the last ``capacity`` logged runs are kept in audit_log as the ids
+        of the children they took, which are only described when the log
+        is read. Runs which are not logged go the usual way, without any
+        overhead when ``sample_rate`` is 0; disabling drops the log.
+        """
+        self._expand()
+        if not enabled:
+            self._restore_run(_run_audited)
+            _pop_attribute(self, '_audit_log')
+            return
+        if hasattr(self, '_metrics') or hasattr(self, '_decisions'):
+            raise Error('Cannot audit an instrumented tree or one caching its decisions')
+        run_method = POLICIES.get(self.policy)
+        if run_method is not run_by_once_policy and run_method is not run_by_recursive_policy:
+            raise Error('Auditing needs the ONCE or RECURSIVE policy, not %s' % self.policy)
+        if not 0 <= sample_rate <= 1:
+            raise ValueError('sample_rate must be between 0 and 1, got %r' % (sample_rate,))
+        self.freeze()
+        self._audit_log = AuditLog(self, run_method, sample_rate, capacity)
+        if sample_rate:
+            self._run_tree = functools.partial(_run_audited, self)
+        else:
+            self._restore_run(_run_audited)
+
+    @property
+    def audit_log(self):
+        """The AuditLog kept since audit(), or None."""
+        return getattr(self, '_audit_log', None)
+
+    def instrument(self, enabled=True):
+        """Record metrics of every node, condition and leaf runner of the tree.
+
+        Enabling resets the metrics. Instrumented nodes test their conditions
+        one by one, without the hash or interval dispatch; disabling removes
+        the instrumentation altogether, so it costs nothing when off.
+        Compiled trees are not instrumented, and frozen trees cannot be
+        instrumented or have the instrumentation removed; the metrics of a
+        tree frozen after it was instrumented may be recorded from many
+        threads.
+        """
+        dtrees = [runner for event, _, _, _, runner, _ in _walk(self) if event is _ENTER]
+        for dtree in dtrees:
+            if dtree._frozen and (enabled or hasattr(dtree, '_metrics')):
+                raise FrozenError('Cannot instrument a frozen DTree')
+            if enabled and (hasattr(dtree, '_decisions') or hasattr(dtree, '_audit_log')):
+                raise Error('Cannot instrument an audited tree or one caching its decisions')
+        for dtree in dtrees:
+            if enabled:
+                dtree._metrics = _NodeMetrics()
+                dtree._run_tree = functools.partial(_run_instrumented, dtree)
+            else:
+                _pop_attribute(dtree, '_metrics')
+                dtree._restore_run(_run_instrumented)
+
+    @property
+    def metrics(self):
+        """Snapshot of the metrics recorded since instrument(), or None.
+
+        A dict with the counts and latencies of this node, and under
+        ``children`` those of each condition and of each leaf runner or the
+        snapshot of each sub-tree.
+        """
+        rv = _node_snapshot(self)
+        # the snapshots of the sub-trees are filled in after being added
+        stack = [(self, rv)] if rv is not None else []
+        while stack:
+            dtree, snapshot = stack.pop()
+            for condition, runner in dtree.children:
+                child = dtree._metrics.children.get(condition) or _ChildMetrics()
+                if isdtree(runner):
+                    runner_snapshot = _node_snapshot(runner)
+                    if runner_snapshot is not None:
+                        stack.append((runner, runner_snapshot))
+                else:
+                    runner_snapshot = child.runner.snapshot()
+                    runner_snapshot['description'] = runner.description
+                condition_snapshot = child.condition.snapshot()
+                condition_snapshot['description'] = condition.description
+                snapshot['children'].append({'condition': condition_snapshot, 'runner': runner_snapshot})
+        return rv
+
+    def render_metrics(self):
+        """Like str(), with the matches/evaluations and mean latency of each line."""
+
+        def annotate(dtree, condition):
+            metrics = getattr(dtree, '_metrics', None)
+            if metrics is None:
+                return ''
+            if condition is None:
+                return metrics.node.format()
+            return (metrics.children.get(condition) or _ChildMetrics()).condition.format()
+
+        parts = []
+        self._write_text(parts.append, annotate)
+        return ''.join(parts)
 
     def __str__(self):
-        rv = ''
+        parts = []
+        self._write_text(parts.append, None)
+        return ''.join(parts)
+
+    def render(self, file=None):
+        """Write what str() returns to the file-like ``file``, line by line.
+
+        Returns the text instead without a file. Like to_dot and to_json,
+        it walks the tree in a loop, in time linear in its size, so that
+        deep and very large trees can be dumped too.
+        """
+        return _write_to(file, lambda write: self._write_text(write, None))
+
+    def to_dot(self, file=None):
+        """Write the tree as a Graphviz DOT digraph to ``file``, or return it.
+
+        Sub-trees are ellipses labelled with their policy, leaf runners are
+        boxes labelled with their description, and the edges are labelled
+        with the conditions.
+        """
+        return _write_to(file, self._write_dot)
+
+    def to_json(self, file=None):
+        """Write the tree as JSON to ``file``, or return it.
+
+        Nodes are written like the rule files of load_rules, as objects
+        with their ``policy`` and their ``children`` as [condition, runner]
+        pairs, but with the descriptions of the conditions and leaf runners.
+        """
+        return _write_to(file, self._write_json)
+
+    def _write_text(self, write, annotate):
         indent = '|      '
-        dtree_mark = '+++'
-        action_mark = '---'
-        if self.depth == 0:
-            policy_msg = self.policy != DEFAULT_POLICY and '(%s)' % self.policy or ''
-            rv += dtree_mark + 'root%s:\n' % policy_msg
-        for condition, runner in self.children:
+        depth = self.depth
+        for event, level, parent, condition, runner, policy in _walk(self):
+            if event is _LEAVE or condition is None and depth:
+                continue
+            note = annotate and annotate(parent, condition) or ''
+            if event is _LEAF:
+                write(indent * (depth + level) + '---' + condition.description + ' --> ' + runner.description + note + '\n')
+                continue
+            policy_msg = policy != DEFAULT_POLICY and '(%s)' % policy or ''
+            if condition is None:
+                write('+++root' + policy_msg + ':' + note + '\n')
+            else:
+                write(indent * (depth + level) + '+++' + condition.description + policy_msg + ':' + note + '\n')
+
+    def _write_dot(self, write):
+        write('digraph dtree {\n')
+        # ids of the sub-trees being walked, by level
+        ids = []
+        count = 0
+        for event, level, parent, condition, runner, policy in _walk(self):
+            if event is _LEAVE:
+                ids.pop()
+                continue
+            node_id = 'n%d' % count
+            count += 1
+            if event is _LEAF:
+                write('  %s [shape=box, label=%s];\n' % (node_id, _dot_string(runner.description)))
+            else:
+                label = policy if condition is not None else 'root (%s)' % policy
+                write('  %s [label=%s];\n' % (node_id, _dot_string(label)))
+            if condition is not None:
+                write('  %s -> %s [label=%s];\n' % (ids[-1], node_id, _dot_string(condition.description)))
+            if event is _ENTER:
+                ids.append(node_id)
+        write('}\n')
+
+    def _write_json(self, write):
+        # whether the children list being written is still empty, by level
+        empty = []
+        for event, level, parent, condition, runner, policy in _walk(self):
+            if event is _LEAVE:
+                empty.pop()
+                write(']}]' if empty else ']}')
+                continue
+            if condition is not None:
+                write('[' if empty[-1] else ', [')
+                empty[-1] = False
+                write(json.dumps(condition.description) + ', ')
+            if event is _LEAF:
+                write(json.dumps(runner.description) + ']')
+            else:
+                write('{"policy": %s, "children": [' % json.dumps(policy))
+                empty.append(True)
+        write('\n')
+
+
+_expand_lock = threading.Lock()
+
+
+def _pop_attribute(obj, name):
+    # obj.__dict__.pop(name, None), without allocating the __dict__ of a
+    # slotted object
+    if hasattr(obj, name):
+        delattr(obj, name)
+
+
+# trees up to that many levels deep are run by their run methods calling
+# each other, which is faster than _run_iteratively but takes a few stack
+# frames per level
+_MAX_CALL_HEIGHT = 30
+
+_UNKNOWN_HEIGHT = sys.maxsize
+
+
+# the list a DTree being built by _build_children appends itself to
+_building = threading.local()
+
+
+def _build_children(dtree):
+    """Add the children of a tree built from a Node, and of its sub-trees.
+
+    Sub-trees built from the Nodes among the children only append
+    themselves to a list, and their children are added by this loop, in
+    the same depth-first order as nested DTree() calls would, but without
+    a bound on the depth of the Nodes.
+    """
+    built = [dtree]
+    stack = [(dtree, iter(dtree._node.args))]
+    while stack:
+        parent, args = stack[-1]
+        for condition, runner_or_node in args:
+            count = len(built)
+            _building.trees = built
+            try:
+                parent._add_child(condition, runner_or_node)
+            finally:
+                _building.trees = None
+            if len(built) > count:
+                stack.append((built[-1], iter(built[-1]._node.args)))
+                break
+        else:
+            stack.pop()
+    # children come after their parent in built
+    for dtree in reversed(built):
+        dtree._height = max([runner._height + 1 for _, runner in dtree.children if isdtree(runner)] or [0])
+
+
+def _resolve_run_method(dtree):
+    run_method = POLICIES.get(dtree.policy)
+    if run_method is None:
+        raise UnknownPolicyError(dtree.policy)
+    return run_method
+
+
+def _run_lazily(self, obj, scope):
+    # replaces DTree._run_tree on lazy trees until their children are built
+    self._expand()
+    return self._run_tree(obj, scope)
+
+
+_ENTER, _LEAF, _LEAVE = 'enter', 'leaf', 'leave'
+
+
+def _walk(dtree):
+    """Walk a tree depth-first in a loop, for rendering and exporting it.
+
+    Yields (event, level, parent, condition, runner, policy) tuples: an
+    _ENTER before the children of a node, the tree itself first, with no
+    condition, a _LEAF for each leaf runner and a _LEAVE after the
+    children of a node. ``level`` counts from 0 for the tree, ``parent`` is
+    the node holding the child, or the tree itself, and ``policy`` is the
+    one of the node entered or left, or holding the leaf.
+    """
+    policy = dtree.policy
+    yield _ENTER, 0, dtree, None, dtree, policy
+    stack = [(iter(dtree.children), dtree, policy)]
+    while stack:
+        children, node, policy = stack[-1]
+        for condition, runner in children:
             if isdtree(runner):
-                policy_msg = runner.policy != DEFAULT_POLICY and '(%s)' % runner.policy or ''
-                rv += indent * (self.depth + 1) + dtree_mark + condition.description + '%s:\n' % policy_msg
-                rv += str(runner)
-            elif isrunner(runner):
-                rv += indent * (self.depth + 1) + action_mark + condition.description + ' --> ' + runner.description + '\n'
-        return rv
+                # like the policy property, without walking up the parents
+                sub_policy = runner._policy or (policy if runner.parent is node else runner.policy)
+                yield _ENTER, len(stack), node, condition, runner, sub_policy
+                stack.append((iter(runner.children), runner, sub_policy))
+                break
+            yield _LEAF, len(stack), node, condition, runner, policy
+        else:
+            stack.pop()
+            yield _LEAVE, len(stack), node, None, node, policy
+
+
+def _write_to(file, writer):
+    # run writer with the write method of file, or return what it wrote
+    if file is not None:
+        writer(file.write)
+        return None
+    parts = []
+    writer(parts.append)
+    return ''.join(parts)
+
+
+def _dot_string(text):
+    return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _run_iteratively(dtree, obj, scope, run_method, leaf=None, validate=None, path=None):
+    """Run a tree of ONCE and RECURSIVE nodes like their run methods do.
+
+    Sub-trees are walked in a loop instead of recursive calls, so the depth
+    of a tree is not bound by the recursion limit. Only RECURSIVE nodes can
+    resume after a sub-tree without a match, so only they are kept on a
+    stack, and a dead end pops back to the innermost of them instead of
+    raising NoMatchError through every level. NoMatchError raised by
+    conditions and leaf runners is still handled like the policies do, and
+    the caller gets a NoMatchError when no leaf matched. ``leaf``, if
+    given, is called with the leaf runner, obj and scope instead of the
+    leaf runner, and ``validate`` likewise with each condition, which are
+    then tested one by one, without the dispatch indexes. ``path``, if
+    given, is a list kept holding the (node, condition) pairs along the
+    path being run, with else_ for else runners, and conditions are tested
+    one by one too.
+    """
+    # the RECURSIVE nodes being run:
+    # [siblings left to test, else runner, node, length of path, run method]
+    stack = []
+    while True:
+        runner = None
+        try:
+            if dtree is None:
+                frame = stack[-1]
+                owner, run_method = frame[2], frame[4]
+                if path is not None:
+                    del path[frame[3]:]
+                for condition, candidate in frame[0]:
+                    if condition._validate(obj, scope) if validate is None else validate(condition, obj, scope):
+                        runner = candidate
+                        break
+                else:
+                    runner, frame[1] = frame[1], None
+                    condition = else_
+                    if runner is None:
+                        stack.pop()
+            elif run_method is run_by_once_policy:
+                owner = dtree
+                plan = dtree._plan
+                if validate is not None or path is not None:
+                    plan = dtree._condition_to_runner.items()
+                elif plan is None:
+                    plan = dtree._plan = _build_plan(list(dtree._condition_to_runner.items()))
+                for condition, candidate in plan:
+                    if candidate is None:
+                        runner = condition.match(obj, scope)
+                        if runner is not None:
+                            break
+                    elif condition._validate(obj, scope) if validate is None else validate(condition, obj, scope):
+                        runner = candidate
+                        break
+                else:
+                    runner = dtree._else_runner
+                    condition = else_
+            else:
+                stack.append([
+                    iter(dtree._condition_to_runner.items()), dtree._else_runner,
+                    dtree, None if path is None else len(path), run_method,
+                ])
+                dtree = None
+                continue
+        except NoMatchError:
+            runner = None
+        dtree = None
+        if runner is not None:
+            if path is not None:
+                path.append((owner, condition))
+            run = getattr(runner._run, '__func__', None)
+            if run is _DTREE_RUN and not _overrides(runner, DTree, 'run'):
+                run = getattr(runner._run_tree, '__func__', None)
+                if run is None:
+                    # a lazy tree not run yet
+                    runner._expand()
+                    run = getattr(runner._run_tree, '__func__', None)
+            if run is _DTREE_RUN_TREE:
+                # a sub-tree without a policy of its own keeps the run method
+                # of its parent, without walking up all the parents
+                if runner._run_method is not None:
+                    run_method = runner._run_method
+                elif runner._policy or runner.parent is not owner:
+                    run_method = POLICIES.get(runner.policy)
+                if run_method is run_by_once_policy or run_method is run_by_recursive_policy:
+                    dtree = runner
+                    continue
+            try:
+                if leaf is None:
+                    return runner._run(obj, scope)
+                return leaf(runner, obj, scope)
+            except NoMatchError:
+                # values read before the leaf ran may be stale now
+                scope.clear()
+        if not stack:
+            raise NoMatchError
+
+
+class Trace(object):
+    """The conditions a run tested and the leaf runner it ended with.
+
+    ``outcomes`` maps the tested conditions to their truth, in testing
+    order, and ``leaf`` is the last leaf runner run.
+    """
+
+    __slots__ = ('outcomes', 'leaf', '_dependencies')
+
+    def __init__(self, dependencies=None):
+        self.outcomes = _OrderedDict()
+        self.leaf = None
+        # accessors read by each condition, shared along a chain of traces
+        self._dependencies = {} if dependencies is None else dependencies
+
+    def record(self, condition, obj, scope):
+        outcome = self.outcomes[condition] = bool(condition._validate(obj, scope))
+        return outcome
+
+    def run_leaf(self, runner, obj, scope):
+        self.leaf = runner
+        return runner._run(obj, scope)
+
+    def depends(self, condition, changed):
+        try:
+            accessors = self._dependencies[condition]
+        except KeyError:
+            accessors = self._dependencies[condition] = _dependencies(condition)
+        if accessors is None:
+            return True
+        for accessor in accessors:
+            if accessor in changed or accessor._description in changed:
+                return True
+        return False
+
+
+class AuditLog(object):
+    """The paths taken by the last runs logged by DTree.audit().
+
+    Iterating gives a dict for each run, oldest first: the descriptions of
+    the ``conditions`` along its path, the description of the ``runner``
+    it ended with, and the type of the ``error`` it raised, or None. Runs
+    without a match have an empty path and NoMatchError.
+    """
+
+    __slots__ = ('sample_rate', 'capacity', 'run_method', '_ids', '_children', '_records', '_count', '_lock')
+
+    def __init__(self, dtree, run_method, sample_rate, capacity):
+        self.sample_rate = sample_rate
+        self.capacity = capacity
+        self.run_method = run_method
+        # (id of node, id of condition) -> id of the child, and
+        # id of the child -> (condition, runner, node)
+        self._ids = {}
+        self._children = []
+        nodes = [dtree]
+        while nodes:
+            node = nodes.pop()
+            for condition, runner in node.children:
+                self._ids[id(node), id(condition)] = len(self._children)
+                self._children.append((condition, runner, node))
+                if isdtree(runner):
+                    nodes.append(runner)
+        self._records = [None] * capacity
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # the ids of the children are keyed by the ids of their nodes and
+        # conditions, which differ once loaded, and the lock cannot be pickled
+        with self._lock:
+            return self.sample_rate, self.capacity, self.run_method, self._children, self._records, self._count
+
+    def __setstate__(self, state):
+        self.sample_rate, self.capacity, self.run_method, self._children, self._records, self._count = state
+        self._ids = dict(((id(node), id(condition)), i) for i, (condition, _, node) in enumerate(self._children))
+        self._lock = threading.Lock()
+
+    def record(self, path, error):
+        ids = self._ids
+        record = (tuple([ids[id(node), id(condition)] for node, condition in path]), error)
+        with self._lock:
+            self._records[self._count % self.capacity] = record
+            self._count += 1
+
+    def records(self):
+        """The logged runs, oldest first, as (ids of the children taken, error type)."""
+        with self._lock:
+            count = self._count
+            records = list(self._records)
+        if count <= self.capacity:
+            return records[:count]
+        start = count % self.capacity
+        return records[start:] + records[:start]
+
+    def clear(self):
+        with self._lock:
+            self._records = [None] * self.capacity
+            self._count = 0
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def __iter__(self):
+        children = self._children
+        for ids, error in self.records():
+            yield {
+                'conditions': [children[i][0].description for i in ids],
+                'runner': children[ids[-1]][1].description if ids else None,
+                'error': error,
+            }
+
+
+def _run_audited(self, obj, scope, trace=False):
+    # replaces DTree._run_tree on trees logging a sample of their runs
+    log = getattr(self, '_audit_log', None)
+    if log is None:
+        if trace:
+            raise Error('Tracing runs needs audit() first')
+        # audit(False) was called in another thread since the run started
+        return DTree._run_tree(self, obj, scope)
+    if not trace and random.random() >= log.sample_rate:
+        return _run_iteratively(self, obj, scope, log.run_method)
+    path = []
+    try:
+        result = _run_iteratively(self, obj, scope, log.run_method, path=path)
+    except NoMatchError:
+        log.record((), NoMatchError)
+        raise
+    except Exception as e:
+        log.record(path, type(e))
+        raise
+    log.record(path, None)
+    return result
+
+
+def _dependencies(condition):
+    # the accessors the condition reads, or None when they are unknown
+    if isinstance(condition, Compare) and not _overrides(condition, Compare, 'validate'):
+        if isinstance(condition.operand, ValueAccessor):
+            return frozenset([condition.accessor, condition.operand])
+        return frozenset([condition.accessor])
+    if isinstance(condition, And) and not _overrides(condition, And, 'validate') or \
+            isinstance(condition, Or) and not _overrides(condition, Or, 'validate'):
+        accessors = frozenset()
+        for operand in condition._conditions:
+            dependencies = _dependencies(operand)
+            if dependencies is None:
+                return None
+            accessors |= dependencies
+        return accessors
+    if isinstance(condition, Not) and not _overrides(condition, Not, 'validate'):
+        return _dependencies(condition._condition)
+    if isinstance(condition, Else):
+        return frozenset()
+    return None
+
+
+class _SinkRouter(Runner):
+    # runs a tree, but collects the objects routed to the leaves with a sink
+    # instead of running them, for DTree.stream
+
+    __slots__ = ('dtree', 'run_method', 'sinks', 'routed', '_description')
+
+    def __init__(self, dtree, run_method, sinks):
+        self.dtree = dtree
+        self.run_method = run_method
+        self.sinks = sinks
+        self.routed = _OrderedDict()
+
+    def _run(self, obj, scope):
+        return _run_iteratively(self.dtree, obj, scope, self.run_method, self._leaf)
+
+    def _leaf(self, runner, obj, scope):
+        if runner in self.sinks:
+            self.routed.setdefault(runner, []).append(obj)
+            return None
+        return runner._run(obj, scope)
+
+
+def _plain(runner, cls):
+    # whether the runner is a cls which runs as cls does
+    return isinstance(runner, cls) and not _overrides(runner, cls, 'run') and not _overrides(runner, cls, '_run')
+
+
+def _batched(runner, batched):
+    # whether run_bulk runs the leaf runner a group of objects at a time,
+    # memoized in ``batched``
+    rv = batched.get(runner)
+    if rv is None:
+        if isinstance(runner, BatchAction):
+            rv = True
+        elif _plain(runner, Chain):
+            rv = any(_batched(step, batched) for step in runner._runners)
+        elif _plain(runner, Catch):
+            rv = _batched(runner.pre_runner, batched) or (
+                runner.next_runner is not None and _batched(runner.next_runner, batched))
+        else:
+            rv = False
+        batched[runner] = rv
+    return rv
+
+
+def _run_bulk(runner, items):
+    # run the runner on the (obj, scope) items like its _run does on each,
+    # but BatchActions once for all; returns their (result, error) pairs
+    if isinstance(runner, BatchAction):
+        try:
+            return [(result, None) for result in runner.run_bulk([obj for obj, _ in items])]
+        except Exception as e:
+            return [(None, e)] * len(items)
+    if _plain(runner, Chain):
+        outcomes = [(None, None)] * len(items)
+        running = list(range(len(items)))
+        for n, step in enumerate(runner._runners):
+            if n:
+                for i in running:
+                    items[i][1].clear()
+            step_outcomes = _run_bulk(step, [items[i] for i in running])
+            for i, outcome in zip(running, step_outcomes):
+                outcomes[i] = outcome
+            running = [i for i, outcome in zip(running, step_outcomes) if outcome[1] is None]
+        return outcomes
+    if _plain(runner, Catch):
+        outcomes = _run_bulk(runner.pre_runner, items)
+        failed = [i for i, outcome in enumerate(outcomes) if outcome[1] is not None]
+        if not failed:
+            return outcomes
+        if runner.next_runner:
+            for i in failed:
+                items[i][1].clear()
+            recovered = _run_bulk(runner.next_runner, [items[i] for i in failed])
+        else:
+            recovered = [(None, None)] * len(failed)
+        for i, (result, error) in zip(failed, recovered):
+            if error is None and runner.error_handler:
+                try:
+                    runner.error_handler(outcomes[i][1], items[i][0])
+                except Exception as e:
+                    result, error = None, e
+            elif error is None:
+                result, error = None, outcomes[i][1]
+            outcomes[i] = (result, error)
+        return outcomes
+    outcomes = []
+    for obj, scope in items:
+        try:
+            outcomes.append((runner._run(obj, scope), None))
+        except Exception as e:
+            outcomes.append((None, e))
+    return outcomes
+
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+# upper bounds in seconds of the latency histogram buckets, the last bucket
+# counts everything slower
+LATENCY_BUCKETS = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+
+
+class _Metrics(object):
+
+    def __init__(self):
+        self.evaluations = 0
+        self.matches = 0
+        self.total_time = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.lock = threading.Lock()
+
+    def record(self, elapsed, matched):
+        bucket = bisect_left(LATENCY_BUCKETS, elapsed)
+        with self.lock:
+            self.evaluations += 1
+            if matched:
+                self.matches += 1
+            self.total_time += elapsed
+            self.histogram[bucket] += 1
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'evaluations': self.evaluations,
+                'matches': self.matches,
+                'total_time': self.total_time,
+                'histogram': list(self.histogram),
+            }
+
+    def format(self):
+        mean = self.total_time / self.evaluations if self.evaluations else 0.0
+        return '  [%d/%d, %.1fus]' % (self.matches, self.evaluations, mean * 1e6)
+
+
+class _ChildMetrics(object):
+
+    def __init__(self):
+        self.condition = _Metrics()
+        self.runner = _Metrics()
+
+
+class _NodeMetrics(object):
+
+    def __init__(self):
+        self.node = _Metrics()
+        # keyed by condition, the conditions of a DTree are distinct
+        self.children = {}
+
+    def child(self, condition):
+        child = self.children.get(condition)
+        if child is None:
+            # setdefault, so that threads recording at once share one
+            child = self.children.setdefault(condition, _ChildMetrics())
+        return child
+
+
+def _validate_instrumented(metrics, condition, obj, scope):
+    start = _clock()
+    result = False
+    try:
+        result = condition._validate(obj, scope)
+        return result
+    finally:
+        metrics.condition.record(_clock() - start, result)
+
+
+def _node_snapshot(dtree):
+    # the metrics snapshot of dtree, without those of its children yet
+    metrics = getattr(dtree, '_metrics', None)
+    if metrics is None:
+        return None
+    rv = metrics.node.snapshot()
+    rv['description'] = dtree.description
+    rv['children'] = []
+    return rv
+
+
+def _run_child_instrumented(metrics, runner, obj, scope):
+    if isdtree(runner):
+        return runner._run(obj, scope)
+    start = _clock()
+    matched = False
+    try:
+        result = runner._run(obj, scope)
+        matched = True
+        return result
+    finally:
+        metrics.runner.record(_clock() - start, matched)
+
+
+def _run_by_once_policy_instrumented(self, obj, scope):
+    metrics = self._metrics
+    for condition, runner in self._condition_to_runner.items():
+        child = metrics.child(condition)
+        if _validate_instrumented(child, condition, obj, scope):
+            return _run_child_instrumented(child, runner, obj, scope)
+    if self.else_runner:
+        child = metrics.child(else_)
+        child.condition.record(0.0, True)
+        return _run_child_instrumented(child, self.else_runner, obj, scope)
+    else:
+        raise NoMatchError
+
+
+def _run_by_recursive_policy_instrumented(self, obj, scope):
+    metrics = self._metrics
+    for condition, runner in self._condition_to_runner.items():
+        child = metrics.child(condition)
+        try:
+            if not _validate_instrumented(child, condition, obj, scope):
+                continue
+        except NoMatchError:
+            continue
+        try:
+            return _run_child_instrumented(child, runner, obj, scope)
+        except NoMatchError:
+            scope.clear()
+    if self.else_runner:
+        child = metrics.child(else_)
+        child.condition.record(0.0, True)
+        return _run_child_instrumented(child, self.else_runner, obj, scope)
+    else:
+        raise NoMatchError
+
+
+_INSTRUMENTED_POLICIES = {
+    run_by_once_policy: _run_by_once_policy_instrumented,
+    run_by_recursive_policy: _run_by_recursive_policy_instrumented,
+}
+
+
+class _DecisionCache(object):
+    # leaf runners chosen for the values read along the path to them, None
+    # for no match, in least recently used first order
+    #
+    # An entry is keyed by the typed values of the accessors in the order
+    # the run read them. As the conditions are pure, the values read so far
+    # decide which accessor is read next, which ``branches`` keeps for each
+    # prefix of the stored keys, with the number of keys below it.
+
+    def __init__(self, run_method, maxsize, ttl):
+        self.run_method = run_method
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.branches = {}
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.skips = self.evictions = self.expirations = 0
+
+    def __getstate__(self):
+        # a pickled cache starts empty: the keys hold the types of values,
+        # which Python 2 cannot always pickle, and the lock cannot be
+        return self.run_method, self.maxsize, self.ttl
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def get(self, obj, scope):
+        # (key, leaf) of the decision for obj, or _MISSING; reads the
+        # accessors along the path of obj, and raises if they fail
+        key = ()
+        while True:
+            with self.lock:
+                entry = self.entries.pop(key, None)
+                if entry is None:
+                    branch = self.branches.get(key)
+                    if branch is None:
+                        self.misses += 1
+                        return _MISSING
+                elif entry[1] is not None and entry[1] <= _clock():
+                    self._forget(key)
+                    self.expirations += 1
+                    self.misses += 1
+                    return _MISSING
+                else:
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return key, entry[0]
+            key += (_typed(branch[0].of(obj, scope)),)
+
+    def put(self, key, accessors, leaf):
+        hash(key)
+        expires = None if self.ttl is None else _clock() + self.ttl
+        with self.lock:
+            if self.entries.pop(key, None) is None:
+                for i, accessor in enumerate(accessors):
+                    branch = self.branches.get(key[:i])
+                    if branch is None:
+                        self.branches[key[:i]] = [accessor, 1]
+                    else:
+                        branch[1] += 1
+            self.entries[key] = (leaf, expires)
+            while len(self.entries) > self.maxsize:
+                self._forget(self.entries.popitem(last=False)[0])
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self._forget(key)
+
+    def skip(self):
+        with self.lock:
+            self.skips += 1
+
+    def _forget(self, key):
+        # drop the branches only leading to the removed key
+        for i in range(len(key)):
+            branch = self.branches[key[:i]]
+            branch[1] -= 1
+            if not branch[1]:
+                del self.branches[key[:i]]
+
+    def info(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'skips': self.skips,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+            }
+
+
+class _ReadingScope(dict):
+    # an evaluation scope noting the accessors read through it, in order;
+    # it only takes the values of accessors from ``scope``, so that the
+    # conditions are tested again and read their accessors through it
+
+    def __init__(self, scope):
+        dict.__init__(self, [(key, value) for key, value in scope.items() if isinstance(key, ValueAccessor)])
+        self.reads = []
+        self._seen = set()
+
+    def get(self, key, default=None):
+        if isinstance(key, ValueAccessor) and key not in self._seen:
+            self._seen.add(key)
+            self.reads.append(key)
+        return dict.get(self, key, default)
+
+
+def _typed(value):
+    return type(value), value
+
+
+def _run_cached(self, decisions, obj, scope):
+    # replaces DTree._run_tree on trees caching their decisions
+    try:
+        found = decisions.get(obj, scope)
+    except Exception:
+        # a value which cannot be read or hashed
+        decisions.skip()
+        return _run_iteratively(self, obj, scope, decisions.run_method)
+    if found is not _MISSING:
+        key, leaf = found
+        if leaf is None:
+            raise NoMatchError
+        try:
+            return leaf._run(obj, scope)
+        except NoMatchError:
+            # a sub-tree run as a leaf may have no match for other inputs:
+            # forget it and backtrack
+            decisions.discard(key)
+            scope.clear()
+            return _run_iteratively(self, obj, scope, decisions.run_method)
+
+    scope = _ReadingScope(scope)
+    leaves = []
+    # the accessors read before the first leaf, and the key of their values
+    decided = []
+
+    def run_leaf(runner, obj, scope):
+        if not leaves:
+            decided.append(_decision_key(scope))
+        leaves.append(runner)
+        return runner._run(obj, scope)
+
+    try:
+        result = _run_iteratively(self, obj, scope, decisions.run_method, run_leaf)
+    except NoMatchError:
+        if not leaves:
+            _put_decision(decisions, _decision_key(scope), None)
+        raise
+    if len(leaves) == 1:
+        _put_decision(decisions, decided[0], leaves[0])
+    return result
+
+
+def _decision_key(scope):
+    # (values, accessors) read so far through a _ReadingScope
+    return tuple([_typed(scope[accessor]) for accessor in scope.reads]), list(scope.reads)
+
+
+def _put_decision(decisions, decision_key, leaf):
+    key, accessors = decision_key
+    try:
+        decisions.put(key, accessors, leaf)
+    except TypeError:
+        # unhashable values are not remembered
+        pass
+
+
+def _run_instrumented(self, obj, scope):
+    # replaces DTree._run_tree on instrumented trees
+    run_method = POLICIES.get(self.policy)
+    if run_method is None:
+        raise UnknownPolicyError(self.policy)
+    run_method = _INSTRUMENTED_POLICIES.get(run_method, run_method)
+    start = _clock()
+    matched = False
+    try:
+        result = run_method(self, obj, scope)
+        matched = True
+        return result
+    finally:
+        self._metrics.node.record(_clock() - start, matched)
+
+
+_map_worker_dtree = None
+
+
+def _init_map_worker(dtree):
+    global _map_worker_dtree
+    _map_worker_dtree = dtree
+
+
+def _map_worker_run(obj):
+    return _map_worker_dtree.run(obj)
+
+
+def _precompute(item):
+    """Fill the lazily computed attributes of a condition or runner.
+
+    Walks the conditions and runners within it in a loop, and returns the
+    trees among them which are not frozen yet, each before its sub-trees.
+    """
+    items = []
+    dtrees = []
+    stack = [item]
+    while stack:
+        item = stack.pop()
+        items.append(item)
+        if isinstance(item, (And, Or)):
+            stack.extend(item._conditions)
+        elif isinstance(item, Not):
+            stack.append(item._condition)
+        elif isinstance(item, Chain):
+            stack.extend(item._runners)
+        elif isinstance(item, Catch):
+            stack.append(item.pre_runner)
+            if item.next_runner is not None:
+                stack.append(item.next_runner)
+        elif isdtree(item) and not item._frozen:
+            dtrees.append(item)
+            for condition, runner in item.children:
+                stack.append(condition)
+                stack.append(runner)
+    # the parts first, whose keys and descriptions compound ones are made of
+    for item in reversed(items):
+        item.description
+        if iscondition(item):
+            item.key
+    return dtrees
+
+
+def _iter_leaves(dtree):
+    stack = [(dtree, enumerate(dtree.children))]
+    while stack:
+        dtree, children = stack[-1]
+        for index, (condition, runner) in children:
+            if isdtree(runner):
+                stack.append((runner, enumerate(runner.children)))
+                break
+            yield dtree, index, runner
+        else:
+            stack.pop()
+
+
+def _iter_conditions(dtree):
+    # conditions of the tree and of the sub-trees _run_iteratively walks
+    stack = [dtree]
+    while stack:
+        dtree = stack.pop()
+        for condition, runner in dtree.children:
+            yield condition
+            if _walked(runner) and POLICIES.get(runner.policy) in (run_by_once_policy, run_by_recursive_policy):
+                stack.append(runner)
 
 
 def isnode(o):
@@ -420,122 +2276,1627 @@ class CachingGetter:
     def __init__(self, getter):
         self._getter = getter
         self._cache = WeakKeyDictionary()
+        self._lock = threading.Lock()
 
     def __call__(self, obj):
         ret = self._cache.get(obj, self._SENTINEL)
         if ret is self._SENTINEL:
             ret = self._getter(obj)
-            self._cache[obj] = ret
+            # readers go without the lock, writers serialize so that every
+            # thread gets the value which was cached first
+            with self._lock:
+                ret = self._cache.setdefault(obj, ret)
         return ret
 
+    def __getstate__(self):
+        return {'_getter': self._getter}
+
+    def __setstate__(self, state):
+        self.__init__(state['_getter'])
+
+
+# comparators are module-level functions so that Compares can be pickled
+def _in(value, operand):
+    return value in operand
+
+
+def _bool_true(value, operand):
+    return bool(value)
+
+
+def _bool_false(value, operand):
+    return not value
+
+
+def _test(value, operand):
+    return operand(value)
+
+
+_COMPARATORS = {
+    '=': operator.eq,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': _in,
+    'is': operator.is_,
+    'is not': operator.is_not,
+    'bool-true': _bool_true,
+    'bool-false': _bool_false,
+    'test': _test,
+}
+
+_DESCRIPTION_FORMATS = {
+    'bool-true': '%s is bool-true',
+    'bool-false': '%s is bool-false',
+}
+
+
+class Compare(Condition):
+    """Condition comparing the value of a ValueAccessor with an operand.
+
+    Unlike a ToCondition wrapping a lambda, a Compare keeps its accessor,
+    operator and operand around, so that it can be inspected by tools like
+    DTree.compile.
+    """
+
+    __slots__ = ('accessor', 'op', 'operand', 'pure', '_comparator', '_description', '_key')
+
+    def __init__(self, accessor, op, operand=None, description=None):
+        if op not in _COMPARATORS:
+            raise ValueError("Unknown operator %r" % op)
+        self.accessor = accessor
+        self.op = op
+        self.operand = operand
+        self._comparator = _COMPARATORS[op]
+        self._description = description
+        # comparisons of pure accessors are pure, except for arbitrary tests
+        self.pure = op != 'test' and accessor.pure and (not isinstance(operand, ValueAccessor) or operand.pure)
+
+    def validate(self, obj):
+        return self._validate(obj, None)
+
+    def _validate(self, obj, scope):
+        operand = self.operand
+        if isinstance(operand, ValueAccessor):
+            operand = operand.of(obj, scope)
+        return self._comparator(self.accessor.of(obj, scope), operand)
+
+    def get_key(self):
+        if self.op == 'test':
+            # arbitrary tests are never pure
+            return None
+        operand = self.operand
+        if not isinstance(operand, ValueAccessor):
+            operand = _constant_key(operand)
+            if operand is None:
+                return None
+        return _StructuralKey('compare', self.accessor, self.op, operand)
+
+    def get_default_description(self):
+        operand = self.operand
+        if isinstance(operand, ValueAccessor):
+            operand = operand._description
+        elif self.op == 'test':
+            return '%s satisfies %s' % (self.accessor._description, getattr(operand, '__name__', operand))
+        fmt = _DESCRIPTION_FORMATS.get(self.op)
+        if fmt is not None:
+            return fmt % self.accessor._description
+        return '%s %s %s' % (self.accessor._description, self.op, operand)
+
+
+class _KeyPath(object):
+    # getter of obj[key1][key2]..., picklable unlike a lambda
+
+    __slots__ = ('path',)
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, obj):
+        for key in self.path:
+            obj = obj[key]
+        return obj
+
+    def __reduce__(self):
+        return _KeyPath, (self.path,)
+
+
+class _AttrPath(object):
+    # getter of obj.name1.name2..., for Python 2 where operator.attrgetter
+    # cannot be pickled
+
+    __slots__ = ('path',)
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, obj):
+        for name in self.path:
+            obj = getattr(obj, name)
+        return obj
+
+    def __reduce__(self):
+        return _AttrPath, (self.path,)
+
+
+if sys.version_info >= (3,):
+    _itemgetter = operator.itemgetter
+    _attrgetter = operator.attrgetter
+else:
+    # the getters of operator cannot be pickled on Python 2
+    def _itemgetter(key):
+        return _KeyPath((key,))
+
+    def _attrgetter(name):
+        return _AttrPath(tuple(name.split('.')))
+
 
 class ValueAccessor(object):
 
-    def __init__(self, description, getter, caching=False):
+    # the keys or attribute names the getters of key() and attr() accessors
+    # follow, which lets the compiler inline uncached lookups; None for
+    # other getters
+    item_path = None
+    attr_path = None
+
+    def __init__(self, description, getter, caching=False, column=None, pure=False):
         self._description = description
         if caching:
             getter = CachingGetter(getter)
         self._getter = getter
-
-    def of(self, obj):
-        return self._getter(obj)
-
-    def _to_condition(self, validator, description=None):
-        return ToCondition(validator, description)
+        self.column = column
+        # whether the getter has no side effects and its values compare
+        # without raising, which makes the comparisons pure
+        self.pure = pure
+
+    @classmethod
+    def key(cls, key, description=None, caching=False, pure=False, sep='.'):
+        """Accessor of ``obj[key]``, also the ``key`` column for run_batch.
+
+        A string key is split on ``sep`` into a path: ``key("profile.age")``
+        gets ``obj["profile"]["age"]``. Pass ``sep=None`` for keys with dots.
+        """
+        if sep is not None and isinstance(key, _STRING_TYPES) and sep in key:
+            path = tuple(key.split(sep))
+            getter = _KeyPath(path)
+        else:
+            path = (key,)
+            getter = _itemgetter(key)
+        accessor = cls(key if description is None else description, getter, caching, column=key, pure=pure)
+        accessor.item_path = path
+        return accessor
+
+    @classmethod
+    def attr(cls, name, description=None, caching=False, pure=False):
+        """Accessor of the attribute ``name`` of ``obj``, or of a dotted path
+        of attributes like ``attr("profile.age")``."""
+        getter = _attrgetter(name)
+        accessor = cls(name if description is None else description, getter, caching, pure=pure)
+        accessor.attr_path = tuple(name.split('.'))
+        return accessor
+
+    def of(self, obj, scope=None):
+        """Get the value of ``obj``.
+
+        ``scope`` is the dict a DTree run creates for each input: the value
+        is computed at most once per scope, however many conditions read it.
+        """
+        if scope is None:
+            return self._getter(obj)
+        value = scope.get(self, _MISSING)
+        if value is _MISSING:
+            value = scope[self] = self._getter(obj)
+        return value
+
+    def _compare(self, op, operand=None, description=None):
+        return Compare(self, op, operand, description)
 
     def eq(self, other):
-        if isinstance(other, ValueAccessor):
-            return self._to_condition(
-                lambda obj: self.of(obj) == other.of(obj),
-                "%s = %s" % (self._description, other._description),
-            )
-        return self._to_condition(
-            lambda obj: self.of(obj) == other,
-            "%s = %s" % (self._description, other),
-        )
+        return self._compare('=', other)
 
     def lt(self, other):
-        if isinstance(other, ValueAccessor):
-            return self._to_condition(
-                lambda obj: self.of(obj) < other.of(obj),
-                "%s < %s" % (self._description, other._description),
-            )
-        return self._to_condition(lambda obj: self.of(obj) < other, "%s < %s" % (self._description, other))
+        return self._compare('<', other)
 
     def le(self, other):
-        if isinstance(other, ValueAccessor):
-            return self._to_condition(
-                lambda obj: self.of(obj) <= other.of(obj),
-                "%s <= %s" % (self._description, other._description),
-            )
-        return self._to_condition(lambda obj: self.of(obj) <= other, "%s <= %s" % (self._description, other))
+        return self._compare('<=', other)
 
     def gt(self, other):
-        if isinstance(other, ValueAccessor):
-            return self._to_condition(
-                lambda obj: self.of(obj) > other.of(obj),
-                "%s > %s" % (self._description, other._description),
-            )
-        return self._to_condition(lambda obj: self.of(obj) > other, "%s > %s" % (self._description, other))
+        return self._compare('>', other)
 
     def ge(self, other):
-        if isinstance(other, ValueAccessor):
-            return self._to_condition(
-                lambda obj: self.of(obj) >= other.of(obj),
-                "%s >= %s" % (self._description, other._description),
-            )
-        return self._to_condition(lambda obj: self.of(obj) >= other, "%s >= %s" % (self._description, other))
+        return self._compare('>=', other)
 
     def in_(self, other):
-        if isinstance(other, ValueAccessor):
-            return self._to_condition(
-                lambda obj: self.of(obj) in other.of(obj),
-                "%s in %s" % (self._description, other._description),
-            )
-        return self._to_condition(lambda obj: self.of(obj) in other, "%s in %s" % (self._description, other))
+        return self._compare('in', other)
 
     def is_(self, other):
-        if isinstance(other, ValueAccessor):
-            return self._to_condition(
-                lambda obj: self.of(obj) is other.of(obj),
-                "%s is %s" % (self._description, other._description),
-            )
-        return self._to_condition(lambda obj: self.of(obj) is other, "%s is %s" % (self._description, other))
+        return self._compare('is', other)
 
     def test(self, validator, description=None):
-        return self._to_condition(
-            lambda obj: validator(self.of(obj)),
-            description,
-        )
+        return self._compare('test', validator, description)
 
     predicate = test
 
     def none(self):
-        return self._to_condition(lambda obj: self.of(obj) is None, "%s is None" % self._description)
+        return self._compare('is', None)
 
     def notnone(self):
-        return self._to_condition(lambda obj: self.of(obj) is not None, "%s is not None" % self._description)
+        return self._compare('is not', None)
 
     def booltrue(self):
-        return self._to_condition(lambda obj: bool(self.of(obj)), "%s is bool-true" % self._description)
+        return self._compare('bool-true')
 
     def boolfalse(self):
-        return self._to_condition(lambda obj: not bool(self.of(obj)), "%s is bool-false" % self._description)
+        return self._compare('bool-false')
+
+
+_INLINE_OPERATORS = {
+    '=': '(%s == %s)',
+    '<': '(%s < %s)',
+    '<=': '(%s <= %s)',
+    '>': '(%s > %s)',
+    '>=': '(%s >= %s)',
+    'in': '(%s in %s)',
+    'is': '(%s is %s)',
+    'is not': '(%s is not %s)',
+}
+
+_LITERAL_TYPES = (type(None), bool, int, str)
+
+_IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _function_of(method):
+    # the function of a method: Python 2 makes a new unbound method at
+    # each access, so methods cannot be compared by identity
+    return getattr(method, '__func__', method)
+
+
+def _overrides(obj, cls, name):
+    if type(obj) is cls:
+        return False
+    return _function_of(getattr(type(obj), name)) is not _function_of(getattr(cls, name))
+
+
+# what the bound _run and _run_tree of a plain DTree have as __func__
+_DTREE_RUN = _function_of(DTree._run)
+_DTREE_RUN_TREE = _function_of(DTree._run_tree)
+
+
+def _walked(runner):
+    # whether the runner is a DTree which _run_iteratively may walk into,
+    # rather than run as a leaf, depending on its policy
+    return isdtree(runner) and getattr(runner._run, '__func__', None) is _DTREE_RUN and \
+        not _overrides(runner, DTree, 'run') and \
+        getattr(runner._run_tree, '__func__', None) is _DTREE_RUN_TREE
+
+
+class _Compiler(object):
+    """Translate a DTree into the source of one flat Python function.
+
+    Policies are resolved at compile time, Compare/And/Or/Not conditions are
+    inlined as plain Python expressions and everything else is called through
+    a name bound in the generated module's namespace.
+    """
+
+    # Python refuses more than 20 statically nested blocks and about 100
+    # levels of indentation, so deep trees are split into several functions.
+    MAX_BLOCKS = 15
+    MAX_INDENT = 50
+
+    def __init__(self, memoize_paths=True):
+        self.namespace = {'NoMatchError': NoMatchError}
+        self._names = {}
+        self._functions = []
+        self._reads = {}
+        self._memoize_paths = memoize_paths
+        # how many RECURSIVE nodes the code being emitted backtracks to
+        self._backtracking = 0
+        # (index, dtree, backtracking) of the functions left to emit
+        self._pending = []
+
+    def compile(self, dtree):
+        self._count_reads(dtree)
+        lines = ['def _run(obj):', '    scope = {}']
+        self._emit_dtree(dtree, lines, 1, 0)
+        self._functions.append('\n'.join(lines))
+        self._emit_functions()
+        return self._exec()
+
+    def compile_forest(self, dtrees):
+        # one function per tree, run by _run(obj, scope, default) with a
+        # scope shared by all of them
+        for dtree in dtrees:
+            self._count_reads(dtree)
+        names = [self._function(dtree) for dtree in dtrees]
+        self._emit_functions()
+        lines = ['def _run(obj, scope, default):', '    results = []']
+        for name in names:
+            lines.append('    try:')
+            lines.append('        results.append(%s(obj, scope))' % name)
+            lines.append('    except NoMatchError:')
+            lines.append('        results.append(default)')
+        lines.append('    return results')
+        self._functions.append('\n'.join(lines))
+        return self._exec()
+
+    def _exec(self):
+        source = '\n\n'.join(self._functions) + '\n'
+        code = compile(source, '<dtree compiled>', 'exec')
+        exec(code, self.namespace)
+        return source, self.namespace['_run']
+
+    def _count_reads(self, item):
+        # accessors read by more than one Compare, and compound conditions
+        # with the same key used more than once, are memoized in the scope
+        stack = [item]
+        while stack:
+            item = stack.pop()
+            if isdtree(item):
+                for condition, runner in item.children:
+                    stack.append(condition)
+                    stack.append(runner)
+                continue
+            if isinstance(item, (And, Or, Not, ToCondition)) and item.key is not None:
+                self._reads[item.key] = self._reads.get(item.key, 0) + 1
+            if isinstance(item, Compare):
+                for accessor in (item.accessor, item.operand):
+                    if isinstance(accessor, ValueAccessor):
+                        self._reads[accessor] = self._reads.get(accessor, 0) + 1
+            elif isinstance(item, (And, Or)):
+                stack.extend(item._conditions)
+            elif isinstance(item, Not):
+                stack.append(item._condition)
+
+    def _bind(self, obj, prefix):
+        name = self._names.get(id(obj))
+        if name is None:
+            name = '%s%d' % (prefix, len(self._names))
+            self._names[id(obj)] = name
+            self.namespace[name] = obj
+        return name
+
+    def _constant(self, value):
+        if type(value) in _LITERAL_TYPES:
+            return repr(value)
+        return self._bind(value, '_c')
+
+    def _function(self, dtree):
+        # the name of a function running dtree, emitted later by
+        # _emit_functions, so that a deep tree split into many functions is
+        # not emitted by as many nested calls
+        index = len(self._functions)
+        self._functions.append(None)
+        self._pending.append((index, dtree, self._backtracking))
+        return '_f%d' % index
+
+    def _emit_functions(self):
+        while self._pending:
+            index, dtree, self._backtracking = self._pending.pop()
+            lines = ['def _f%d(obj, scope):' % index]
+            self._emit_dtree(dtree, lines, 1, 0)
+            self._functions[index] = '\n'.join(lines)
+
+    def _emit_dtree(self, dtree, lines, indent, blocks):
+        run_method = POLICIES.get(dtree.policy)
+        pad = '    ' * indent
+        if _overrides(dtree, DTree, 'run'):
+            lines.append(pad + 'return %s(obj)' % self._bind(dtree.run, '_r'))
+            return
+        if run_method not in (run_by_once_policy, run_by_recursive_policy):
+            lines.append(pad + 'return %s(obj, scope)' % self._bind(dtree._run, '_r'))
+            return
+        recursive = run_method is run_by_recursive_policy
+        for condition, runner in dtree._condition_to_runner.items():
+            test = 'if %s:' % self._expression(condition)
+            if recursive:
+                lines.append(pad + 'try:')
+                lines.append(pad + '    ' + test)
+                self._backtracking += 1
+                self._emit_runner(runner, lines, indent + 2, blocks + 1)
+                self._backtracking -= 1
+                lines.append(pad + 'except NoMatchError:')
+                lines.append(pad + '    pass')
+            else:
+                lines.append(pad + test)
+                self._emit_runner(runner, lines, indent + 1, blocks)
+        if dtree.else_runner:
+            self._emit_runner(dtree.else_runner, lines, indent, blocks)
+        else:
+            lines.append(pad + 'raise NoMatchError')
+
+    def _emit_runner(self, runner, lines, indent, blocks):
+        pad = '    ' * indent
+        if isdtree(runner):
+            if indent < self.MAX_INDENT and blocks < self.MAX_BLOCKS:
+                self._emit_dtree(runner, lines, indent, blocks)
+            else:
+                lines.append(pad + 'return %s(obj, scope)' % self._function(runner))
+        else:
+            if isinstance(runner, ToAction) and not _overrides(runner, ToAction, 'run'):
+                call = 'return %s(obj)' % self._bind(runner._runner, '_a')
+            else:
+                call = 'return %s(obj, scope)' % self._bind(runner._run, '_a')
+            if not self._backtracking:
+                lines.append(pad + call)
+                return
+            # a leaf giving up after changing obj must not leave stale
+            # values to the siblings tested next
+            lines.append(pad + 'try:')
+            lines.append(pad + '    ' + call)
+            lines.append(pad + 'except NoMatchError:')
+            lines.append(pad + '    scope.clear()')
+            lines.append(pad + '    raise')
+
+    def _value(self, accessor):
+        if _overrides(accessor, ValueAccessor, 'of'):
+            return '%s(obj, scope)' % self._bind(accessor.of, '_g')
+        caching = isinstance(accessor._getter, CachingGetter)
+        path = True
+        if accessor.item_path is not None and not caching:
+            value = 'obj' + ''.join('[%s]' % self._constant(key) for key in accessor.item_path)
+        elif accessor.attr_path is not None and not caching and all(
+                _IDENTIFIER.match(name) and not keyword.iskeyword(name) for name in accessor.attr_path):
+            value = '.'.join(('obj',) + accessor.attr_path)
+        else:
+            value = '%s(obj)' % self._bind(accessor._getter, '_g')
+            path = False
+        if self._reads.get(accessor, 0) < 2 or path and not self._memoize_paths:
+            return value
+        key = self._bind(accessor, '_k')
+        return '(scope[%s] if %s in scope else scope.setdefault(%s, %s))' % (key, key, key, value)
+
+    def _expression(self, condition):
+        expression = self._inline(condition)
+        key = condition.key if isinstance(condition, (And, Or, Not, ToCondition)) else None
+        if key is None or self._reads.get(key, 0) < 2:
+            return expression
+        key = self._bind(key, '_k')
+        return '(scope[%s] if %s in scope else scope.setdefault(%s, bool(%s)))' % (key, key, key, expression)
+
+    def _inline(self, condition):
+        if isinstance(condition, Compare) and not _overrides(condition, Compare, 'validate'):
+            value = self._value(condition.accessor)
+            op = condition.op
+            operand = condition.operand
+            if isinstance(operand, ValueAccessor):
+                operand = self._value(operand)
+            elif op != 'test':
+                operand = self._constant(operand)
+            if op in _INLINE_OPERATORS:
+                return _INLINE_OPERATORS[op] % (value, operand)
+            if op == 'bool-true':
+                return value
+            if op == 'bool-false':
+                return '(not %s)' % value
+            if op == 'test':
+                return '%s(%s)' % (self._bind(operand, '_t'), value)
+        elif isinstance(condition, And) and not _overrides(condition, And, 'validate'):
+            return self._join(condition._conditions, ' and ', 'True')
+        elif isinstance(condition, Or) and not _overrides(condition, Or, 'validate'):
+            return self._join(condition._conditions, ' or ', 'False')
+        elif isinstance(condition, Not) and not _overrides(condition, Not, 'validate'):
+            return '(not %s)' % self._expression(condition._condition)
+        elif isinstance(condition, Else) and not _overrides(condition, Else, 'validate'):
+            return 'True'
+        elif isinstance(condition, ToCondition) and not _overrides(condition, ToCondition, 'validate'):
+            return '%s(obj)' % self._bind(condition._validator, '_v')
+        return '%s(obj, scope)' % self._bind(condition._validate, '_v')
+
+    def _join(self, conditions, joiner, empty):
+        if not conditions:
+            return empty
+        return '(' + joiner.join(self._expression(c) for c in conditions) + ')'
+
+
+class CompiledDTree(Runner):
+    """A DTree flattened into one generated Python function by DTree.compile.
+
+    The compiled evaluator is a snapshot: children added to the DTree after
+    compiling are not seen by it.
+    """
+
+    def __init__(self, dtree):
+        self._dtree = dtree
+        self.source, self.run = _Compiler().compile(dtree)
+
+    @property
+    def dtree(self):
+        return self._dtree
+
+    def get_default_description(self):
+        return self._dtree.description
+
+    def __reduce__(self):
+        return CompiledDTree, (self._dtree,)
+
+    def __str__(self):
+        return str(self._dtree)
+
+
+class Forest(Runner):
+    """Run many DTrees on one input, sharing the work they have in common.
+
+    The trees are frozen and compiled together, like DTree.compile does for
+    one tree, into functions which share one scope per input: accessors
+    read through a getter, and And/Or/Not and pure ToCondition conditions
+    with a key, are computed at most once per input for all the trees.
+    Key and attribute paths and single comparisons are inlined instead,
+    as repeating them is cheaper than looking them up. ``network`` counts
+    the distinct accessors and conditions of the trees, and those used by
+    more than one tree. As the trees share what they read, their leaves
+    should not change the input.
+
+    ``run`` returns the results of the trees in order, or a dict of them
+    when ``trees`` is a dict; trees without a match give ``default``.
+    """
+
+    def __init__(self, trees, default=None):
+        if isinstance(trees, dict):
+            self._names = list(trees)
+            dtrees = [trees[name] for name in self._names]
+        else:
+            self._names = None
+            dtrees = list(trees)
+        for dtree in dtrees:
+            dtree.freeze()
+        self._dtrees = dtrees
+        self.default = default
+        self.source, self._evaluate = _Compiler(memoize_paths=False).compile_forest(dtrees)
+        self.network = _forest_network(dtrees)
+
+    @property
+    def trees(self):
+        if self._names is None:
+            return list(self._dtrees)
+        return _OrderedDict(zip(self._names, self._dtrees))
+
+    def run(self, obj):
+        return self._run(obj, {})
+
+    def _run(self, obj, scope):
+        results = self._evaluate(obj, scope, self.default)
+        if self._names is None:
+            return results
+        return _OrderedDict(zip(self._names, results))
+
+    def __reduce__(self):
+        return Forest, (self.trees, self.default)
+
+
+def _forest_network(dtrees):
+    accessors = {}
+    conditions = {}
+    for dtree in dtrees:
+        used_accessors = set()
+        used_conditions = set()
+        stack = list(_iter_conditions(dtree))
+        while stack:
+            condition = stack.pop()
+            if isinstance(condition, Else):
+                continue
+            if condition.key is not None:
+                used_conditions.add(condition.key)
+            if isinstance(condition, Compare):
+                used_accessors.add(condition.accessor)
+                if isinstance(condition.operand, ValueAccessor):
+                    used_accessors.add(condition.operand)
+            elif isinstance(condition, (And, Or)):
+                stack.extend(condition._conditions)
+            elif isinstance(condition, Not):
+                stack.append(condition._condition)
+        for accessor in used_accessors:
+            accessors[accessor] = accessors.get(accessor, 0) + 1
+        for key in used_conditions:
+            conditions[key] = conditions.get(key, 0) + 1
+    return {
+        'trees': len(dtrees),
+        'accessors': len(accessors),
+        'shared_accessors': sum(1 for count in accessors.values() if count > 1),
+        'conditions': len(conditions),
+        'shared_conditions': sum(1 for count in conditions.values() if count > 1),
+    }
+
+
+_HASHABLE_TYPES = frozenset([type(None), bool, int, float, str, bytes])
+
+
+class _HashIndex(object):
+    """Dispatch a run of sibling ``=``/``in`` Compares on one accessor.
+
+    The dict maps every compared value to the first sibling testing it, so
+    one lookup gives the same child as testing the siblings in order. Values
+    of other types than the builtin hashable ones are tested in order.
+    """
+
+    @staticmethod
+    def key(condition):
+        if not isinstance(condition, Compare) or _overrides(condition, Compare, 'validate'):
+            return None
+        if condition.op == '=':
+            values = [condition.operand]
+        elif condition.op == 'in' and isinstance(condition.operand, (set, frozenset, list, tuple)):
+            values = condition.operand
+        else:
+            return None
+        for value in values:
+            if type(value) not in _HASHABLE_TYPES or value != value:
+                return None
+        return condition.accessor
+
+    def __init__(self, accessor, children):
+        self.accessor = accessor
+        self.children = children
+        self.table = {}
+        for condition, runner in children:
+            values = [condition.operand] if condition.op == '=' else condition.operand
+            for value in values:
+                self.table.setdefault(value, runner)
+
+    def match(self, obj, scope):
+        value = self.accessor.of(obj, scope)
+        if type(value) in _HASHABLE_TYPES:
+            return self.table.get(value)
+        for condition, runner in self.children:
+            if condition._validate(obj, scope):
+                return runner
+        return None
+
+
+class _IntervalIndex(object):
+    """Dispatch a run of sibling ``<``/``<=``/``>``/``>=`` Compares on one accessor.
+
+    The sorted thresholds split the number line into points and the open
+    intervals between them. The first sibling holding on each of them is
+    computed up front, so a bisect finds the child the siblings tested in
+    order would give. Values other than int and float are tested in order.
+    """
+
+    @staticmethod
+    def key(condition):
+        if not isinstance(condition, Compare) or _overrides(condition, Compare, 'validate'):
+            return None
+        if condition.op not in ('<', '<=', '>', '>='):
+            return None
+        value = condition.operand
+        if type(value) not in (int, float) or value != value:
+            return None
+        return condition.accessor
+
+    def __init__(self, accessor, children):
+        self.accessor = accessor
+        self.children = children
+        self.breakpoints = sorted(set(condition.operand for condition, _ in children))
+        positions = dict((value, i) for i, value in enumerate(self.breakpoints))
+        self.points = []
+        for point in self.breakpoints:
+            self.points.append(self._first(
+                lambda condition: condition._comparator(point, condition.operand)
+            ))
+        # the open interval j lies between breakpoints j - 1 and j
+        self.intervals = []
+        for j in range(len(self.breakpoints) + 1):
+            self.intervals.append(self._first(
+                lambda condition: (positions[condition.operand] >= j) == (condition.op in ('<', '<='))
+            ))
+
+    def _first(self, holds):
+        for condition, runner in self.children:
+            if holds(condition):
+                return runner
+        return None
+
+    def match(self, obj, scope):
+        value = self.accessor.of(obj, scope)
+        if type(value) in (int, float) and value == value:
+            j = bisect_left(self.breakpoints, value)
+            if j < len(self.breakpoints) and self.breakpoints[j] == value:
+                return self.points[j]
+            return self.intervals[j]
+        for condition, runner in self.children:
+            if condition._validate(obj, scope):
+                return runner
+        return None
+
+
+_INDEXES = (_HashIndex, _IntervalIndex)
+_MIN_INDEX_SIZE = 3
+
+
+def _build_plan(children):
+    """Group runs of indexable siblings of a DTree run by the ONCE policy.
+
+    Returns a list of ``(condition, runner)`` pairs and ``(index, None)``
+    pairs, where ``index.match(obj, scope)`` returns the runner of the first
+    matching sibling of its run, or None.
+    """
+    plan = []
+    i = 0
+    while i < len(children):
+        condition = children[i][0]
+        for index_class in _INDEXES:
+            accessor = index_class.key(condition)
+            if accessor is None:
+                continue
+            j = i + 1
+            while j < len(children) and index_class.key(children[j][0]) is accessor:
+                j += 1
+            if j - i >= _MIN_INDEX_SIZE:
+                plan.append((index_class(accessor, children[i:j]), None))
+                i = j
+                break
+        else:
+            plan.append(children[i])
+            i += 1
+    return plan
+
+
+class _Profile(object):
+    """Costs and selectivities of conditions, measured on sample inputs."""
+
+    def __init__(self, samples):
+        self.samples = samples
+        self._stats = {}
+
+    def stats(self, condition):
+        # (mean seconds per validation, fraction of samples validated)
+        stats = self._stats.get(condition)
+        if stats is None:
+            validated = evaluated = 0
+            start = _clock()
+            for obj in self.samples:
+                try:
+                    validated += bool(condition.validate(obj))
+                    evaluated += 1
+                except Exception:
+                    pass
+            cost = (_clock() - start) / max(len(self.samples), 1)
+            stats = self._stats[condition] = (cost, float(validated) / evaluated if evaluated else 0.5)
+        return stats
+
+    def count_hits(self, dtree):
+        hits = {}
+        for obj in self.samples:
+            node = dtree
+            while node is not None:
+                matched = None
+                for condition, runner in node.children:
+                    try:
+                        if condition.validate(obj):
+                            matched = condition, runner
+                            break
+                    except Exception:
+                        break
+                if matched is None:
+                    break
+                key = (id(node), matched[0])
+                hits[key] = hits.get(key, 0) + 1
+                node = matched[1] if isdtree(matched[1]) else None
+        return hits
+
+
+def _recorded_hits(dtree, hits=None):
+    if hits is None:
+        hits = {}
+    metrics = getattr(dtree, '_metrics', None)
+    for condition, runner in dtree.children:
+        if metrics is not None and condition in metrics.children:
+            hits[(id(dtree), condition)] = metrics.children[condition].condition.matches
+        if isdtree(runner):
+            _recorded_hits(runner, hits)
+    return hits
+
+
+def _optimized_condition(condition, profile):
+    if profile is None or not condition.pure:
+        return condition
+    if isinstance(condition, Not) and not _overrides(condition, Not, 'validate'):
+        optimized = Not(_optimized_condition(condition._condition, profile))
+    elif (isinstance(condition, And) and not _overrides(condition, And, 'validate')) or \
+            (isinstance(condition, Or) and not _overrides(condition, Or, 'validate')):
+        conjunction = isinstance(condition, And)
+        operands = []
+        for i, operand in enumerate(condition._conditions):
+            operand = _optimized_condition(operand, profile)
+            cost, validated = profile.stats(operand)
+            # And stops at the first false operand, Or at the first true one
+            deciding = 1.0 - validated if conjunction else validated
+            operands.append((cost / max(deciding, 1e-9), i, operand))
+        operands.sort(key=lambda item: item[:2])
+        optimized = (And if conjunction else Or)(*[operand for _, _, operand in operands])
+    else:
+        return condition
+    optimized._description = getattr(condition, '_description', None)
+    return optimized
+
+
+def _constant_set(condition):
+    # what a pure Compare with a constant operand accepts, as
+    # (accessor, values, None) or (accessor, None, (low, low_closed, high, high_closed))
+    if not isinstance(condition, Compare) or _overrides(condition, Compare, 'validate') or not condition.pure:
+        return None
+    if _HashIndex.key(condition) is not None:
+        values = [condition.operand] if condition.op == '=' else condition.operand
+        return condition.accessor, frozenset(values), None
+    if _IntervalIndex.key(condition) is not None:
+        bound = condition.operand
+        interval = {
+            '<': (None, False, bound, False),
+            '<=': (None, False, bound, True),
+            '>': (bound, False, None, False),
+            '>=': (bound, True, None, False),
+        }[condition.op]
+        return condition.accessor, None, interval
+    return None
+
+
+def _in_interval(value, interval):
+    low, low_closed, high, high_closed = interval
+    return (low is None or value > low or (low_closed and value == low)) and \
+        (high is None or value < high or (high_closed and value == high))
+
+
+def _below(a, b):
+    # whether interval a lies entirely below interval b
+    high, high_closed = a[2], a[3]
+    low, low_closed = b[0], b[1]
+    if high is None or low is None:
+        return False
+    return high < low or (high == low and not (high_closed and low_closed))
+
+
+def _exclusive(a, b):
+    if a is None or b is None or a[0] is not b[0]:
+        return False
+    if a[1] is not None and b[1] is not None:
+        return a[1].isdisjoint(b[1])
+    if a[2] is not None and b[2] is not None:
+        return _below(a[2], b[2]) or _below(b[2], a[2])
+    values, interval = (a[1], b[2]) if a[1] is not None else (b[1], a[2])
+    return all(
+        type(value) in (int, float) and not _in_interval(value, interval)
+        for value in values
+    )
+
+
+def _optimized_node(dtree, profile, hits):
+    children = []
+    for condition, runner in dtree._condition_to_runner.items():
+        count = hits.get((id(dtree), condition), 0)
+        if isdtree(runner):
+            runner = _optimized_node(runner, profile, hits)
+        children.append((count, _constant_set(condition), _optimized_condition(condition, profile), runner))
+    args = []
+    i = 0
+    while i < len(children):
+        # siblings of a run exclude each other, so that at most one of them
+        # holds and their order does not matter
+        j = i + 1
+        while j < len(children) and all(_exclusive(children[j][1], child[1]) for child in children[i:j]):
+            j += 1
+        run = sorted(children[i:j], key=lambda child: -child[0])
+        args.extend((condition, runner) for _, _, condition, runner in run)
+        i = j
+    if dtree.else_runner:
+        runner = dtree.else_runner
+        if isdtree(runner):
+            runner = _optimized_node(runner, profile, hits)
+        args.append((else_, runner))
+    return Node(*args, **dtree._kwargs)
+
+
+def _contains(a, b):
+    # whether everything constant set a accepts, constant set b accepts too
+    if a is None or b is None or a[0] is not b[0]:
+        return False
+    if a[1] is not None:
+        if b[1] is not None:
+            return a[1] <= b[1]
+        return all(type(value) in (int, float) and _in_interval(value, b[2]) for value in a[1])
+    if b[2] is None:
+        return False
+    a_low, a_low_closed, a_high, a_high_closed = a[2]
+    b_low, b_low_closed, b_high, b_high_closed = b[2]
+    if b_low is not None and (a_low is None or a_low < b_low or
+                              (a_low == b_low and a_low_closed and not b_low_closed)):
+        return False
+    if b_high is not None and (a_high is None or a_high > b_high or
+                               (a_high == b_high and a_high_closed and not b_high_closed)):
+        return False
+    return True
+
+
+class _Test(object):
+    # inner node of a DecisionDiagram
+
+    __slots__ = ('atom', 'low', 'high')
+
+    def __init__(self, atom, low, high):
+        self.atom = atom
+        self.low = low
+        self.high = high
+
+
+class DecisionDiagram(Runner):
+    """A ONCE DTree lowered by DTree.lower().
+
+    Runs like the tree, by testing one atomic condition per inner node of
+    a shared, reduced decision diagram. ``report`` compares the number of
+    atomic tests per input of the tree and of the diagram.
+    """
+
+    __slots__ = ('_root', 'report', '_description')
+
+    def __init__(self, root, report):
+        self._root = root
+        self.report = report
+
+    def run(self, obj):
+        return self._run(obj, {})
+
+    def _run(self, obj, scope):
+        node = self._root
+        while type(node) is _Test:
+            node = node.high if node.atom._validate(obj, scope) else node.low
+        if node is None:
+            raise NoMatchError
+        return node._run(obj, scope)
+
+    def count_tests(self, obj):
+        # the number of atomic tests run() makes for obj
+        count = 0
+        node = self._root
+        scope = {}
+        while type(node) is _Test:
+            node = node.high if node.atom._validate(obj, scope) else node.low
+            count += 1
+        return count
+
+
+def _lowered(runner):
+    # whether lowering goes into the sub-tree rather than keep it as a leaf
+    return _walked(runner) and POLICIES.get(runner.policy) is run_by_once_policy
+
+
+def _operands(condition):
+    # the operands of plain And/Or conditions, None for other conditions
+    if isinstance(condition, And) and not _overrides(condition, And, 'validate') or \
+            isinstance(condition, Or) and not _overrides(condition, Or, 'validate'):
+        return condition._conditions
+    return None
+
+
+def _atoms(condition):
+    # the atomic conditions of a condition, from left to right
+    if _operands(condition) is not None:
+        return [atom for operand in condition._conditions for atom in _atoms(operand)]
+    if isinstance(condition, Not) and not _overrides(condition, Not, 'validate'):
+        return _atoms(condition._condition)
+    if isinstance(condition, Else):
+        return []
+    return [condition]
+
+
+class _DiagramBuilder(object):
+    """Build a decision diagram which tests the atoms in the order the ONCE
+    policy does, but skips the atoms whose outcome the tests on the way
+    decide, like ``age < 18`` once ``age < 12`` held.
+
+    A diagram is built for each state of the walk: the sub-tree, the index
+    of the child being tested and the outcomes known about what is left to
+    test. States are memoized and equal diagram nodes are shared.
+    """
+
+    def __init__(self, max_nodes):
+        self.max_nodes = max_nodes
+        self.atoms = []
+        self.sets = []
+        self.variables = {}
+        self.regions = {}
+        self.memo = {}
+        self.unique = {}
+
+    def variable(self, atom):
+        if not atom.pure:
+            raise Error('Cannot lower the impure condition %s' % atom.description)
+        key = atom.key
+        if key is None:
+            key = id(atom)
+        variable = self.variables.get(key)
+        if variable is None:
+            variable = self.variables[key] = len(self.atoms)
+            self.atoms.append(atom)
+            self.sets.append(_constant_set(atom))
+        return variable
+
+    def outcome(self, variable, facts):
+        # the outcome of an atom which the known outcomes decide, or None
+        if variable in facts:
+            return facts[variable]
+        constant_set = self.sets[variable]
+        if constant_set is None:
+            return None
+        for fact, outcome in facts.items():
+            fact_set = self.sets[fact]
+            if fact_set is None or fact_set[0] is not constant_set[0]:
+                continue
+            if outcome and _contains(fact_set, constant_set):
+                return True
+            if outcome and _exclusive(fact_set, constant_set):
+                return False
+            if not outcome and _contains(constant_set, fact_set):
+                return False
+        return None
+
+    def evaluate(self, condition, facts):
+        # (truth, None) if the known outcomes decide the condition, else
+        # (None, the atom the policy tests next)
+        operands = _operands(condition)
+        if operands is not None:
+            stop = isinstance(condition, Or)
+            for operand in operands:
+                truth, variable = self.evaluate(operand, facts)
+                if truth is None:
+                    return None, variable
+                if truth == stop:
+                    return stop, None
+            return not stop, None
+        if isinstance(condition, Not) and not _overrides(condition, Not, 'validate'):
+            truth, variable = self.evaluate(condition._condition, facts)
+            return (None, variable) if truth is None else (not truth, None)
+        if isinstance(condition, Else):
+            return True, None
+        variable = self.variable(condition)
+        truth = self.outcome(variable, facts)
+        return truth, (variable if truth is None else None)
+
+    def region(self, dtree, index):
+        # the atoms tested from the child index of dtree on, and the
+        # accessors of the ones with constant sets
+        regions = self.regions.get(id(dtree))
+        if regions is None:
+            children = list(dtree._condition_to_runner.items())
+            variables = set()
+            accessors = set()
+            if _lowered(dtree.else_runner):
+                variables, accessors = map(set, self.region(dtree.else_runner, 0))
+            regions = [None] * (len(children) + 1)
+            regions[-1] = (frozenset(variables), frozenset(accessors))
+            for i in range(len(children) - 1, -1, -1):
+                condition, runner = children[i]
+                if _lowered(runner):
+                    sub_variables, sub_accessors = self.region(runner, 0)
+                    variables |= sub_variables
+                    accessors |= sub_accessors
+                for atom in _atoms(condition):
+                    variable = self.variable(atom)
+                    variables.add(variable)
+                    if self.sets[variable] is not None:
+                        accessors.add(self.sets[variable][0])
+                regions[i] = (frozenset(variables), frozenset(accessors))
+            self.regions[id(dtree)] = regions
+        return regions[index]
+
+    def build(self, dtree, index, facts):
+        while True:
+            children = dtree._condition_to_runner
+            if index == len(children):
+                runner = dtree.else_runner
+            else:
+                condition, runner = list(children.items())[index]
+                truth, variable = self.evaluate(condition, facts)
+                if truth is None:
+                    break
+                if not truth:
+                    index += 1
+                    continue
+            if not _lowered(runner):
+                return runner
+            dtree, index = runner, 0
+
+        variables, accessors = self.region(dtree, index)
+        sets = self.sets
+        key = (id(dtree), index, frozenset(
+            fact for fact in facts.items()
+            if fact[0] in variables or (sets[fact[0]] is not None and sets[fact[0]][0] in accessors)
+        ))
+        rv = self.memo.get(key, _MISSING)
+        if rv is _MISSING:
+            branches = []
+            for outcome in (False, True):
+                branch_facts = dict(facts)
+                branch_facts[variable] = outcome
+                branches.append(self.build(dtree, index, branch_facts))
+            rv = self.memo[key] = self.test(variable, branches[0], branches[1])
+        return rv
+
+    def test(self, variable, low, high):
+        if low is high:
+            return low
+        key = (variable, id(low), id(high))
+        rv = self.unique.get(key)
+        if rv is None:
+            if len(self.unique) >= self.max_nodes:
+                raise Error('The decision diagram has more than %d nodes' % self.max_nodes)
+            rv = self.unique[key] = _Test(self.atoms[variable], low, high)
+        return rv
+
+
+def _count_tests(condition, obj, scope):
+    # (truth, number of atomic tests) of condition, short-circuiting like
+    # And and Or
+    operands = _operands(condition)
+    if operands is not None:
+        stop = isinstance(condition, Or)
+        count = 0
+        for operand in operands:
+            truth, n = _count_tests(operand, obj, scope)
+            count += n
+            if truth == stop:
+                return stop, count
+        return not stop, count
+    if isinstance(condition, Not) and not _overrides(condition, Not, 'validate'):
+        truth, count = _count_tests(condition._condition, obj, scope)
+        return not truth, count
+    if isinstance(condition, Else):
+        return True, 0
+    return bool(condition._validate(obj, scope)), 1
+
+
+def _count_dtree_tests(dtree, obj):
+    # the number of atomic tests the ONCE policy makes for obj
+    count = 0
+    scope = {}
+    while dtree is not None:
+        runner = dtree.else_runner
+        for condition, candidate in dtree._condition_to_runner.items():
+            truth, n = _count_tests(condition, obj, scope)
+            count += n
+            if truth:
+                runner = candidate
+                break
+        dtree = runner if runner is not None and _lowered(runner) else None
+    return count
+
+
+def _worst_tests(dtree):
+    # the most atomic tests the ONCE policy can make
+    # [children left, tests so far, most tests so far] of the trees entered
+    stack = [[iter(dtree.children), 0, 0]]
+    while True:
+        frame = stack[-1]
+        for condition, runner in frame[0]:
+            frame[1] += len(_atoms(condition))
+            if _lowered(runner):
+                stack.append([iter(runner.children), 0, 0])
+                break
+            frame[2] = max(frame[2], frame[1])
+        else:
+            stack.pop()
+            worst = max(frame[1], frame[2])
+            if not stack:
+                return worst
+            stack[-1][2] = max(stack[-1][2], stack[-1][1] + worst)
+
+
+def _worst_path(root):
+    memo = {}
+
+    def longest(node):
+        if type(node) is not _Test:
+            return 0
+        rv = memo.get(id(node))
+        if rv is None:
+            rv = memo[id(node)] = 1 + max(longest(node.low), longest(node.high))
+        return rv
+
+    return longest(root)
+
+
+def _count_nodes(root):
+    seen = set()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if type(node) is _Test and id(node) not in seen:
+            seen.add(id(node))
+            stack.extend((node.low, node.high))
+    return len(seen)
+
+
+class _BatchEvaluator(object):
+    """Route the rows of a columnar table through a DTree with NumPy masks.
+
+    Every method works on ``rows``, an array of row indices, so that a
+    condition is only evaluated on the rows which reach it, like run does.
+    """
+
+    def __init__(self, numpy, data):
+        self.np = numpy
+        self.data = data
+        if getattr(getattr(data, 'dtype', None), 'names', None):
+            self.size = len(data)
+            self.row = data.__getitem__
+        elif isinstance(data, dict):
+            self.size = len(next(iter(data.values()))) if data else 0
+            self.row = lambda i: dict((key, column[i]) for key, column in data.items())
+        elif hasattr(data, 'iloc'):
+            self.size = len(data)
+            self.row = lambda i: data.iloc[i]
+        else:
+            raise TypeError('Expected structured array, dict of arrays or DataFrame, got %s' % type(data))
+        self._columns = {}
+        self._leaf_ids = None
+
+    def route(self, dtree, rows):
+        if self._leaf_ids is None:
+            self._leaf_ids = dict(
+                ((id(parent), index), leaf_id)
+                for leaf_id, (parent, index, _) in enumerate(_iter_leaves(dtree))
+            )
+        np = self.np
+        run_method = POLICIES.get(dtree.policy)
+        if _overrides(dtree, DTree, 'run') or run_method not in (run_by_once_policy, run_by_recursive_policy):
+            raise Error('run_batch supports only the once and recursive policies')
+        leaf_ids = np.full(len(rows), -1, dtype=np.intp)
+        pending = np.arange(len(rows))
+        for index, (condition, runner) in enumerate(dtree.children):
+            if not pending.size:
+                break
+            mask = self.mask(condition, rows[pending])
+            hit = pending[mask]
+            pending = pending[~mask]
+            if isdtree(runner):
+                ids = self.route(runner, rows[hit])
+                if run_method is run_by_recursive_policy:
+                    pending = np.sort(np.concatenate((pending, hit[ids < 0])))
+            else:
+                ids = self._leaf_ids[(id(dtree), index)]
+            leaf_ids[hit] = ids
+        return leaf_ids
+
+    def mask(self, condition, rows):
+        np = self.np
+        if isinstance(condition, Compare) and not _overrides(condition, Compare, 'validate'):
+            mask = self._compare(condition, rows)
+            if mask is not None:
+                return mask
+        elif isinstance(condition, And) and not _overrides(condition, And, 'validate'):
+            return self._reduce(condition._conditions, rows, True)
+        elif isinstance(condition, Or) and not _overrides(condition, Or, 'validate'):
+            return self._reduce(condition._conditions, rows, False)
+        elif isinstance(condition, Not) and not _overrides(condition, Not, 'validate'):
+            return ~self.mask(condition._condition, rows)
+        elif isinstance(condition, Else) and not _overrides(condition, Else, 'validate'):
+            return np.ones(len(rows), dtype=bool)
+        return np.fromiter(
+            (bool(condition.validate(self.row(i))) for i in rows), dtype=bool, count=len(rows),
+        )
+
+    def _reduce(self, conditions, rows, conjunction):
+        # short-circuit like And/Or.validate: later operands only see the
+        # rows which are not decided by the previous ones yet
+        np = self.np
+        mask = np.full(len(rows), conjunction, dtype=bool)
+        for condition in conditions:
+            positions = np.flatnonzero(mask == conjunction)
+            if not positions.size:
+                break
+            mask[positions] = self.mask(condition, rows[positions])
+        return mask
+
+    def values(self, accessor, rows):
+        np = self.np
+        if accessor.column is not None and not _overrides(accessor, ValueAccessor, 'of'):
+            column = self._columns.get(accessor.column)
+            if column is None:
+                column = self._columns[accessor.column] = np.asarray(self.data[accessor.column])
+            return column[rows]
+        values = np.empty(len(rows), dtype=object)
+        values[:] = [accessor.of(self.row(i)) for i in rows]
+        return values
+
+    def _compare(self, condition, rows):
+        np = self.np
+        op = condition.op
+        operand = condition.operand
+        values = self.values(condition.accessor, rows)
+        if isinstance(operand, ValueAccessor):
+            if op == 'in' or op == 'is':
+                return None
+            operand = self.values(operand, rows)
+        elif op in ('=', '<', '<=', '>', '>=') and np.ndim(operand) != 0:
+            return None
+        if op in ('=', '<', '<=', '>', '>='):
+            mask = _COMPARATORS[op](values, operand)
+        elif op == 'in':
+            if not isinstance(operand, (set, frozenset, list, tuple)):
+                return None
+            mask = np.isin(values, list(operand))
+        elif op in ('is', 'is not'):
+            if operand is not None:
+                return None
+            if values.dtype == object:
+                mask = np.frompyfunc(lambda value: value is None, 1, 1)(values)
+            else:
+                mask = np.zeros(len(values), dtype=bool)
+            if op == 'is not':
+                mask = ~np.asarray(mask, dtype=bool)
+        elif op in ('bool-true', 'bool-false'):
+            if values.dtype.kind in 'biuf':
+                mask = values.astype(bool)
+            else:
+                mask = np.frompyfunc(bool, 1, 1)(values)
+            if op == 'bool-false':
+                mask = ~np.asarray(mask, dtype=bool)
+        else:
+            mask = np.frompyfunc(operand, 1, 1)(values)
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != (len(rows),):
+            return None
+        return mask
+
+
+# comparisons of rule files, the 'test' one takes a function
+_RULE_OPERATORS = frozenset(_COMPARATORS) - frozenset(['test'])
+_UNARY_OPERATORS = frozenset(['bool-true', 'bool-false'])
+
+
+class _RuleBuilder(object):
+    # builds the Nodes of a parsed rule file, naming the faulty part of the
+    # file in errors
+
+    def __init__(self, accessors, actions, conditions):
+        self.accessors = accessors
+        self.actions = actions
+        self.conditions = conditions
+
+    def node(self, document, where):
+        if not isinstance(document, dict) or not isinstance(document.get('children'), list):
+            raise RuleFileError('%s: expected a node object with a children list' % where)
+        kwargs = dict((str(key), value) for key, value in document.items() if key != 'children')
+        policy = kwargs.get('policy')
+        if policy is not None and policy not in POLICIES:
+            raise RuleFileError("%s: unknown policy '%s'" % (where, policy))
+        args = []
+        for i, child in enumerate(document['children']):
+            child_where = '%s.children[%d]' % (where, i)
+            if not isinstance(child, list) or len(child) != 2:
+                raise RuleFileError('%s: expected a [condition, runner] pair' % child_where)
+            args.append((
+                self.condition(child[0], child_where + '[0]'),
+                self.runner(child[1], child_where + '[1]'),
+            ))
+        return Node(*args, **kwargs)
+
+    def condition(self, document, where):
+        if isinstance(document, _STRING_TYPES):
+            if document == 'else':
+                return else_
+            return self.lookup(self.conditions, 'condition', document, where)
+        if isinstance(document, list):
+            return self.compare(document, where)
+        if not isinstance(document, dict):
+            raise RuleFileError('%s: expected a condition, got %r' % (where, document))
+        description = document.get('description')
+        kinds = [kind for kind in ('and', 'or', 'not') if kind in document]
+        if len(kinds) != 1 or len(document) != 1 + (description is not None):
+            raise RuleFileError('%s: expected one of and, or, not and an optional description' % where)
+        kind = kinds[0]
+        if kind == 'not':
+            condition = Not(self.condition(document['not'], where + '.not'))
+        else:
+            operands = document[kind]
+            if not isinstance(operands, list) or not operands:
+                raise RuleFileError('%s: expected a non-empty list of conditions' % where)
+            operands = [self.condition(operand, '%s.%s[%d]' % (where, kind, i))
+                        for i, operand in enumerate(operands)]
+            condition = (And if kind == 'and' else Or)(*operands)
+        if description is not None:
+            condition.description = description
+        return condition
+
+    def compare(self, document, where):
+        if len(document) not in (2, 3) or not isinstance(document[0], _STRING_TYPES):
+            raise RuleFileError('%s: expected [accessor, operator, operand]' % where)
+        accessor = self.lookup(self.accessors, 'accessor', document[0], where)
+        op = document[1]
+        if op not in _RULE_OPERATORS:
+            raise RuleFileError("%s: unknown operator '%s'" % (where, op))
+        if (len(document) == 2) != (op in _UNARY_OPERATORS):
+            raise RuleFileError("%s: wrong number of operands for '%s'" % (where, op))
+        operand = document[2] if len(document) == 3 else None
+        if isinstance(operand, dict):
+            if list(operand) != ['accessor']:
+                raise RuleFileError('%s: expected {"accessor": name} as operand' % where)
+            operand = self.lookup(self.accessors, 'accessor', operand['accessor'], where)
+        return accessor._compare(op, operand)
+
+    def runner(self, document, where):
+        if isinstance(document, _STRING_TYPES):
+            return self.lookup(self.actions, 'action', document, where)
+        if isinstance(document, list):
+            if not document or not all(isinstance(name, _STRING_TYPES) for name in document):
+                raise RuleFileError('%s: expected a non-empty list of action names' % where)
+            return Chain(*[self.lookup(self.actions, 'action', name, where) for name in document])
+        return self.node(document, where)
+
+    def lookup(self, names, kind, name, where):
+        try:
+            return names[name]
+        except (KeyError, TypeError):
+            raise RuleFileError("%s: unknown %s '%s'" % (where, kind, name))
+
+
+class _RulePickler(pickle.Pickler):
+    # pickles the named accessors, actions and conditions by name, so that
+    # they need not be picklable and are the caller's objects when loaded
+
+    def __init__(self, file, ids):
+        pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+        self.ids = ids
+
+    def persistent_id(self, obj):
+        return self.ids.get(id(obj))
+
+
+class _RuleUnpickler(pickle.Unpickler):
+    # only loads the classes and comparators of this module and ``cls``, so
+    # that a cache file cannot make loading it call arbitrary functions
+
+    def __init__(self, file, namespaces, cls):
+        pickle.Unpickler.__init__(self, file)
+        self.namespaces = namespaces
+        self.cls = cls
+
+    def persistent_load(self, pid):
+        kind, name = pid
+        return self.namespaces[kind][name]
+
+    def find_class(self, module, name):
+        if (module, name) == (self.cls.__module__, self.cls.__name__):
+            return self.cls
+        if module == __name__:
+            obj = globals().get(name)
+            if isinstance(obj, type) and obj.__module__ == __name__ or obj is else_:
+                return obj
+        for obj in _COMPARATORS.values():
+            if (module, name) == (obj.__module__, obj.__name__):
+                return obj
+        if (module, name) in _RULE_CACHE_GLOBALS:
+            return _RULE_CACHE_GLOBALS[module, name]
+        raise pickle.UnpicklingError('%s.%s is not allowed in a rule cache' % (module, name))
+
+
+_RULE_CACHE_GLOBALS = dict(
+    ((obj.__module__, obj.__name__), obj) for obj in (set, frozenset, object, OrderedDict)
+)
+
+
+def _rule_names_digest(digest, namespaces):
+    # the tree derives descriptions, keys and purity from the named objects,
+    # so a cache is only valid for the same objects
+    for kind in sorted(namespaces):
+        names = namespaces[kind]
+        for name in sorted(names):
+            obj = names[name]
+            digest.update(('\0%s\0%s\0%s.%s\0%r' % (
+                kind, name, type(obj).__module__, type(obj).__name__,
+                tuple(getattr(obj, attribute, None) for attribute in ('description', 'pure', 'caching', 'column')),
+            )).encode('utf-8'))
+
+
+def _write_rule_cache(cache_dir, cache_name, dtree, ids):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            _RulePickler(f, ids).dump(dtree)
+        getattr(os, 'replace', os.rename)(temp_path, os.path.join(cache_dir, cache_name))
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    # drop the caches of former versions of the file
+    prefix = cache_name[:-len('.dtree') - 32]
+    for name in os.listdir(cache_dir):
+        if name != cache_name and len(name) == len(cache_name) and \
+                name.startswith(prefix) and name.endswith('.dtree'):
+            os.remove(os.path.join(cache_dir, name))
+
+
+def load_rules(path, accessors, actions, conditions=None, cls=None, cache_dir=None):
+    """Build a frozen tree from a JSON rule file.
+
+    The file holds a node: an object with a ``children`` list of
+    ``[condition, runner]`` pairs, and Node keyword arguments such as
+    ``policy``. A condition is ``"else"``, the name of one of
+    ``conditions``, ``[accessor, operator, operand]`` with the name of one
+    of ``accessors``, an operator among ``=``, ``<``, ``<=``, ``>``,
+    ``>=``, ``in``, ``is``, ``is not``, or ``[accessor, "bool-true"]`` /
+    ``[accessor, "bool-false"]``; an operand ``{"accessor": name}`` is read
+    from the object too. ``{"and": [...]}``, ``{"or": [...]}`` and
+    ``{"not": condition}`` combine conditions and may have a
+    ``description``. A runner is the name of one of ``actions``, a list of
+    names run as a Chain, or a node. Plain functions among ``actions`` and
+    ``conditions`` are wrapped in ToAction and ToCondition.
+
+    The tree, of class ``cls`` (DTree by default), is pickled to
+    ``cache_dir`` (``__pycache__`` next to the file by default, False to
+    disable), keyed by the hash of the file, so that later loads of the
+    same file skip parsing and building it. Named objects are stored by
+    name and looked up again in the given mappings; the key also covers
+    their types, descriptions and ``pure`` flags, so that changing them
+    rebuilds the tree. Raises RuleFileError for invalid files.
+
+    Like a ``.pyc`` file, the cache is trusted as much as the directory it
+    is in: loading it only creates objects of the dtree classes, ``cls``
+    and a few builtin containers, but their state comes from the file.
+    Pass a private ``cache_dir``, or False, when others can write next to
+    the rule file.
+    """
+    cls = cls or DTree
+    actions = dict((name, action if isrunner(action) else ToAction(action, name))
+                   for name, action in actions.items())
+    conditions = dict((name, condition if iscondition(condition) else ToCondition(condition, name))
+                      for name, condition in (conditions or {}).items())
+    namespaces = {'accessor': accessors, 'action': actions, 'condition': conditions}
+    with open(path, 'rb') as f:
+        data = f.read()
+    cache_path = None
+    if cache_dir is not False:
+        digest = hashlib.sha256(data)
+        digest.update(('\0%s.%s\0%s\0%s' % (
+            cls.__module__, cls.__name__, __version__, sys.version_info[:2])).encode('utf-8'))
+        _rule_names_digest(digest, namespaces)
+        cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(path)), '__pycache__')
+        cache_name = '%s.%s.dtree' % (os.path.basename(path), digest.hexdigest()[:32])
+        cache_path = os.path.join(cache_dir, cache_name)
+        try:
+            with open(cache_path, 'rb') as f:
+                dtree = _RuleUnpickler(f, namespaces, cls).load()
+            if isinstance(dtree, cls):
+                return dtree
+        except Exception:
+            # no cache yet, or one referring to names that are gone or to
+            # globals that are not allowed
+            pass
+
+    try:
+        document = json.loads(data.decode('utf-8'))
+    except ValueError as e:
+        raise RuleFileError('%s: %s' % (path, e))
+    builder = _RuleBuilder(accessors, actions, conditions)
+    dtree = cls(builder.node(document, os.path.basename(path))).freeze()
+
+    if cache_path is not None:
+        ids = {}
+        for kind, names in namespaces.items():
+            for name, obj in names.items():
+                ids[id(obj)] = (kind, name)
+        try:
+            _write_rule_cache(cache_dir, cache_name, dtree, ids)
+        except Exception:
+            # like for .pyc files, the cache is only an optimization
+            pass
+    return dtree
 
 
 def to_condition(*args, **kwargs):
 
-    def decorator(validator, description=None):
+    def decorator(validator, description=None, pure=False):
         return functools.wraps(validator)(
             ToCondition(
                 validator,
                 getattr(validator, '__name__', str(validator)) if description is None else description,
+                pure,
             )
         )
 
     if not args:
         description = kwargs.get('description')
-        return functools.partial(decorator, description=description)
+        return functools.partial(decorator, description=description, pure=kwargs.get('pure', False))
 
     elif len(args) == 1 and not kwargs:
         validator = args[0]
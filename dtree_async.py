@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""asyncio evaluation of dtree rules.
+
+The conditions, accessors and runners of ``dtree`` are reused as they are:
+whenever a getter, validator, action or error handler returns an awaitable,
+it is awaited, so plain synchronous parts mix in without being wrapped in
+tasks or threads.
+"""
+import asyncio
+from inspect import isawaitable
+
+from dtree import (
+    And,
+    Catch,
+    Chain,
+    Compare,
+    DTree,
+    NoMatchError,
+    Not,
+    ONCE,
+    Or,
+    POLICIES,
+    RECURSIVE,
+    ToCondition,
+    UnknownPolicyError,
+    ValueAccessor,
+    _MISSING,
+    _overrides,
+    isdtree,
+)
+
+__all__ = (
+    "AsyncDTree",
+    "avalidate",
+    "arun",
+    "ASYNC_POLICIES",
+)
+
+
+class _Pending(object):
+    # an accessor value some task of the run is still waiting for
+
+    def __init__(self, future):
+        self.future = future
+
+
+async def _value(accessor, obj, scope):
+    value = scope.get(accessor, _MISSING)
+    if value is _MISSING:
+        if _overrides(accessor, ValueAccessor, 'of'):
+            value = accessor.of(obj)
+        else:
+            value = accessor._getter(obj)
+        if not isawaitable(value):
+            scope[accessor] = value
+            return value
+        future = asyncio.ensure_future(value)
+        scope[accessor] = _Pending(future)
+        value = await asyncio.shield(future)
+        scope[accessor] = value
+    elif isinstance(value, _Pending):
+        value = await asyncio.shield(value.future)
+    return value
+
+
+async def _validate(condition, obj, scope):
+    if isinstance(condition, Compare) and not _overrides(condition, Compare, 'validate'):
+        value = await _value(condition.accessor, obj, scope)
+        operand = condition.operand
+        if isinstance(operand, ValueAccessor):
+            operand = await _value(operand, obj, scope)
+        result = condition._comparator(value, operand)
+    elif isinstance(condition, And) and not _overrides(condition, And, 'validate'):
+        for operand in condition._conditions:
+            if not await _validate(operand, obj, scope):
+                return False
+        return True
+    elif isinstance(condition, Or) and not _overrides(condition, Or, 'validate'):
+        for operand in condition._conditions:
+            if await _validate(operand, obj, scope):
+                return True
+        return False
+    elif isinstance(condition, Not) and not _overrides(condition, Not, 'validate'):
+        return not await _validate(condition._condition, obj, scope)
+    elif isinstance(condition, ToCondition) and not _overrides(condition, ToCondition, '_validate'):
+        # memoize the outcome rather than the awaitable, which can only be
+        # awaited once
+        key = condition.key
+        if key is not None:
+            result = scope.get(key, _MISSING)
+            if result is not _MISSING:
+                return result
+        result = condition.validate(obj)
+        if isawaitable(result):
+            result = await result
+        if key is not None:
+            scope[key] = result
+        return result
+    else:
+        result = condition._validate(obj, scope)
+    if isawaitable(result):
+        result = await result
+    return result
+
+
+async def _run(runner, obj, scope):
+    if isinstance(runner, AsyncDTree) or (isdtree(runner) and not _overrides(runner, DTree, 'run')):
+        runner._expand()
+        run_method = ASYNC_POLICIES.get(runner.policy)
+        if run_method is not None:
+            return await run_method(runner, obj, scope)
+        run_method = POLICIES.get(runner.policy)
+        if run_method is None:
+            raise UnknownPolicyError(runner.policy)
+        result = run_method(runner, obj, scope)
+    elif isinstance(runner, Chain) and not _overrides(runner, Chain, 'run'):
+        result = None
+        for i, item in enumerate(runner._runners):
+            if i:
+                # values read before the previous runners ran may be stale
+                scope.clear()
+            result = await _run(item, obj, scope)
+        return result
+    elif isinstance(runner, Catch) and not _overrides(runner, Catch, 'run'):
+        try:
+            return await _run(runner.pre_runner, obj, scope)
+        except Exception as e:
+            result = None
+            if runner.next_runner:
+                scope.clear()
+                result = await _run(runner.next_runner, obj, scope)
+            if runner.error_handler:
+                handled = runner.error_handler(e, obj)
+                if isawaitable(handled):
+                    await handled
+                return result
+            else:
+                raise e
+    else:
+        result = runner._run(obj, scope)
+    if isawaitable(result):
+        result = await result
+    return result
+
+
+async def avalidate(condition, obj, scope=None):
+    """Async counterpart of ``condition.validate(obj)``."""
+    return await _validate(condition, obj, {} if scope is None else scope)
+
+
+async def arun(runner, obj, scope=None):
+    """Async counterpart of ``runner.run(obj)``."""
+    return await _run(runner, obj, {} if scope is None else scope)
+
+
+def _validations(dtree, obj, scope):
+    # yield (awaitable truth of the condition, runner) for every sibling;
+    # concurrent trees start all validations at once, but they are still
+    # awaited in order
+    children = list(dtree._condition_to_runner.items())
+    if not getattr(dtree, 'concurrent', False):
+        for condition, runner in children:
+            yield _validate(condition, obj, scope), runner
+        return
+    tasks = [asyncio.ensure_future(_validate(condition, obj, scope)) for condition, _ in children]
+    try:
+        for task, (_, runner) in zip(tasks, children):
+            yield task, runner
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()
+
+
+async def arun_by_once_policy(self, obj, scope):
+    matched = None
+    validations = _validations(self, obj, scope)
+    try:
+        for validation, runner in validations:
+            if await validation:
+                matched = runner
+                break
+    finally:
+        validations.close()
+    if matched is not None:
+        return await _run(matched, obj, scope)
+    if self.else_runner:
+        return await _run(self.else_runner, obj, scope)
+    else:
+        raise NoMatchError
+
+
+async def arun_by_recursive_policy(self, obj, scope):
+    validations = _validations(self, obj, scope)
+    try:
+        for validation, runner in validations:
+            try:
+                if not await validation:
+                    continue
+            except NoMatchError:
+                continue
+            try:
+                return await _run(runner, obj, scope)
+            except NoMatchError:
+                # the runner may have changed obj before giving up
+                scope.clear()
+    finally:
+        validations.close()
+    if self.else_runner:
+        return await _run(self.else_runner, obj, scope)
+    else:
+        raise NoMatchError
+
+
+ASYNC_POLICIES = {
+    ONCE: arun_by_once_policy,
+    RECURSIVE: arun_by_recursive_policy,
+}
+
+
+class AsyncDTree(DTree):
+    """A DTree whose ``run`` is a coroutine.
+
+    Pass ``concurrent=True`` to a Node to start the validation of all its
+    conditions at once, e.g. when they query remote services. The first
+    matching condition in declaration order still wins and the validations
+    left over are cancelled. Like ``policy``, ``concurrent`` is inherited by
+    sub-nodes.
+    """
+
+    @property
+    def concurrent(self):
+        concurrent = self._kwargs.get('concurrent')
+        if concurrent is None:
+            return self.parent is not None and self.parent.concurrent
+        return concurrent
+
+    async def run(self, obj):
+        return await _run(self, obj, {})
+
+    def _run(self, obj, scope):
+        return _run(self, obj, scope)
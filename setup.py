@@ -1,10 +1,16 @@
 import os
+import sys
 
 from setuptools import setup
 
 with open(os.path.join(os.path.dirname(__file__), 'README.md')) as f:
     readme = f.read()
 
+py_modules = ['dtree']
+# dtree_async uses async def, which older interpreters cannot import
+if sys.version_info >= (3, 5):
+    py_modules.append('dtree_async')
+
 setup(
     name='dtree-python',
     version=__import__('dtree').__version__,
@@ -14,7 +20,7 @@ setup(
     author='ZouYJ',
     author_email='boyzouyj@gmail.com',
     url='https://github.com/boy-zyj/dtree-python',
-    py_modules=['dtree'],
+    py_modules=py_modules,
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Developers',
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Tests of dtree_async, imported by test_async on Python 3.5 and later."""
+import asyncio
+import unittest
+
+from dtree import *
+from dtree_async import *
+
+
+async def fetch_score(s):
+    await asyncio.sleep(0)
+    return s['score']
+
+
+score = ValueAccessor("score", fetch_score)
+name = ValueAccessor("name", lambda s: s['name'])
+
+
+def run(coroutine):
+    if hasattr(asyncio, 'run'):
+        return asyncio.run(coroutine)
+    # Python 3.5 and 3.6
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class AsyncDTreeTestCase(unittest.TestCase):
+
+    def test_mixed_sync_and_async(self):
+        written = []
+
+        async def write(s):
+            await asyncio.sleep(0)
+            written.append(s['name'])
+            return "written"
+
+        rule = AsyncDTree(Node(
+            (score.lt(10) & name.eq("yao"), ToAction(write)),
+            (score.ge(90), Node(
+                (name.in_(["li"]), ToAction(lambda s: "top li")),
+            )),
+            (~score.ge(50), ToAction(lambda s: 1 / 0).catch(ToAction(write), lambda e, s: None)),
+            (else_, ToAction(lambda s: "pass") / ToAction(lambda s: "chained")),
+        ))
+        self.assertEqual(run(rule.run({'score': 5, 'name': 'yao'})), "written")
+        self.assertEqual(run(rule.run({'score': 20, 'name': 'li'})), "written")
+        self.assertEqual(written, ["yao", "li"])
+        self.assertEqual(run(rule.run({'score': 60, 'name': 'li'})), "chained")
+        self.assertEqual(run(rule.run({'score': 95, 'name': 'li'})), "top li")
+        self.assertRaises(NoMatchError, run, rule.run({'score': 95, 'name': 'yao'}))
+        self.assertTrue(run(avalidate(score.gt(1) | name.eq("x"), {'score': 5})))
+        self.assertEqual(run(arun(ToAction(fetch_score), {'score': 5})), 5)
+
+    def test_recursive_policy(self):
+        rule = AsyncDTree(Node(
+            (score.gt(10), Node(
+                (name.eq("li"), ToAction(lambda s: "li")),
+            )),
+            (score.gt(5), ToAction(lambda s: "fallback")),
+            policy='recursive',
+        ))
+        self.assertEqual(run(rule.run({'score': 20, 'name': 'li'})), "li")
+        self.assertEqual(run(rule.run({'score': 20, 'name': 'yao'})), "fallback")
+
+    def test_values_reread_after_action(self):
+        async def raise_score(s):
+            await asyncio.sleep(0)
+            s['score'] += 10
+
+        async def raise_score_and_give_up(s):
+            await raise_score(s)
+            raise NoMatchError
+
+        rule = AsyncDTree(Node(
+            (score.lt(10), ToAction(raise_score_and_give_up)),
+            (score.lt(10), ToAction(lambda s: "low")),
+            (score.lt(20), ToAction(raise_score).then(AsyncDTree(Node(
+                (score.lt(20), ToAction(lambda s: "middle")),
+                (else_, ToAction(lambda s: "high")),
+            )))),
+            policy='recursive',
+        ))
+        self.assertEqual(run(rule.run({'score': 5})), "high")
+
+    def test_pure_async_condition(self):
+        checks = []
+
+        @to_condition(pure=True)
+        async def is_vip(s):
+            checks.append(s['name'])
+            await asyncio.sleep(0)
+            return s['name'] == "li"
+
+        rule = AsyncDTree(Node(
+            (score.lt(10) & is_vip, ToAction(lambda s: "young vip")),
+            (is_vip, ToAction(lambda s: "vip")),
+            (else_, ToAction(lambda s: "other")),
+        ))
+        self.assertEqual(run(rule.run({'score': 20, 'name': 'li'})), "vip")
+        self.assertEqual(run(rule.run({'score': 5, 'name': 'yao'})), "other")
+        self.assertEqual(checks, ["li", "yao"])
+
+    def test_concurrent_siblings(self):
+        events = []
+
+        def remote(delay, result):
+            async def check(s):
+                events.append(('start', delay))
+                await asyncio.sleep(delay)
+                events.append(('end', delay))
+                return result
+            return to_condition(check)
+
+        rule = AsyncDTree(Node(
+            (remote(0.02, False), ToAction(lambda s: 1)),
+            (remote(0.01, True), ToAction(lambda s: 2)),
+            (remote(0.05, True), ToAction(lambda s: 3)),
+            (remote(0.0, True), ToAction(lambda s: 4)),
+            concurrent=True,
+        ))
+        self.assertEqual(run(rule.run({})), 2)
+        self.assertEqual(events[:4], [('start', 0.02), ('start', 0.01), ('start', 0.05), ('start', 0.0)])
+        self.assertNotIn(('end', 0.05), events)
+
+    def test_accessor_read_once_when_concurrent(self):
+        reads = []
+
+        async def get(s):
+            reads.append(1)
+            await asyncio.sleep(0.01)
+            return s['score']
+
+        shared = ValueAccessor("score", get)
+        rule = AsyncDTree(Node(
+            (shared.lt(0), ToAction(lambda s: "negative")),
+            (shared.eq(3), ToAction(lambda s: "three")),
+            (shared.gt(1), ToAction(lambda s: "big")),
+            concurrent=True,
+        ))
+        self.assertEqual(run(rule.run({'score': 3})), "three")
+        self.assertEqual(reads, [1])
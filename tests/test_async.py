@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+import sys
+
+# dtree_async and its tests use async def, which older interpreters cannot
+# even parse
+if sys.version_info >= (3, 5):
+    from tests.async_cases import *
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import random
+import sys
+import unittest
+
+from dtree import *
+
+age = ValueAccessor.key('age')
+gender = ValueAccessor.key('gender')
+
+give_book = ToAction(lambda s: "book", "give book")
+give_note = ToAction(lambda s: "note", "give note")
+give_ball = ToAction(lambda s: "ball", "give ball")
+
+
+def fail(s):
+    raise ValueError(s['age'])
+
+
+class AuditTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rule = DTree(Node(
+            (age.lt(0), ToAction(fail, "fail")),
+            (age.lt(12), Node(
+                (gender.eq("female"), Node((age.gt(100), give_book))),
+                (else_, give_ball),
+                policy='once',
+            )),
+            (age.lt(18), Node(
+                (gender.eq("female"), give_note),
+            )),
+            (age.lt(60), give_book),
+            policy='recursive',
+        ))
+
+    def test_trace(self):
+        self.assertIsNone(self.rule.audit_log)
+        self.assertRaises(Error, self.rule.run, {'age': 10}, trace=True)
+        self.rule.audit()
+        self.assertTrue(self.rule.frozen)
+        self.assertNotIn('_run_tree', self.rule.__dict__)
+
+        self.assertEqual(self.rule.run({'age': 10, 'gender': "female"}), "note")
+        self.assertEqual(len(self.rule.audit_log), 0)
+        self.assertEqual(self.rule.run({'age': 10, 'gender': "female"}, trace=True), "note")
+        self.assertEqual(self.rule.run({'age': 8, 'gender': "male"}, trace=True), "ball")
+        self.assertEqual(list(self.rule.audit_log), [
+            # the dead end under age < 12 is not part of the path
+            {'conditions': ["age < 18", "gender = female"], 'runner': "give note", 'error': None},
+            {'conditions': ["age < 12", "ELSE"], 'runner': "give ball", 'error': None},
+        ])
+
+    def test_errors(self):
+        self.rule.audit(sample_rate=1)
+        self.assertRaises(ValueError, self.rule.run, {'age': -1})
+        self.assertRaises(NoMatchError, self.rule.run, {'age': 70})
+        self.assertEqual(list(self.rule.audit_log), [
+            {'conditions': ["age < 0"], 'runner': "fail", 'error': ValueError},
+            {'conditions': [], 'runner': None, 'error': NoMatchError},
+        ])
+        self.assertRaises(Error, self.rule.instrument)
+        self.assertRaises(Error, self.rule.cache_decisions)
+        self.rule.audit(False)
+        self.assertIsNone(self.rule.audit_log)
+        self.assertNotIn('_run_tree', self.rule.__dict__)
+
+    def test_sampling(self):
+        self.rule.audit(sample_rate=0.25, capacity=100)
+        random.seed(0)
+        for a in range(1, 60):
+            self.rule.run({'age': a, 'gender': "male"})
+        logged = len(self.rule.audit_log)
+        self.assertTrue(5 < logged < 30, logged)
+
+        self.rule.audit(sample_rate=1, capacity=3)
+        for a, g in ((20, "male"), (5, "male"), (15, "female"), (30, "male")):
+            self.rule.run({'age': a, 'gender': g})
+        self.assertEqual(len(self.rule.audit_log.records()), 3)
+        self.assertEqual([run['runner'] for run in self.rule.audit_log], ["give ball", "give note", "give book"])
+        self.rule.audit_log.clear()
+        self.assertEqual(list(self.rule.audit_log), [])
+
+    def test_deep_tree(self):
+        depth = 3 * sys.getrecursionlimit()
+        node = Node((else_, give_book))
+        for i in range(depth):
+            node = Node((age.lt(-i), give_note), (else_, node), policy='recursive' if i % 2 else None)
+        rule = DTree(node)
+        rule.audit(sample_rate=1)
+        self.assertTrue(rule.frozen)
+        self.assertEqual(rule.run({'age': 30}), "book")
+        run, = rule.audit_log
+        self.assertEqual(run['conditions'], ["ELSE"] * (depth + 1))
+        self.assertEqual(run['runner'], "give book")
+        rule.audit(False)
+        self.assertEqual(rule.run({'age': 30}), "book")
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import itertools
+import unittest
+
+from dtree import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+age = ValueAccessor("age", lambda s: s['age'], column='age')
+interest = ValueAccessor("interest", lambda s: s['interest'], column='interest')
+gender = ValueAccessor("gender", lambda s: s['gender'])
+
+give_book = ToAction(lambda s: "book", "give book")
+give_football = ToAction(lambda s: "football", "give football")
+give_note = ToAction(lambda s: "note", "give note")
+
+rows = list(itertools.product(
+    [5, 12, 14, 15, 30],
+    ['sports', 'writing', 'reading'],
+    ['male', 'female'],
+))
+
+
+def outcome(runner, obj):
+    try:
+        return runner.run(obj)
+    except NoMatchError:
+        return NoMatchError
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class RunBatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = {
+            'age': numpy.array([r[0] for r in rows]),
+            'interest': numpy.array([r[1] for r in rows]),
+            'gender': numpy.array([r[2] for r in rows]),
+        }
+        self.students = [dict(zip(('age', 'interest', 'gender'), r)) for r in rows]
+
+    def assertSameLeaves(self, rule, data):
+        leaf_ids = rule.run_batch(data)
+        leaves = rule.leaves
+        for leaf_id, student in zip(leaf_ids, self.students):
+            expected = outcome(rule, student)
+            self.assertEqual(expected, leaves[leaf_id].run(student) if leaf_id >= 0 else NoMatchError)
+
+    def test_once_policy(self):
+        rule = DTree(Node(
+            (age.lt(12), Node(
+                (interest.eq("sports"), Node(
+                    (gender.eq("female"), give_note),
+                    (else_, give_football),
+                )),
+                (else_, give_book),
+            )),
+            (age.ge(15) & ~interest.in_({"writing"}), give_book),
+            (Or(gender.eq("male"), age.eq(14)), Node(
+                (interest.eq("writing"), give_note),
+            )),
+            (to_condition(lambda s: s['age'] == 15), give_football),
+        ))
+        self.assertSameLeaves(rule, self.data)
+        structured = numpy.array(rows, dtype=[('age', int), ('interest', 'U10'), ('gender', 'U10')])
+        self.assertSameLeaves(rule, structured)
+
+    def test_recursive_policy(self):
+        rule = DTree(Node(
+            (age.ge(12), Node(
+                (interest.eq("sports"), give_football),
+                (gender.eq("female"), Node(
+                    (interest.eq("writing"), give_note),
+                    policy='once',
+                )),
+            )),
+            (gender.eq("male") | age.test(lambda a: a > 20), give_book),
+            policy='recursive',
+        ))
+        self.assertSameLeaves(rule, self.data)
+
+    def test_actions(self):
+        rule = DTree(Node(
+            (age.lt(14), give_football),
+            (else_, ToAction(lambda s: s['interest'])),
+        ))
+        self.assertEqual(
+            rule.run_batch(self.data, actions=True),
+            [rule.run(student) for student in self.students],
+        )
+        rule = DTree(Node((age.lt(14), give_football)))
+        self.assertRaises(NoMatchError, rule.run_batch, self.data, actions=True)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from dtree import *
+
+age = ValueAccessor.key('age')
+kind = ValueAccessor.key('kind')
+
+log = []
+
+
+def insert(rows):
+    log.append(('insert', [row['id'] for row in rows]))
+    return ['row %d' % row['id'] for row in rows]
+
+
+def publish(messages):
+    log.append(('publish', [message['id'] for message in messages]))
+    if any(message['age'] < 0 for message in messages):
+        raise ValueError('bad age')
+    return ['sent %d' % message['id'] for message in messages]
+
+
+def validate(s):
+    log.append(('validate', s['id']))
+    if s.get('invalid'):
+        raise ValueError(s['id'])
+    return s['id']
+
+
+def audit(s):
+    log.append(('audit', s['id']))
+    return 'audited %d' % s['id']
+
+
+handled = []
+
+
+def handle(e, s):
+    handled.append((type(e), s['id']))
+
+
+give_note = ToAction(lambda s: 'note', 'give note')
+
+
+class BulkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        del log[:]
+        del handled[:]
+        self.rule = DTree(Node(
+            (kind.eq('row'), Node(
+                (age.lt(0), ToAction(validate) / BatchAction(insert)),
+                (age.lt(18), ToAction(validate) / BatchAction(insert) / ToAction(audit)),
+                policy='once',
+            )),
+            (kind.eq('message'), Catch(BatchAction(publish), ToAction(audit), handle)),
+            (kind.eq('row'), give_note),
+            policy='recursive',
+        ))
+
+    def people(self, *specs):
+        return [dict(id=i, kind=k, age=a, **extra) for i, (k, a, extra) in enumerate(specs)]
+
+    def test_bulk(self):
+        people = self.people(('row', 10, {}), ('message', 20, {}), ('row', 30, {}), ('row', 12, {}),
+                             ('message', 40, {}), ('row', -1, {}))
+        self.assertEqual(self.rule.run_bulk(people), [
+            'audited 0', 'sent 1', 'note', 'audited 3', 'sent 4', 'row 5',
+        ])
+        # each leaf runs once, in the order it was first reached, and every
+        # object goes through the steps of its chain in order
+        self.assertEqual(log, [
+            ('validate', 0), ('validate', 3), ('insert', [0, 3]), ('audit', 0), ('audit', 3),
+            ('publish', [1, 4]),
+            ('validate', 5), ('insert', [5]),
+        ])
+        self.assertEqual(self.rule.run(people[0]), 'audited 0')
+
+    def test_errors(self):
+        people = self.people(('row', 10, {}), ('row', 12, {'invalid': True}), ('message', -5, {}),
+                             ('message', 20, {}), ('other', 0, {}), ('row', 15, {}))
+        self.assertRaises(ValueError, self.rule.run_bulk, people)
+        del log[:]
+        del handled[:]
+        errors = []
+        results = self.rule.run_bulk(people, error_handler=lambda e, s: errors.append((type(e), s['id'])))
+        self.assertEqual(results, ['audited 0', None, 'audited 2', 'audited 3', None, 'audited 5'])
+        # the invalid row left its chain before the insert
+        self.assertIn(('insert', [0, 5]), log)
+        self.assertEqual(handled, [(ValueError, 2), (ValueError, 3)])
+        self.assertEqual(errors, [(ValueError, 1), (NoMatchError, 4)])
+
+        self.assertRaises(Error, BatchAction(lambda objs: []).run, {})
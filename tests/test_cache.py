@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import sys
+import unittest
+
+from dtree import *
+
+
+def outcome(runner, obj):
+    try:
+        return runner.run(obj)
+    except NoMatchError:
+        return NoMatchError
+
+
+age = ValueAccessor.key('age', pure=True)
+gender = ValueAccessor.key('gender', pure=True)
+name = ValueAccessor.key('name')
+
+runs = []
+
+
+def give(item):
+    def run(s):
+        runs.append(item)
+        return item
+    return ToAction(run, "give %s" % item)
+
+
+def no_match(s):
+    raise NoMatchError
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        del runs[:]
+        self.rule = DTree(Node(
+            (age.lt(12), Node(
+                (gender.eq("female"), give("note")),
+                (else_, give("ball")),
+            )),
+            (age.ge(60) & ~gender.eq("male"), give("book")),
+            (age.ge(18), ToAction(no_match)),
+            (age.ge(18), give("pen")),
+            policy='recursive',
+        ))
+        self.students = [{'age': a, 'gender': g, 'name': 'x'} for a in (10, 15, 30, 70) for g in ("male", "female")]
+
+    def outcomes(self):
+        return [outcome(self.rule, s) for s in self.students]
+
+    def test_cache(self):
+        expected = self.outcomes()
+        self.assertIsNone(self.rule.cache_info)
+        self.rule.cache_decisions()
+        self.assertTrue(self.rule.frozen)
+        self.assertEqual(self.outcomes(), expected)
+
+        tested = []
+        validate = Compare._validate
+
+        def counting(condition, obj, scope):
+            tested.append(condition)
+            return validate(condition, obj, scope)
+
+        Compare._validate = counting
+        try:
+            del runs[:]
+            self.assertEqual(self.outcomes(), expected)
+        finally:
+            Compare._validate = validate
+        # the inputs which backtracked from a leaf were not cached
+        self.assertEqual(len(runs), 6)
+        self.assertEqual(len(tested), 4 + 4 + 5)
+
+        # the decisions are keyed by the values read on the way, so both
+        # students aged 15 share theirs
+        info = self.rule.cache_info
+        self.assertEqual((info['hits'], info['misses'], info['size']), (6, 10, 4))
+        self.rule.cache_decisions(False)
+        self.assertIsNone(self.rule.cache_info)
+        self.assertEqual(self.outcomes(), expected)
+
+    def test_eviction(self):
+        self.rule.cache_decisions(maxsize=2)
+        for a in (10, 11, 10, 70, 11):
+            self.rule.run({'age': a, 'gender': 'female'})
+        info = self.rule.cache_info
+        self.assertEqual((info['hits'], info['misses'], info['evictions'], info['size']), (1, 4, 2, 2))
+
+        self.rule.cache_decisions(ttl=0)
+        self.rule.run({'age': 10, 'gender': 'female'})
+        self.rule.run({'age': 10, 'gender': 'female'})
+        info = self.rule.cache_info
+        self.assertEqual((info['hits'], info['misses'], info['expirations']), (0, 2, 1))
+
+    def test_pure_only(self):
+        for condition in (name.eq('x'), age.test(bool), to_condition(pure=True)(lambda s: True)):
+            rule = DTree(Node((condition, give("pen"))))
+            self.assertRaises(Error, rule.cache_decisions)
+            self.assertFalse(rule.frozen)
+        self.rule.instrument()
+        self.assertRaises(Error, self.rule.cache_decisions)
+
+    def test_typed_keys(self):
+        flag = ValueAccessor.key('flag', pure=True)
+        rule = DTree(Node(
+            (flag.is_(True), give("pen")),
+            (else_, give("note")),
+        ))
+        rule.cache_decisions()
+        self.assertEqual([rule.run({'flag': f}) for f in (1, True, 1, True)], ["note", "pen"] * 2)
+        self.assertEqual(rule.cache_info['size'], 2)
+
+    def test_other_toggles_keep_cache(self):
+        self.rule.cache_decisions()
+        self.rule.instrument(False)
+        self.rule.audit(False)
+        self.outcomes()
+        self.assertEqual(self.rule.cache_info['hits'], 1)
+        self.outcomes()
+        self.assertEqual(self.rule.cache_info['hits'], 6)
+
+    def test_fields_read_on_some_branches(self):
+        income = ValueAccessor.key('income', pure=True)
+        rule = DTree(Node(
+            (age.lt(18), give("note")),
+            (income.gt(1000), give("pen")),
+            (else_, give("book")),
+        ))
+        rule.cache_decisions()
+        for _ in range(5):
+            self.assertEqual(rule.run({'age': 10}), "note")
+        self.assertEqual(rule.run({'age': 30, 'income': 2000}), "pen")
+        self.assertEqual(rule.run({'age': 30, 'income': 10}), "book")
+        self.assertEqual(rule.run({'age': 30, 'income': 2000}), "pen")
+        self.assertRaises(KeyError, rule.run, {'age': 30})
+        info = rule.cache_info
+        self.assertEqual((info['hits'], info['misses'], info['skips'], info['size']), (5, 3, 1, 3))
+
+    def test_deep_tree(self):
+        depth = 3 * sys.getrecursionlimit()
+        node = Node((else_, give("book")))
+        for i in range(depth):
+            node = Node((age.lt(-i), give("note")), (else_, node), policy='recursive' if i % 2 else None)
+        rule = DTree(node)
+        rule.cache_decisions()
+        self.assertTrue(rule.frozen)
+        for _ in range(3):
+            self.assertEqual(rule.run({'age': 30}), "book")
+        self.assertEqual(rule.run({'age': -5000}), "note")
+        info = rule.cache_info
+        self.assertEqual((info['hits'], info['misses']), (2, 2))
+        rule.cache_decisions(False)
+        self.assertEqual(rule.run({'age': 30}), "book")
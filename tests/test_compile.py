@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import itertools
+import sys
+import unittest
+
+from dtree import *
+
+age = ValueAccessor("age", lambda s: s['age'])
+interest = ValueAccessor("interest", lambda s: s['interest'])
+gender = ValueAccessor("gender", lambda s: s['gender'])
+
+give_book = ToAction(lambda s: "book", "give book")
+give_football = ToAction(lambda s: "football", "give football")
+give_note = ToAction(lambda s: "note", "give note")
+
+students = [
+    {'age': a, 'interest': i, 'gender': g}
+    for a, i, g in itertools.product(
+        [5, 12, 14, 15, 30],
+        ['sports', 'writing', 'reading'],
+        ['male', 'female'],
+    )
+]
+
+
+def outcome(runner, obj):
+    try:
+        return runner.run(obj)
+    except NoMatchError:
+        return NoMatchError
+
+
+class CompileTestCase(unittest.TestCase):
+
+    def assertSameResults(self, rule, inputs=students):
+        compiled = rule.compile()
+        self.assertIsInstance(compiled, CompiledDTree)
+        for obj in inputs:
+            self.assertEqual(outcome(rule, obj), outcome(compiled, obj))
+
+    def test_once_policy(self):
+        rule = DTree(Node(
+            (age.lt(12), Node(
+                (interest.eq("sports"), Node(
+                    (gender.eq("female"), give_note),
+                    (else_, give_football),
+                )),
+                (else_, give_book),
+            )),
+            (age.ge(15) & ~interest.in_(["writing"]), give_book),
+            (Or(gender.eq("male"), age.eq(14)), Node(
+                (interest.eq("writing"), give_note),
+            )),
+        ))
+        self.assertSameResults(rule)
+        self.assertEqual(str(rule.compile()), str(rule))
+
+    def test_recursive_policy(self):
+        rule = DTree(Node(
+            (age.ge(12), Node(
+                (interest.eq("sports"), give_football),
+                (gender.eq("female"), Node(
+                    (interest.eq("writing"), give_note),
+                    policy='once',
+                )),
+            )),
+            (gender.eq("male"), give_book),
+            policy='recursive',
+        ))
+        self.assertSameResults(rule)
+
+    def test_opaque_conditions_and_runners(self):
+
+        @to_condition
+        def is_teenager(s):
+            return 13 <= s['age'] < 20
+
+        class IsOld(Condition):
+            def validate(self, obj):
+                return obj['age'] >= 30
+
+        rule = DTree(Node(
+            (is_teenager, give_note.then(give_book)),
+            (IsOld(), ToAction(lambda s: 1 / 0).catch(give_football, lambda e, s: None)),
+            (age.test(lambda a: a % 2 == 0), give_note),
+            (age.eq(age), give_book),
+        ))
+        self.assertSameResults(rule)
+
+    def test_deep_tree(self):
+        node = Node((else_, give_book))
+        for depth in range(300):
+            node = Node((age.gt(depth), node), policy='recursive' if depth % 2 else None)
+        rule = DTree(node)
+        self.assertSameResults(rule, [{'age': 1000}, {'age': 100}])
+
+        depth = 3 * sys.getrecursionlimit()
+        node = Node((else_, give_book))
+        for i in range(depth):
+            node = Node((age.gt(i), node), policy='recursive' if i % 2 else None)
+        rule = DTree(node)
+        self.assertSameResults(rule, [{'age': depth}, {'age': 100}])
+
+    def test_inlined_paths(self):
+        class Profile(object):
+            def __init__(self, age):
+                self.age = age
+
+        class Student(object):
+            def __init__(self, age):
+                self.profile = Profile(age)
+
+        key_age = ValueAccessor.key('profile.age')
+        attr_age = ValueAccessor.attr('profile.age')
+        rule = DTree(Node(
+            (key_age.lt(12), give_note),
+            (key_age.ge(60) | ValueAccessor.key('profile.name').eq('bob'), give_book),
+            (else_, give_football),
+        ))
+        inputs = [{'profile': {'age': a, 'name': n}} for a in (10, 30, 70) for n in ('bob', 'ann')]
+        self.assertSameResults(rule, inputs)
+        self.assertIn("obj['profile']['age']", rule.compile().source)
+
+        rule = DTree(Node((attr_age.lt(12), give_note), (else_, give_book)))
+        self.assertSameResults(rule, [Student(10), Student(30)])
+        self.assertIn("obj.profile.age", rule.compile().source)
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
+import gc
+import sys
 import textwrap
 import unittest
 
 from dtree import *
+from dtree import POLICIES, run_by_once_policy
 
 student = {
     'age': 15,
@@ -66,3 +69,297 @@ class DTreeTestCase(unittest.TestCase):
         self.assertEqual(s, str(rule))
         gift = rule.run(student)  # give book
         self.assertEqual(gift, "give book")
+
+    def test_accessor_read_once_per_run(self):
+        reads = []
+
+        def get_gender(s):
+            reads.append(s['gender'])
+            return s['gender']
+
+        gender = ValueAccessor("gender", get_gender)
+        rule = DTree(Node(
+            (gender.eq("male") & age.lt(12), give_football),
+            (gender.eq("male"), give_book),
+            (Or(gender.eq("other"), gender.in_(["female"])), Node(
+                (~gender.eq("female"), give_book),
+                (else_, give_note),
+            )),
+        ))
+        for runner in (rule, rule.compile()):
+            del reads[:]
+            self.assertEqual(runner.run(student), "give note")
+            self.assertEqual(reads, ["female"])
+            self.assertEqual(runner.run(dict(student, gender="male")), "give book")
+            self.assertEqual(reads, ["female", "male"])
+
+    def test_values_reread_after_action(self):
+        def add_ten_years(student):
+            student['age'] += 10
+
+        def add_ten_years_and_give_up(student):
+            add_ten_years(student)
+            raise NoMatchError
+
+        rule = DTree(Node(
+            (age.lt(18), Chain(ToAction(add_ten_years), DTree(Node(
+                (age.lt(18), ToAction(lambda s: "minor")),
+                (else_, ToAction(lambda s: "adult")),
+            )))),
+            (else_, PASS),
+        ))
+        for runner in (rule, rule.compile()):
+            self.assertEqual(runner.run({'age': 10}), "adult")
+
+        rule = DTree(Node(
+            (age.lt(18), ToAction(add_ten_years_and_give_up)),
+            (age.lt(18), give_book),
+            (age.ge(18), give_note),
+            policy='recursive',
+        ))
+        for runner in (rule, rule.compile()):
+            self.assertEqual(runner.run({'age': 10}), "give note")
+
+    def test_hash_dispatch(self):
+        country = ValueAccessor("country", lambda s: s['country'])
+        routes = [ToAction(lambda s, i=i: i, "route %d" % i) for i in range(8)]
+        rule = DTree(Node(
+            (country.eq("DE"), routes[0]),
+            (country.in_({"FR", "BE", 1}), routes[1]),
+            (country.eq("FR"), routes[2]),
+            (country.eq("NL"), routes[3]),
+            (country.test(lambda c: isinstance(c, tuple)), routes[4]),
+            (country.eq("IT"), routes[5]),
+            (country.in_(["ES", "PT"]), routes[6]),
+            (country.eq("NL"), routes[7]),
+            (else_, pass_),
+        ))
+        cases = [
+            ("DE", 0), ("FR", 1), ("BE", 1), (1.0, 1), (True, 1), ("NL", 3),
+            ((), 4), ("IT", 5), ("PT", 6), ("XX", None), (None, None),
+        ]
+        for value, expected in cases:
+            self.assertEqual(rule.run({'country': value}), expected)
+        rule.add_child(country.eq("XX"), routes[7])
+        self.assertEqual(rule.run({'country': "XX"}), 7)
+        self.assertEqual(rule.compile().run({'country': "PT"}), 6)
+
+    def test_interval_dispatch(self):
+        score = ValueAccessor("score", lambda s: s['score'])
+        conditions = [
+            score.lt(12), score.lt(18), score.ge(65), score.le(30), score.gt(30),
+            score.eq(40), score.le(18.5), score.gt(50), score.ge(-1), score.lt(100),
+        ]
+        rule = DTree(Node(*[
+            (condition, ToAction(lambda s, i=i: i)) for i, condition in enumerate(conditions)
+        ]))
+        values = [-5, -1, 0, 11.5, 12, 17.9, 18, 18.5, 19, 30, 30.5, 40, 50, 64, 65, 99, 100,
+                  1e9, float('inf'), float('nan'), True, False]
+        for value in values:
+            expected = next((i for i, c in enumerate(conditions) if c.validate({'score': value})), None)
+            try:
+                got = rule.run({'score': value})
+            except NoMatchError:
+                got = None
+            self.assertEqual(got, expected, value)
+
+    def test_freeze(self):
+        import threading
+
+        reads = []
+
+        def get_age(s):
+            reads.append(1)
+            return s.age
+
+        class Student(object):
+            def __init__(self, age):
+                self.age = age
+
+        cached_age = ValueAccessor("age", get_age, caching=True)
+        rule = DTree(Node(
+            (cached_age.lt(12), Node(
+                (cached_age.lt(6), give_note),
+                (else_, give_football),
+            )),
+            (else_, give_book),
+            policy='recursive',
+        ))
+        self.assertIs(rule.freeze(), rule)
+        self.assertTrue(rule.frozen)
+        self.assertTrue(rule.children[0][1].frozen)
+        self.assertRaises(FrozenError, rule.add_child, is_male, give_book)
+        self.assertRaises(FrozenError, rule.children[0][1].add_child, is_male, give_book)
+        self.assertRaises(FrozenError, rule.drop_nodes)
+        self.assertRaises(FrozenError, rule.instrument)
+        self.assertNotIn('_run_tree', rule.__dict__)
+        with self.assertRaises(FrozenError):
+            rule.children[0][1].description = 'young'
+        self.assertEqual(rule.children[0][1].policy, 'recursive')
+        self.assertEqual(str(rule).splitlines()[0], '+++root(recursive):')
+
+        students = [Student(age) for age in range(20)]
+        expected = [rule.run(s) for s in students]
+        results = []
+
+        def run():
+            results.append([rule.run(s) for s in students])
+
+        threads = [threading.Thread(target=run) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [expected] * 8)
+        self.assertEqual(len(reads), 20)
+
+    def test_compact_representation(self):
+        for condition in (age.lt(12), is_male & is_female, ~is_male, else_):
+            self.assertFalse(hasattr(condition, '__dict__'))
+        self.assertFalse(hasattr(give_book / give_note, '__dict__'))
+        rule = DTree(Node(
+            (age.lt(12), Node(
+                (is_female, give_note),
+                (else_, give_football),
+                policy='recursive',
+            )),
+            (else_, give_book),
+        ))
+        s = str(rule)
+        self.assertIs(rule.drop_nodes(), rule)
+        self.assertEqual(str(rule), s)
+        self.assertEqual(str(DTree(rule.node)), s)
+        self.assertEqual(rule.children[0][1].node.kwargs, {'policy': 'recursive'})
+        self.assertEqual(rule.run(student), "give book")
+        # reading the children and running does not allocate a __dict__
+        rule.leaves
+        rule.else_runner
+        for dtree in (rule, rule.children[0][1]):
+            attributes = set(map(id, (dtree._condition_to_runner, dtree._kwargs)))
+            self.assertFalse([o for o in gc.get_referents(dtree) if type(o) is dict and id(o) not in attributes])
+
+    def test_backtracking(self):
+        def no_match(student):
+            raise NoMatchError
+
+        rule = DTree(Node(
+            (to_condition(no_match), give_football),
+            (age.lt(18), ToAction(no_match)),
+            (is_female, Node(
+                (age.ge(12), Node(
+                    (interest.eq("sports"), give_football),
+                )),
+                (else_, give_book),
+                policy='once',
+            )),
+            (interest.eq("reading"), give_note),
+            policy='recursive',
+        ))
+        self.assertEqual(rule.run(student), "give note")
+        self.assertRaises(NoMatchError, rule.run, dict(student, interest="writing"))
+
+    def test_deep_tree(self):
+        depth = 3 * sys.getrecursionlimit()
+        for policy, expected in (('once', "give book"), ('recursive', "give note")):
+            rule = DTree(Node(policy=policy))
+            dtree = rule
+            for _ in range(depth):
+                child = DTree(Node(policy=policy))
+                child.parent = dtree
+                dtree.add_child(age.ge(0), child)
+                dtree = child
+            dtree.add_child(age.lt(0), give_football)
+            if policy == 'once':
+                dtree.add_child(else_, give_book)
+            rule.add_child(age.gt(12), give_note)
+            self.assertEqual(rule.run(student), expected)
+
+        node = Node((else_, give_book))
+        for _ in range(depth):
+            node = Node((age.lt(0), give_football), (else_, node))
+        rule = DTree(node)
+        self.assertEqual(rule.run(student), "give book")
+        self.assertEqual(len(rule.leaves), depth + 1)
+        self.assertIs(rule.drop_nodes(), rule)
+        self.assertEqual(len(DTree(rule.node).leaves), depth + 1)
+        self.assertEqual(rule.freeze().run(student), "give book")
+        self.assertTrue(rule.children[1][1].frozen)
+        self.assertIs(rule.leaves[-1], give_book)
+
+    def test_overridden_run_and_validate(self):
+        calls = []
+
+        class CountingDTree(DTree):
+            def run(self, obj, trace=False):
+                calls.append(obj['age'])
+                return super(CountingDTree, self).run(obj, trace)
+
+        rule = CountingDTree(Node(
+            (age.lt(18), Node(
+                (age.lt(12), give_book),
+                (else_, give_note),
+            )),
+            (else_, give_football),
+        ))
+        self.assertEqual(rule.run(student), "give note")
+        self.assertEqual(calls, [15, 15])
+        del calls[:]
+        self.assertEqual(rule.compile().run(student), "give note")
+        self.assertEqual(calls, [15, 15])
+
+        class Never(object):
+            def validate(self, obj):
+                return False
+
+        class NeverAnd(Never, And):
+            pass
+
+        class NeverOr(Never, Or):
+            pass
+
+        class NeverNot(Never, Not):
+            pass
+
+        class Upper(Chain):
+            def run(self, obj):
+                return super(Upper, self).run(obj).upper()
+
+        class Handled(Catch):
+            def run(self, obj):
+                try:
+                    return super(Handled, self).run(obj)
+                except ValueError:
+                    return "handled"
+
+        def fail(student):
+            raise ValueError
+
+        for condition in (NeverAnd(is_female), NeverOr(is_female), NeverNot(is_male)):
+            rule = DTree(Node((condition, give_book), (else_, give_note)))
+            self.assertEqual(rule.run(student), "give note")
+            self.assertEqual(rule.compile().run(student), "give note")
+        for runner, expected in ((Upper(give_book), "GIVE BOOK"), (Handled(ToAction(fail)), "handled")):
+            rule = DTree(Node((is_female, runner)))
+            self.assertEqual(rule.run(student), expected)
+            self.assertEqual(rule.compile().run(student), expected)
+
+    def test_unscoped_policy(self):
+        runs = []
+
+        def run_logged(dtree, obj):
+            runs.append(obj['age'])
+            return run_by_once_policy(dtree, obj)
+
+        register_policy('logged', run_logged)
+        try:
+            rule = DTree(Node(
+                (age.lt(12), give_note),
+                (else_, Node((is_female, give_book), policy='once')),
+                policy='logged',
+            ))
+            self.assertEqual(rule.run(student), "give book")
+            self.assertEqual(runs, [15])
+            self.assertEqual(rule.freeze().run(student), "give book")
+            self.assertEqual(runs, [15, 15])
+        finally:
+            del POLICIES['logged']
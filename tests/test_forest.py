@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import pickle
+import unittest
+
+from dtree import *
+
+reads = []
+
+
+def read_score(s):
+    reads.append(s['score'])
+    return s['score']
+
+
+score = ValueAccessor('score', read_score, pure=True)
+age = ValueAccessor.key('age')
+country = ValueAccessor.key('country')
+
+
+@to_condition(pure=True)
+def is_member(s):
+    reads.append('member')
+    return s.get('member', False)
+
+
+def price(s):
+    return 100 if s['age'] >= 18 else 50
+
+
+def discount(s):
+    return 10
+
+
+pricing = DTree(Node(
+    (is_member & score.gt(50), ToAction(discount)),
+    (age.ge(0), ToAction(price)),
+))
+eligibility = DTree(Node(
+    (age.lt(18), pass_),
+    (is_member & score.gt(50), ToAction(discount)),
+    (score.gt(80), ToAction(price)),
+    policy='recursive',
+))
+risk = DTree(Node(
+    (country.in_(["x", "y"]), Node((score.lt(20), ToAction(price)))),
+))
+
+
+class ForestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        del reads[:]
+
+    def expected(self, obj):
+        results = []
+        for dtree in (pricing, eligibility, risk):
+            try:
+                results.append(dtree.run(obj))
+            except NoMatchError:
+                results.append("none")
+        return results
+
+    def test_forest(self):
+        forest = Forest([pricing, eligibility, risk], default="none")
+        self.assertTrue(risk.frozen)
+        people = [
+            {'age': a, 'score': s, 'country': c, 'member': m}
+            for a in (10, 30) for s in (10, 60, 90) for c in ("x", "z") for m in (False, True)
+        ]
+        for person in people:
+            self.assertEqual(forest.run(person), self.expected(person))
+
+        del reads[:]
+        forest.run({'age': 30, 'score': 10, 'country': "x", 'member': True})
+        # three trees read score and two test is_member, once each
+        self.assertEqual(reads, ['member', 10])
+        self.assertEqual(forest.network, {
+            'trees': 3, 'accessors': 3, 'shared_accessors': 2, 'conditions': 8, 'shared_conditions': 3,
+        })
+
+    def test_names(self):
+        forest = Forest({'pricing': pricing, 'risk': risk})
+        self.assertEqual(forest.run({'age': 10, 'score': 5, 'country': "y"}), {'pricing': 50, 'risk': 50})
+        self.assertEqual(forest.run({'age': 10, 'score': 5, 'country': "z"}), {'pricing': 50, 'risk': None})
+        forest = pickle.loads(pickle.dumps(Forest({'pricing': DTree(Node((age.lt(18), pass_)))})))
+        self.assertEqual(list(forest.trees), ['pricing'])
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import threading
+import unittest
+
+from dtree import *
+
+
+def give(item):
+    return ToAction(lambda s: item, "give %s" % item)
+
+
+def outcome(runner, obj):
+    try:
+        return runner.run(obj)
+    except NoMatchError:
+        return NoMatchError
+
+
+tenant = ValueAccessor.key('tenant')
+age = ValueAccessor.key('age')
+
+built = []
+
+
+class CountingDTree(DTree):
+
+    def __init__(self, node, lazy=False):
+        built.append(node)
+        super(CountingDTree, self).__init__(node, lazy)
+
+
+def tenant_node(name):
+    return Node(
+        (age.lt(12), Node(
+            (age.lt(6), give("%s toy" % name)),
+            (age.gt(100), give("%s cake" % name)),
+            policy='once',
+        )),
+        (age.lt(18), Node((age.ge(0), give("%s book" % name)))),
+        (else_, give("%s pen" % name)),
+    )
+
+
+NODE = Node(*[(tenant.eq(name), tenant_node(name)) for name in ("a", "b", "c", "d")], policy='recursive')
+STUDENTS = [{'tenant': "b", 'age': a} for a in (3, 8, 15, 30)]
+
+
+class LazyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        del built[:]
+        self.eager = DTree(NODE)
+
+    def test_lazy(self):
+        rule = CountingDTree(NODE, lazy=True)
+        self.assertEqual(len(built), 1)
+        self.assertEqual([outcome(rule, s) for s in STUDENTS], [outcome(self.eager, s) for s in STUDENTS])
+        # the root, its four children, and the two sub-trees of tenant b
+        self.assertEqual(len(built), 7)
+
+        # the leaves of sub-trees still to build are routed by stream()
+        del built[:]
+        toys = []
+        b_toy = NODE.args[1][1].args[0][1].args[0][1]
+        rule = CountingDTree(NODE, lazy=True)
+        results = list(rule.stream(STUDENTS, sinks={b_toy: toys.extend}))
+        self.assertEqual(results, [None, "b book", "b book", "b pen"])
+        self.assertEqual(toys, STUDENTS[:1])
+        self.assertEqual(len(built), 7)
+
+        del built[:]
+        rule = CountingDTree(NODE, lazy=True)
+        self.assertEqual(str(rule), str(self.eager))
+        self.assertEqual(len(built), 1 + 4 * 3)
+        rule = CountingDTree(NODE, lazy=True).expand()
+        self.assertEqual(len(built), 2 * (1 + 4 * 3))
+        self.assertEqual(len(rule.leaves), 4 * 4)
+
+    def test_add_child(self):
+        rule = DTree(NODE, lazy=True)
+        rule.add_child(tenant.eq("e"), tenant_node("e"))
+        self.assertEqual(rule.run({'tenant': "e", 'age': 30}), "e pen")
+        self.assertEqual(len(rule.children), 5)
+
+    def test_threads(self):
+        rule = CountingDTree(NODE, lazy=True)
+        start = threading.Event()
+        results = []
+
+        def run():
+            start.wait()
+            results.append([outcome(rule, s) for s in STUDENTS])
+
+        threads = [threading.Thread(target=run) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [[outcome(self.eager, s) for s in STUDENTS]] * 8)
+        # every sub-tree was built once
+        self.assertEqual(len(built), 7)
+        self.assertEqual(len(set(map(id, built))), 7)
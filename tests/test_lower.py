@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from dtree import *
+
+
+def give(item):
+    return ToAction(lambda s: item, "give %s" % item)
+
+
+def outcome(runner, obj):
+    try:
+        return runner.run(obj)
+    except NoMatchError:
+        return NoMatchError
+
+
+age = ValueAccessor.key('age', pure=True)
+gender = ValueAccessor.key('gender', pure=True)
+interest = ValueAccessor.key('interest', pure=True)
+name = ValueAccessor.key('name')
+
+
+students = [
+    {'age': a, 'gender': g, 'interest': i, 'name': 'x'}
+    for a in (5, 10, 12, 15, 18, 30, 65) for g in ("male", "female") for i in ("sports", "reading")
+]
+
+
+class LowerTestCase(unittest.TestCase):
+
+    def test_lower(self):
+        rule = DTree(Node(
+            (age.lt(12) & gender.eq("female"), give("doll")),
+            (age.lt(12), Node(
+                (interest.eq("sports") | gender.eq("male"), give("ball")),
+            )),
+            (age.lt(18) & ~interest.eq("sports"), give("book")),
+            (age.ge(60), Node(
+                (name.eq('x'), give("pen")),
+                policy='recursive',
+            )),
+            (age.lt(18), give("note")),
+            (else_, Node(
+                (gender.eq("female") & age.ge(18), give("bag")),
+            )),
+        ))
+        diagram = rule.lower(students)
+        self.assertIsInstance(diagram, DecisionDiagram)
+        for s in students:
+            self.assertEqual(outcome(diagram, s), outcome(rule, s))
+
+        report = diagram.report
+        self.assertEqual(report['atoms'], 7)
+        self.assertEqual(report['worst_tests_before'], 9)
+        self.assertEqual(report['worst_tests_after'], 5)
+        self.assertLess(report['average_tests_after'], report['average_tests_before'])
+        # age < 12, age < 18, age >= 60, gender = female and age >= 18, each once
+        self.assertEqual(diagram.count_tests({'age': 30, 'gender': 'female', 'interest': 'sports'}), 5)
+        self.assertIsNone(rule.lower().report['average_tests_before'])
+
+    def test_shared_subgraphs(self):
+        sub = Node((interest.eq("sports"), give("ball")), (else_, give("book")))
+        give_bag = give("bag")
+        rule = DTree(Node(
+            (gender.eq("female"), Node((age.lt(12), sub), (else_, give_bag))),
+            (else_, Node((age.lt(12), sub), (else_, give_bag))),
+        ))
+        # both branches of the gender test are the same diagram
+        self.assertEqual(rule.lower().report['nodes'], 2)
+
+    def test_errors(self):
+        self.assertRaises(Error, DTree(Node((name.eq('x'), give("pen")))).lower)
+        self.assertRaises(Error, DTree(Node((age.lt(3), give("pen")), policy='recursive')).lower)
+        self.assertRaises(Error, DTree(Node(*[(age.eq(i) | gender.eq(i), give(i)) for i in range(30)])).lower,
+                          max_nodes=10)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import pickle
+import unittest
+
+from dtree import *
+
+age = ValueAccessor.key('age')
+gender = ValueAccessor.key('gender')
+real = ValueAccessor.attr('real', caching=True)
+pure_age = ValueAccessor.key('age', pure=True)
+
+
+class Number(object):
+    real = 1
+
+
+def give_book(s):
+    return "book"
+
+
+def give_note(s):
+    return "note"
+
+
+def fail(s):
+    raise ValueError(s)
+
+
+def ignore(e, s):
+    pass
+
+
+rule = DTree(Node(
+    (age.lt(12) & ~gender.eq("male"), ToAction(give_book) / ToAction(give_note)),
+    (Or(age.ge(60), gender.in_(["other"])), ToAction(fail).catch(ToAction(give_book), ignore)),
+    (age.test(bool), Node(
+        (gender.eq("male"), pass_),
+    )),
+    (else_, ToAction(give_book)),
+    policy='recursive',
+))
+
+students = [
+    {'age': a, 'gender': g}
+    for a in (0, 10, 30, 70) for g in ("male", "female", "other")
+]
+
+
+class MapTestCase(unittest.TestCase):
+
+    def test_pickle(self):
+        for runner in (rule, rule.compile()):
+            copy = pickle.loads(pickle.dumps(runner))
+            self.assertEqual(str(copy), str(rule))
+            self.assertEqual([copy.run(s) for s in students], [rule.run(s) for s in students])
+        self.assertIs(pickle.loads(pickle.dumps(else_)), else_)
+        self.assertTrue(pickle.loads(pickle.dumps(real.eq(1))).validate(Number()))
+
+    def test_map(self):
+        self.assertEqual(rule.map(students, workers=2, chunksize=4), [rule.run(s) for s in students])
+        self.assertRaises(NoMatchError, DTree(Node((age.lt(0), pass_))).map, students, workers=2)
+
+    @unittest.skipIf(not hasattr(multiprocessing, 'get_context'), "needs multiprocessing contexts")
+    def test_map_spawned(self):
+        # spawn and forkserver workers get the tree pickled
+        def instrumented():
+            tree = DTree(rule.node)
+            tree.instrument()
+            return tree
+
+        def cached():
+            tree = DTree(Node(
+                (pure_age.lt(12), ToAction(give_book)),
+                (else_, ToAction(give_note)),
+            ))
+            tree.cache_decisions()
+            return tree
+
+        def audited():
+            tree = DTree(rule.node)
+            tree.audit(sample_rate=1.0)
+            return tree
+
+        spawn = multiprocessing.get_context('spawn')
+        pool = multiprocessing.Pool
+        multiprocessing.Pool = spawn.Pool
+        try:
+            for make in (instrumented, cached, audited):
+                tree = make()
+                expected = [tree.run(s) for s in students]
+                copy = pickle.loads(pickle.dumps(tree))
+                self.assertEqual([copy.run(s) for s in students], expected)
+                if copy.audit_log is not None:
+                    self.assertEqual(list(copy.audit_log)[-len(students):], list(tree.audit_log))
+                self.assertEqual(tree.map(students, workers=1, chunksize=4), expected)
+        finally:
+            multiprocessing.Pool = pool
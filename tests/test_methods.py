@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import pickle
 import unittest
 
 from dtree import *
@@ -113,3 +114,42 @@ class CommonTestCase(unittest.TestCase):
     def test_value_accessor(self):
         condition = name.test(lambda name: len(name) == 3, "name size == 3")
         self.assertTrue(condition.validate(student))
+
+    def test_key_paths(self):
+        s = {'profile': {'age': 18}, 'a.b': 1}
+        profile_age = ValueAccessor.key('profile.age')
+        self.assertEqual(profile_age.of(s), 18)
+        self.assertEqual(profile_age.item_path, ('profile', 'age'))
+        self.assertTrue(profile_age.ge(18).validate(s))
+        self.assertEqual(ValueAccessor.key('a.b', sep=None).of(s), 1)
+        self.assertEqual(pickle.loads(pickle.dumps(profile_age)).of(s), 18)
+        self.assertEqual(ValueAccessor.attr('real.imag').of(3), 0)
+        self.assertEqual(ValueAccessor.attr('real.imag').attr_path, ('real', 'imag'))
+
+    def test_shared_evaluation(self):
+        calls = []
+
+        @to_condition(pure=True)
+        def is_vip(s):
+            calls.append(s['name'])
+            return s['name'] == 'yao'
+
+        other_age = ValueAccessor('age', lambda s: s['age'])
+        self.assertEqual(age.eq(18).key, age.eq(18).key)
+        self.assertNotEqual(age.eq(18).key, age.eq(True).key)
+        self.assertNotEqual(age.eq(18).key, other_age.eq(18).key)
+        self.assertEqual(And(is_vip, age.in_([1, 2])).key, And(is_vip, age.in_([1, 2])).key)
+        self.assertIsNone(And(is_vip, to_condition(lambda s: True)).key)
+
+        rule = DTree(Node(
+            (And(is_vip, age.lt(10)), pass_),
+            (Or(~age.gt(30), name.eq('li')), Node(
+                (And(is_vip, age.lt(10)) | age.eq(17), pass_),
+                (~(is_vip & age.lt(10)), ToAction(lambda s: 'shared')),
+            )),
+            policy='recursive',
+        ))
+        for runner in (rule, rule.compile()):
+            del calls[:]
+            self.assertEqual(runner.run(student), 'shared')
+            self.assertEqual(calls, ['yao'])
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import sys
+import unittest
+
+from dtree import *
+
+age = ValueAccessor.key('age')
+gender = ValueAccessor.key('gender')
+
+give_book = ToAction(lambda s: "book", "give book")
+give_note = ToAction(lambda s: "note", "give note")
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rule = DTree(Node(
+            (age.lt(12), Node(
+                (gender.eq("female"), give_note),
+                (else_, give_book),
+            )),
+            (age.ge(60), Node(
+                (gender.eq("male"), give_book),
+            )),
+            (else_, give_note),
+            policy='recursive',
+        ))
+
+    def run_all(self):
+        for a in (10, 30, 70):
+            for g in ("male", "female"):
+                self.rule.run({'age': a, 'gender': g})
+
+    def test_off_by_default(self):
+        self.run_all()
+        self.assertIsNone(self.rule.metrics)
+        self.assertNotIn('_run_tree', self.rule.__dict__)
+
+    def test_snapshot(self):
+        self.rule.instrument()
+        self.run_all()
+        metrics = self.rule.metrics
+        self.assertEqual((metrics['evaluations'], metrics['matches']), (6, 6))
+        self.assertEqual(sum(metrics['histogram']), 6)
+        young, old, other = metrics['children']
+        self.assertEqual(young['condition']['description'], 'age < 12')
+        self.assertEqual((young['condition']['evaluations'], young['condition']['matches']), (6, 2))
+        self.assertEqual([c['runner']['evaluations'] for c in young['runner']['children']], [1, 1])
+        self.assertEqual((old['runner']['evaluations'], old['runner']['matches']), (2, 1))
+        self.assertEqual(other['runner']['description'], 'give note')
+        self.assertEqual(other['runner']['evaluations'], 3)
+
+        rendered = self.rule.render_metrics()
+        counts = [line.rsplit('  [', 1)[1].split(',')[0] for line in rendered.splitlines()]
+        self.assertEqual(counts, ['6/6', '2/6', '1/2', '1/1', '2/4', '1/2', '3/3'])
+        self.assertEqual(
+            [line.rsplit('  [', 1)[0] for line in rendered.splitlines()],
+            str(self.rule).splitlines(),
+        )
+
+        self.rule.instrument(False)
+        self.assertIsNone(self.rule.metrics)
+        self.assertEqual(self.rule.render_metrics(), str(self.rule))
+
+    def test_frozen_after_instrument(self):
+        import threading
+
+        self.rule.instrument()
+        self.rule.freeze()
+        self.assertRaises(FrozenError, self.rule.instrument, False)
+
+        def run():
+            for _ in range(200):
+                self.run_all()
+
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        metrics = self.rule.metrics
+        self.assertEqual(metrics['evaluations'], 4 * 200 * 6)
+        self.assertEqual(metrics['children'][0]['condition']['evaluations'], 4 * 200 * 6)
+
+    def test_deep_tree(self):
+        depth = 3 * sys.getrecursionlimit()
+        node = Node((else_, give_book))
+        for _ in range(depth):
+            node = Node((age.lt(0), give_note), (else_, node))
+        rule = DTree(node)
+        rule.instrument()
+        metrics = rule.metrics
+        for _ in range(depth):
+            self.assertEqual(metrics['evaluations'], 0)
+            metrics = metrics['children'][1]['runner']
+        self.assertEqual(metrics['children'][0]['runner']['description'], 'give book')
+        rule.instrument(False)
+        self.assertIsNone(rule.metrics)
+        self.assertEqual(rule.run({'age': 30}), "book")
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from dtree import *
+
+
+def give(item):
+    return ToAction(lambda s: item, "give %s" % item)
+
+
+country = ValueAccessor.key('country', pure=True)
+age = ValueAccessor.key('age', pure=True)
+name = ValueAccessor.key('name')
+
+
+def slow_check(s):
+    sum(range(2000))
+    return s['age'] != 1
+
+
+slow = to_condition(description="slow", pure=True)(slow_check)
+
+samples = [
+    {'country': c, 'age': a, 'name': 'x'}
+    for c in ['FR'] * 6 + ['DE'] * 3 + ['NL', 'IT']
+    for a in (1, 10, 20, 30, 70)
+]
+
+
+class OptimizeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rule = DTree(Node(
+            (country.eq("DE"), give(0)),
+            (country.in_(["NL", "BE"]), give(1)),
+            (country.eq("FR"), Node(
+                (slow & age.lt(15), give(2)),
+                (age.ge(65), give(3)),
+                (age.le(12), give(4)),
+                (age.ge(15), give(5)),
+            )),
+            (name.eq("x") & country.eq("IT"), give(6)),
+            (country.eq("XX"), give(7)),
+            (else_, give(8)),
+        ))
+
+    def descriptions(self, dtree):
+        return [condition.description for condition, _ in dtree.children]
+
+    def test_samples(self):
+        optimized = self.rule.optimize(samples)
+        self.assertIsNot(optimized, self.rule)
+        self.assertEqual(
+            self.descriptions(optimized),
+            ["country = FR", "country = DE", "country in ['NL', 'BE']",
+             "AND(name = x, country = IT)", "country = XX", "ELSE"],
+        )
+        france = optimized.children[0][1]
+        self.assertEqual(france.children[0][0].description, "AND(age < 15, slow)")
+        self.assertEqual(
+            self.descriptions(france)[1:],
+            ["age >= 65", "age <= 12", "age >= 15"],
+        )
+        for s in samples + [{'country': 'XX', 'age': 1, 'name': 'y'}]:
+            self.assertEqual(optimized.run(s), self.rule.run(s))
+        self.assertEqual(self.descriptions(self.rule)[0], "country = DE")
+
+    def test_recorded_metrics(self):
+        self.assertRaises(Error, self.rule.optimize)
+        self.rule.instrument()
+        for s in samples:
+            self.rule.run(s)
+        optimized = self.rule.optimize()
+        self.assertEqual(self.descriptions(optimized)[0], "country = FR")
+        france = optimized.children[0][1]
+        self.assertEqual(france.children[0][0].description, "AND(slow, age < 15)")
+
+    def test_exclusive_ranges(self):
+        rule = DTree(Node(
+            (age.lt(10), give(0)),
+            (age.ge(60), give(1)),
+            (age.eq(30), give(2)),
+            (age.gt(20), give(3)),
+        ))
+        ages = [{'age': a} for a in [1, 70, 70, 30, 30, 30, 25]]
+        optimized = rule.optimize(ages)
+        self.assertEqual(
+            self.descriptions(optimized),
+            ["age = 30", "age >= 60", "age < 10", "age > 20"],
+        )
+        for s in ages:
+            self.assertEqual(optimized.run(s), rule.run(s))
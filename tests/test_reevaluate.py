@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from dtree import *
+
+reads = []
+
+
+def reader(name):
+    def get(s):
+        reads.append(name)
+        return s[name]
+    return ValueAccessor(name, get)
+
+
+age = reader('age')
+gender = reader('gender')
+interest = reader('interest')
+checks = []
+
+
+@to_condition
+def is_new(s):
+    checks.append(s)
+    return s.get('new', False)
+
+
+give_book = ToAction(lambda s: "book", "give book")
+give_note = ToAction(lambda s: "note", "give note")
+give_ball = ToAction(lambda s: "ball", "give ball")
+
+
+class ReevaluateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        del reads[:]
+        del checks[:]
+        self.rule = DTree(Node(
+            (gender.eq("female") & age.lt(12), give_note),
+            (age.lt(18), Node(
+                (interest.eq("sports"), give_ball),
+                (is_new, give_book),
+            )),
+            (else_, give_book),
+            policy='recursive',
+        ))
+
+    def test_trace(self):
+        student = {'age': 10, 'gender': 'male', 'interest': 'reading'}
+        result, trace = self.rule.trace(student)
+        self.assertEqual(result, "book")
+        self.assertIs(trace.leaf, give_book)
+        self.assertEqual(
+            [(c.description, outcome) for c, outcome in trace.outcomes.items()],
+            [("AND(gender = female, age < 12)", False), ("age < 18", True),
+             ("interest = sports", False), ("is_new", False)],
+        )
+
+    def test_reevaluate(self):
+        student = {'age': 10, 'gender': 'male', 'interest': 'reading', 'new': True}
+        result, trace = self.rule.trace(student)
+        self.assertEqual(result, "book")
+        self.assertIs(trace.leaf, give_book)
+        self.assertEqual(self.rule.run(student), "book")
+
+        del reads[:]
+        student['interest'] = 'sports'
+        result, trace = self.rule.reevaluate(student, trace, changed={'interest'})
+        self.assertEqual(result, "ball")
+        self.assertEqual(reads, ['interest'])
+        self.assertEqual(len(trace.outcomes), 3)
+
+        del reads[:]
+        del checks[:]
+        student['age'] = 30
+        result, trace = self.rule.reevaluate(student, trace, changed={age})
+        self.assertEqual(result, "book")
+        self.assertIs(trace.leaf, give_book)
+        self.assertEqual(sorted(reads), ['age', 'gender'])
+
+        # undeclared changes are not seen
+        student['age'] = 5
+        result, trace = self.rule.reevaluate(student, trace, changed={'gender'})
+        self.assertEqual(result, "book")
+        result, trace = self.rule.reevaluate(student, trace, changed={'age'})
+        self.assertEqual(result, "ball")
+
+    def test_opaque_conditions(self):
+        student = {'age': 10, 'gender': 'male', 'interest': 'reading'}
+        _, trace = self.rule.trace(student)
+        del checks[:]
+        student['new'] = True
+        result, _ = self.rule.reevaluate(student, trace, changed=())
+        self.assertEqual(result, "book")
+        self.assertEqual(len(checks), 1)
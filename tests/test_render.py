@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import json
+import sys
+import unittest
+
+try:
+    from StringIO import StringIO  # Python 2, for str
+except ImportError:
+    from io import StringIO
+
+from dtree import *
+
+age = ValueAccessor.key('age')
+gender = ValueAccessor.key('gender')
+
+give_book = ToAction(lambda s: "book", "give book")
+give_note = ToAction(lambda s: "note", 'give "note"')
+
+
+class RenderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rule = DTree(Node(
+            (age.lt(12), Node(
+                (gender.eq("female"), give_note),
+                (else_, give_book),
+                policy='recursive',
+            )),
+            (else_, give_book),
+        ))
+
+    def test_render(self):
+        text = (
+            '+++root:\n'
+            '|      +++age < 12(recursive):\n'
+            '|      |      ---gender = female --> give "note"\n'
+            '|      |      ---ELSE --> give book\n'
+            '|      ---ELSE --> give book\n'
+        )
+        self.assertEqual(str(self.rule), text)
+        self.assertEqual(self.rule.render(), text)
+        out = StringIO()
+        self.assertIsNone(self.rule.render(out))
+        self.assertEqual(out.getvalue(), text)
+        self.assertEqual(str(self.rule.children[0][1]), text.split('\n', 2)[2].rsplit('|      ---', 1)[0])
+
+    def test_exports(self):
+        self.assertEqual(json.loads(self.rule.to_json()), {
+            'policy': 'once',
+            'children': [
+                ['age < 12', {
+                    'policy': 'recursive',
+                    'children': [['gender = female', 'give "note"'], ['ELSE', 'give book']],
+                }],
+                ['ELSE', 'give book'],
+            ],
+        })
+        self.assertEqual(self.rule.to_dot(), (
+            'digraph dtree {\n'
+            '  n0 [label="root (once)"];\n'
+            '  n1 [label="recursive"];\n'
+            '  n0 -> n1 [label="age < 12"];\n'
+            '  n2 [shape=box, label="give \\"note\\""];\n'
+            '  n1 -> n2 [label="gender = female"];\n'
+            '  n3 [shape=box, label="give book"];\n'
+            '  n1 -> n3 [label="ELSE"];\n'
+            '  n4 [shape=box, label="give book"];\n'
+            '  n0 -> n4 [label="ELSE"];\n'
+            '}\n'
+        ))
+
+    def test_deep_tree(self):
+        depth = sys.getrecursionlimit() * 3
+        rule = sub = DTree(Node())
+        for i in range(depth):
+            child = DTree(Node((else_, give_book)))
+            sub.add_child(age.gt(i), child)
+            sub = child
+        lines = str(rule).splitlines()
+        # the root, and a sub-tree and an else line for each level
+        self.assertEqual(len(lines), 1 + 2 * depth)
+        self.assertEqual(lines[depth + 1], '|      ' * (depth + 1) + '---ELSE --> give book')
+        self.assertEqual(rule.to_dot().count(' -> '), 2 * depth)
+        self.assertEqual(rule.to_json().count('"children"'), 1 + depth)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import dtree
+from dtree import *
+
+accessors = {
+    'age': ValueAccessor.key('age'),
+    'gender': ValueAccessor.key('gender'),
+    'interest': ValueAccessor.key('interest'),
+    'favorite': ValueAccessor.key('favorite'),
+}
+
+give_book = ToAction(lambda s: "book", "give book")
+actions = {
+    'give_book': give_book,
+    'give_note': lambda s: "note",
+    'log': lambda s: s.setdefault('log', True),
+}
+conditions = {'is_adult': lambda s: s['age'] >= 18}
+
+RULES = {
+    'policy': 'recursive',
+    'children': [
+        [{'and': [['age', '<', 12], ['gender', '=', 'female']], 'description': 'young girl'}, 'give_note'],
+        ['is_adult', {
+            'policy': 'once',
+            'children': [
+                [['interest', 'in', ['reading', 'writing']], ['log', 'give_book']],
+                [{'not': ['interest', '=', {'accessor': 'favorite'}]}, 'give_note'],
+            ],
+        }],
+        [{'or': [['gender', 'is', None], ['interest', 'bool-false']]}, 'give_note'],
+        ['else', 'give_book'],
+    ],
+}
+
+
+class RulesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'rules.json')
+        self.write(RULES)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, document):
+        with open(self.path, 'w') as f:
+            json.dump(document, f)
+
+    def load(self):
+        return load_rules(self.path, accessors, actions, conditions)
+
+    def caches(self):
+        return sorted(os.listdir(os.path.join(self.dir, '__pycache__')))
+
+    def check(self, rule):
+        self.assertTrue(rule.frozen)
+        self.assertEqual(rule.children[0][0].description, 'young girl')
+        self.assertEqual(rule.children[1][1].children[1][0].description, 'NOT(interest = favorite)')
+        self.assertIs(rule.leaves[-1], give_book)
+        student = {'age': 30, 'gender': 'male', 'interest': 'reading', 'favorite': 'chess'}
+        self.assertEqual(rule.run(student), "book")
+        self.assertTrue(student['log'])
+        self.assertEqual(rule.run(dict(student, interest='chess')), "book")
+        self.assertEqual(rule.run(dict(student, interest='chess', age=50, favorite='go')), "note")
+        self.assertEqual(rule.run({'age': 10, 'gender': 'female'}), "note")
+        self.assertEqual(rule.run({'age': 15, 'gender': None, 'interest': 'chess'}), "note")
+
+    def test_cache(self):
+        rule = self.load()
+        self.check(rule)
+        self.assertEqual(len(self.caches()), 1)
+
+        loads = json.loads
+        dtree.json.loads = None
+        try:
+            self.check(self.load())
+        finally:
+            dtree.json.loads = loads
+
+        old = self.caches()
+        self.write(dict(RULES, policy='once'))
+        self.assertEqual(self.load().policy, 'once')
+        self.assertEqual(len(self.caches()), 1)
+        self.assertNotEqual(self.caches(), old)
+        self.assertEqual(load_rules(self.path, accessors, actions, conditions, cache_dir=False).policy, 'once')
+
+    def test_cache_follows_named_objects(self):
+        self.write({'children': [[['age', '<', 12], 'give_book']]})
+        pure = dict(accessors, age=ValueAccessor.key('age', pure=True))
+        rule = load_rules(self.path, pure, actions, conditions)
+        self.assertEqual(rule.children[0][0].description, 'age < 12')
+        rule.cache_decisions()
+
+        renamed = dict(accessors, age=ValueAccessor.key('age', 'years'))
+        rule = load_rules(self.path, renamed, actions, conditions)
+        self.assertEqual(rule.children[0][0].description, 'years < 12')
+        self.assertFalse(rule.children[0][0].pure)
+        self.assertRaises(dtree.Error, rule.cache_decisions)
+        self.assertEqual(len(self.caches()), 1)
+
+    def test_cache_globals(self):
+        self.load()
+        path = os.path.join(self.dir, '__pycache__', self.caches()[0])
+        with open(path, 'wb') as f:
+            # a pickle calling os.remove(self.path)
+            f.write(b'cos\nremove\n(' + pickle.dumps(self.path, 0)[:-1] + b'tR.')
+        self.check(self.load())
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_errors(self):
+        for document, message in (
+            ({'children': [['age', '<', 1]]}, 'rules.json.children[0]: expected a [condition, runner] pair'),
+            ({'children': [[['size', '<', 1], 'give_book']]}, "unknown accessor 'size'"),
+            ({'children': [[['age', '~', 1], 'give_book']]}, "unknown operator '~'"),
+            ({'children': [[['age', 'bool-true', 1], 'give_book']]}, "wrong number of operands"),
+            ({'children': [['else', {'children': [['is_old', 'give_book']]}]]},
+             "rules.json.children[0][1].children[0][0]: unknown condition 'is_old'"),
+            ({'children': [[{'and': []}, 'give_book']]}, "non-empty list of conditions"),
+            ({'children': [['else', ['give_book', 'give_gift']]]}, "unknown action 'give_gift'"),
+            ({'policy': 'random', 'children': []}, "unknown policy 'random'"),
+        ):
+            self.write(document)
+            with self.assertRaises(RuleFileError) as context:
+                self.load()
+            self.assertIn(message, str(context.exception))
+        with open(self.path, 'w') as f:
+            f.write('{')
+        self.assertRaises(RuleFileError, self.load)
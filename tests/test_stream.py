@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import threading
+import unittest
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from dtree import *
+
+age = ValueAccessor.key('age')
+gender = ValueAccessor.key('gender')
+
+give_book = ToAction(lambda s: "book", "give book")
+give_note = ToAction(lambda s: "note", "give note")
+give_ball = ToAction(lambda s: "ball", "give ball")
+
+
+def fail(s):
+    raise ValueError(s['age'])
+
+
+class StreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rule = DTree(Node(
+            (age.lt(0), ToAction(fail)),
+            (age.lt(12), Node(
+                (gender.eq("female"), give_note),
+                (else_, give_ball),
+            )),
+            (age.lt(60), give_book),
+            policy='recursive',
+        ))
+        self.reads = []
+
+    def students(self, ages):
+        for a in ages:
+            self.reads.append(a)
+            yield {'age': a, 'gender': "female" if a % 2 else "male"}
+
+    def test_lazy(self):
+        stream = self.rule.stream(self.students(range(0, 60, 5)), chunk_size=4)
+        self.assertEqual(self.reads, [])
+        self.assertEqual(next(stream), "ball")
+        self.assertEqual(self.reads, [0, 5, 10, 15])
+        self.assertEqual(list(stream), ["note", "ball"] + ["book"] * 9)
+        self.assertEqual(len(self.reads), 12)
+
+    def test_sinks(self):
+        chunks = []
+        notes = queue.Queue(maxsize=1)
+        received = []
+
+        def consume():
+            for _ in range(3):
+                received.append(notes.get()['age'])
+
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        results = list(self.rule.stream(
+            self.students([1, 2, 3, 30, 4, 5]), chunk_size=3,
+            sinks={give_ball: chunks.append, give_note: notes},
+        ))
+        consumer.join()
+        self.assertEqual(results, [None, None, None, "book", None, None])
+        self.assertEqual([[s['age'] for s in chunk] for chunk in chunks], [[2], [4]])
+        self.assertEqual(received, [1, 3, 5])
+
+    def test_errors(self):
+        errors = []
+        results = list(self.rule.stream(
+            self.students([-1, 10, 70]), chunk_size=2,
+            error_handler=lambda e, s: errors.append((type(e), s['age'])),
+        ))
+        self.assertEqual(results, [None, "ball", None])
+        self.assertEqual(errors, [(ValueError, -1), (NoMatchError, 70)])
+        self.assertRaises(ValueError, list, self.rule.stream(self.students([10, -1])))
+
+    def test_sinks_and_errors(self):
+        chunks = []
+        errors = []
+        results = list(self.rule.stream(
+            self.students([-1, 2, 30, 70, 4]), chunk_size=2,
+            sinks={give_ball: chunks.append},
+            error_handler=lambda e, s: errors.append((type(e), s['age'])),
+        ))
+        self.assertEqual(results, [None, None, "book", None, None])
+        self.assertEqual([[s['age'] for s in chunk] for chunk in chunks], [[2], [4]])
+        self.assertEqual(errors, [(ValueError, -1), (NoMatchError, 70)])